@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Benchmarks of the NUT client against a local upsd emulator.
+
+Each scenario runs for a number of operations over a real TCP
+connection and reports the operations per second and the median (p50)
+and 99th percentile (p99) latency of one operation::
+
+    python benchmarks/benchmark.py
+    python benchmarks/benchmark.py --vars 200 --latency 0.0005 get_var
+
+The emulator is tests/emulator.py; see --help for its settings.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "tests"))
+
+from emulator import UPSEmulator
+from nut2 import PyNUTClient, FleetPoller, ShardedPoller
+
+
+def percentile(samples, fraction):
+    """Return the value below which fraction of the sorted samples lie."""
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+def measure(name, operation, count):
+    """Call operation count times and print the statistics."""
+    operation()  # Warm up.
+    samples = []
+    start = time.perf_counter()
+    for _ in range(count):
+        begin = time.perf_counter()
+        operation()
+        samples.append(time.perf_counter() - begin)
+    total = time.perf_counter() - start
+    samples.sort()
+    print("%-14s %8d ops %10.0f ops/s   p50 %8.1f us   p99 %8.1f us" % (
+        name, count, count / total, percentile(samples, 0.5) * 1e6,
+        percentile(samples, 0.99) * 1e6))
+    return samples
+
+
+def bench_get_var(upsd, options):
+    with PyNUTClient(upsd.host, upsd.port, options.login,
+                     options.password) as client:
+        measure("get_var", lambda: client.get_var("ups0", "var0"),
+                options.count)
+
+
+def bench_list_vars(upsd, options):
+    with PyNUTClient(upsd.host, upsd.port, options.login,
+                     options.password) as client:
+        measure("list_vars", lambda: client.list_vars("ups0"),
+                options.count)
+
+
+def bench_list_commands(upsd, options):
+    with PyNUTClient(upsd.host, upsd.port, options.login,
+                     options.password) as client:
+        measure("list_commands", lambda: client.list_commands("ups0"),
+                max(1, options.count // 10))
+
+
+def fleet_targets(upsd, options):
+    """Start the extra servers of the fleet scenarios, and return them
+    with the (host, port, login, password) of the whole fleet.
+    """
+    servers = [UPSEmulator(**emulator_settings(options)).start()
+               for _ in range(options.servers - 1)]
+    return servers, [(server.host, server.port, options.login,
+                      options.password) for server in [upsd] + servers]
+
+
+def bench_fleet(upsd, options):
+    servers, targets = fleet_targets(upsd, options)
+    try:
+        poller = FleetPoller(targets, concurrency=options.concurrency)
+        try:
+            measure("fleet_sweep", poller.sweep, max(1, options.count // 100))
+        finally:
+            poller.close()
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def bench_sharded(upsd, options):
+    servers, targets = fleet_targets(upsd, options)
+    try:
+        with ShardedPoller(targets, processes=options.processes) as poller:
+            measure("sharded_sweep", poller.sweep,
+                    max(1, options.count // 100))
+    finally:
+        for server in servers:
+            server.stop()
+
+
+SCENARIOS = {
+    'get_var': bench_get_var,
+    'list_vars': bench_list_vars,
+    'list_commands': bench_list_commands,
+    'fleet': bench_fleet,
+    'sharded': bench_sharded,
+}
+
+
+def emulator_settings(options):
+    return dict(ups_count=options.ups, var_count=options.vars,
+                command_count=options.commands,
+                value_size=options.value_size, latency=options.latency,
+                jitter=options.jitter)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("scenarios", nargs="*",
+                        help="scenarios to run, among %s (default: all)" %
+                        ", ".join(sorted(SCENARIOS)))
+    parser.add_argument("--count", type=int, default=2000,
+                        help="operations per scenario (list_commands runs "
+                        "a tenth, fleet a hundredth)")
+    parser.add_argument("--ups", type=int, default=1,
+                        help="UPS per server")
+    parser.add_argument("--vars", type=int, default=50,
+                        help="variables per UPS")
+    parser.add_argument("--commands", type=int, default=20,
+                        help="commands per UPS")
+    parser.add_argument("--value-size", type=int, default=8,
+                        help="length of the variable values")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="delay before each reply, in seconds")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="maximum random delay added to the latency")
+    parser.add_argument("--servers", type=int, default=20,
+                        help="servers polled by the fleet scenarios")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="concurrent connections of the fleet scenario")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="worker processes of the sharded scenario "
+                        "(default: one per CPU)")
+    parser.add_argument("--login", default=None)
+    parser.add_argument("--password", default=None)
+    options = parser.parse_args(argv)
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: %s" % name)
+
+    with UPSEmulator(**emulator_settings(options)) as upsd:
+        for name in options.scenarios or sorted(SCENARIOS):
+            SCENARIOS[name](upsd, options)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,37 @@
 """A Python module for dealing with NUT (Network UPS Tools) servers.
 
 * PyNUTError: Base class for custom exceptions.
+* PyNUTConnectionError: Raised when the connection to the server fails.
+* PyNUTTimeoutError: Raised when the server does not answer in time.
 * PyNUTClient: Allows connecting to and communicating with PyNUT
   servers.
+* SharedPyNUTClient: PyNUTClient that can be shared between threads,
+  batching and coalescing their requests.
+* ConnectionPool: Keeps PyNUTClient sessions alive and reconnects them.
+* AsyncPyNUTClient: asyncio version of PyNUTClient, with the same API
+  exposed as coroutines.
+* Pipeline: Sends several requests to a server in a single round trip.
+* Transport: Base class for client connections; TCPTransport,
+  UnixTransport and LoopbackTransport implement it.
+* MetadataCache: LRU cache with expiry for static UPS metadata.
+* DiscoveryCache: Inventory of the UPS of servers, saved between runs.
+* ClientStats: Per-command request counters and latency histograms,
+  with observer hooks.
+* UPSSnapshot: Compact, typed copy of the variables of a UPS, with
+  variable names shared through a UPSSchema.
+* HistoryStore: Ring buffers of recent numeric values of UPS, with
+  min/max/avg rollups over several windows.
+* SampleLog: Segmented, append-only file log of UPS variables, read
+  back by time range through mmap.
+* PollScheduler: Polls each variable of a UPS at its own, learned pace.
+* FleetPoller: Polls the UPS of many servers concurrently.
+* FleetExecutor: Runs set_var, run_command or fsd on many UPS at once.
+* ShardedPoller: Polls the UPS of many servers from several processes.
+* FleetColumns: Variables of many UPS as numeric columns (numpy arrays
+  if numpy is installed) with missing-value masks.
+* NUTProxy: Caching NUT server relaying one or more upstream servers.
+* MetricsExporter: Prometheus/OpenMetrics exporter polling NUT servers
+  on its own schedule.
 
 Copyright (C) 2019 Ryan Shipp
 
@@ -22,12 +51,60 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import telnetlib
+import array
+import asyncio
+import bisect
+import collections
+import collections.abc
+import contextlib
+import functools
+import gzip
+import http.server
+import inspect
+import json
 import logging
+import math
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import weakref
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+try:
+    import ssl
+except ImportError:  # Python built without OpenSSL
+    ssl = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __version__ = '2.1.1'
-__all__ = ['PyNUTError', 'PyNUTClient']
+__all__ = ['PyNUTError', 'PyNUTConnectionError', 'PyNUTTimeoutError',
+           'PyNUTCircuitOpenError', 'PyNUTClient', 'ConnectionPool',
+           'SharedPyNUTClient', 'AsyncPyNUTClient', 'Pipeline',
+           'AsyncPipeline', 'Transport', 'TCPTransport', 'UnixTransport',
+           'LoopbackTransport', 'MetadataCache', 'DiscoveryCache', 'VarChange',
+           'ClientStats', 'CommandStats', 'LatencyHistogram', 'RequestEvent',
+           'UPSSchema', 'UPSSnapshot', 'HistoryStore', 'VarHistory', 'Rollup',
+           'SampleLog', 'Sample', 'PollScheduler', 'FleetPoller',
+           'FleetTarget', 'PollResult', 'FleetExecutor', 'ActionTarget',
+           'ActionResult', 'ShardedPoller', 'FleetColumns', 'NUTProxy',
+           'ProxyUpstream', 'MetricsExporter']
 
 logging.basicConfig(level=logging.WARNING, format="[%(levelname)s] %(message)s")
 
@@ -35,399 +112,4394 @@ logging.basicConfig(level=logging.WARNING, format="[%(levelname)s] %(message)s")
 class PyNUTError(Exception):
     """Base class for custom exceptions."""
 
-class PyNUTClient(object):
-    """Access NUT (Network UPS Tools) servers."""
 
-    def __init__(self, host="127.0.0.1", port=3493, login=None, password=None, debug=False, timeout=5, connect=True):
-        """Class initialization method.
+class PyNUTConnectionError(PyNUTError):
+    """Raised when the connection to the server fails, or can no longer
+    be used.
+    """
 
-        host     : Host to connect (defaults to 127.0.0.1).
-        port     : Port where NUT listens for connections (defaults to 3493).
-        login    : Login used to connect to NUT server (defaults to None
-                   for no authentication).
-        password : Password used when using authentication (defaults to None).
-        debug    : Boolean, put class in debug mode (prints everything
-                   on console, defaults to False).
-        timeout  : Timeout used to wait for network response (defaults
-                   to 5 seconds).
-        """
-        if debug:
-            # Print DEBUG messages to the console.
-            logging.getLogger().setLevel(logging.DEBUG)
 
-        logging.debug("Class initialization...")
-        logging.debug(" -> Host = %s (port %s)", host, port)
-        logging.debug(" -> Login = '%s' / '%s'", login, password)
+class PyNUTTimeoutError(PyNUTConnectionError):
+    """Raised when the server does not answer in time.
 
-        self._host = host
-        self._port = port
-        self._login = login
-        self._password = password
-        self._timeout = timeout
-        self._srv_handler = None
+    When an operation runs out of its deadline (see PyNUTClient), the
+    error tells how far it went: operation is the name of the client
+    method, elapsed the time spent on it, and partial the list of the
+    replies received in full before the timeout (completed is their
+    number). As a reply may still be on its way, the connection should
+    not be used after a timeout.
+    """
 
-        if connect:
-            self._connect()
+    def __init__(self, message, operation=None, elapsed=None, partial=()):
+        PyNUTError.__init__(self, message)
+        self.operation = operation
+        self.elapsed = elapsed
+        self.partial = list(partial)
+        self.completed = len(self.partial)
 
-    def __del__(self):
-        # Try to disconnect cleanly when class is deleted.
-        if self._srv_handler:
-            try:
-                self._srv_handler.write(b"LOGOUT\n")
-                self._srv_handler.close()
-            except (telnetlib.socket.error, AttributeError):
-                # The socket is already disconnected.
-                pass
 
-    def __enter__(self):
-        return self
+def _wrap_error(err):
+    """Return err as a PyNUTError, so that an unexpected exception (like
+    a reply which is not valid UTF-8) is reported like protocol errors.
+    """
+    if isinstance(err, PyNUTError):
+        return err
+    error = PyNUTError("%s: %s" % (type(err).__name__, err))
+    error.__cause__ = err
+    return error
 
-    def __exit__(self, exc_t, exc_v, trace):
-        self.__del__()
 
-    def _connect(self):
-        """Connects to the defined server.
+class _Deadline(object):
+    """Time budget of one logical client operation."""
 
-        If login/pass was specified, the class tries to authenticate.
-        An error is raised if something goes wrong.
+    __slots__ = ('operation', 'start', 'expires', 'replies')
+
+    def __init__(self, operation, seconds):
+        self.operation = operation
+        self.start = time.monotonic()
+        self.expires = self.start + seconds
+        self.replies = []
+
+    def timeout(self, timeout):
+        """Return the timeout to use for the next read."""
+        remaining = self.expires - time.monotonic()
+        if remaining <= 0:
+            raise self.error("Timed out waiting for the server.")
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def error(self, message):
+        now = time.monotonic()
+        if now >= self.expires:
+            message = "%s exceeded its deadline of %.3gs." % (
+                self.operation, self.expires - self.start)
+        return PyNUTTimeoutError(message, self.operation, now - self.start,
+                                 self.replies)
+
+
+def _operation(method):
+    """Run a PyNUTClient method as one logical operation, subject to the
+    client deadline as a whole (calls made by the method itself are
+    part of the same operation). For a generator method, the deadline
+    covers the whole iteration, from its first item to its last.
+    """
+    name = method.__name__.lstrip('_')
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator(self, *args, **kwargs):
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("%s%r called...", name, args)
+            iterator = method(self, *args, **kwargs)
+            if self._budget is not None or self._deadline is None:
+                yield from iterator
+                return
+            # The budget is only installed while the generator runs, so
+            # that other calls made between items are not charged for it.
+            budget = _Deadline(name, self._deadline)
+            while True:
+                self._budget = budget
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._budget = None
+                try:
+                    yield item
+                except GeneratorExit:
+                    self._budget = budget
+                    try:
+                        iterator.close()
+                    finally:
+                        self._budget = None
+                    raise
+        return generator
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # Checked first so that nothing is formatted when not debugging.
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("%s%r called...", name, args)
+        if self._budget is not None or self._deadline is None:
+            return method(self, *args, **kwargs)
+        with self.deadline(self._deadline, name):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class Transport(object):
+    """Base class for the byte stream connecting a client to a server.
+
+    Received data is kept in a single reusable bytearray. read_until
+    only searches the bytes that arrived since its last search, and
+    copies a reply out of the buffer exactly once. Subclasses provide
+    the actual I/O by implementing _send, _recv_into and close.
+
+    bytes_sent and bytes_received count the bytes written and returned
+    by read_until.
+    """
+
+    # The TLS session in use, if any, and whether it was resumed.
+    tls_session = None
+    tls_session_reused = False
+
+    def __init__(self, bufsize=8192):
+        self._buffer = bytearray(bufsize)
+        self._start = 0
+        self._end = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def write(self, data, timeout=None):
+        """Send data to the server.
+
+        A PyNUTError is raised if it can not all be sent within timeout
+        seconds (by default, the timeout the transport was opened with),
+        or if the connection is closed.
         """
-        logging.debug("Connecting to host")
+        self._send(data, timeout)
+        self.bytes_sent += len(data)
+
+    def start_tls(self, context, server_hostname=None, session=None,
+                  timeout=None):
+        """Switch the connection to TLS (once the server accepted a
+        STARTTLS request), trying to resume session if given. The
+        handshake must be done within timeout seconds (see write).
+        """
+        raise PyNUTError("TLS is not supported by this transport.")
+
+    def read_until(self, terminator, timeout=None):
+        """Read up to and including terminator, and return it as bytes.
+
+        A PyNUTError is raised if the terminator is not received within
+        timeout seconds, or if the connection is closed.
+        """
+        buf = self._buffer
+        # Number of bytes already known not to contain the terminator,
+        # counted from self._start since _fill may move the data.
+        scanned = 0
+        while True:
+            index = buf.find(terminator, self._start + scanned, self._end)
+            if index >= 0:
+                end = index + len(terminator)
+                with memoryview(buf) as view:
+                    data = bytes(view[self._start:end])
+                self.bytes_received += end - self._start
+                self._start = end
+                if self._start == self._end:
+                    self._start = self._end = 0
+                return data
+            scanned = max(0, self._end - self._start - len(terminator) + 1)
+            self._fill(timeout)
+            buf = self._buffer
+
+    def _fill(self, timeout):
+        """Receive more data at the end of the buffer."""
+        if self._end == len(self._buffer):
+            if self._start:
+                # Move the unread data to the front of the buffer.
+                size = self._end - self._start
+                self._buffer[:size] = self._buffer[self._start:self._end]
+                self._start, self._end = 0, size
+            else:
+                self._buffer.extend(bytes(len(self._buffer)))
+        with memoryview(self._buffer) as view:
+            received = self._recv_into(view[self._end:], timeout)
+        if not received:
+            raise PyNUTConnectionError("Connection closed by server.")
+        self._end += received
+
+    def _send(self, data, timeout):
+        raise NotImplementedError
 
+    def _recv_into(self, view, timeout):
+        raise NotImplementedError
+
+    def close(self):
+        """Close the connection."""
+
+
+class _SocketTransport(Transport):
+    """Transport over a connected stream socket."""
+
+    def __init__(self, sock, timeout=None):
+        Transport.__init__(self)
+        self._sock = sock
+        self._timeout = self._sock_timeout = timeout
+        sock.settimeout(timeout)
+
+    def _settimeout(self, timeout):
+        if timeout != self._sock_timeout:
+            self._sock.settimeout(timeout)
+            self._sock_timeout = timeout
+
+    def _send(self, data, timeout):
+        self._settimeout(self._timeout if timeout is None else timeout)
         try:
-            self._srv_handler = telnetlib.Telnet(self._host, self._port,
-                                                 timeout=self._timeout)
-
-            if self._login is not None:
-                self._srv_handler.write(b"USERNAME %s\n" % self._login.encode('utf-8'))
-                result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-                if not result == "OK\n":
-                    raise PyNUTError(result.replace("\n", ""))
-
-            if self._password is not None:
-                self._srv_handler.write(b"PASSWORD %s\n" % self._password.encode('utf-8'))
-                result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-                if not result == "OK\n":
-                    raise PyNUTError(result.replace("\n", ""))
-        except telnetlib.socket.error:
-            raise PyNUTError("Socket error.")
+            self._sock.sendall(data)
+        except socket.timeout:
+            raise PyNUTTimeoutError("Timed out sending to the server.")
+        except socket.error:
+            raise PyNUTConnectionError("Socket error.")
 
-    def description(self, ups):
-        """Returns the description for a given UPS."""
-        logging.debug("description called...")
+    def _recv_into(self, view, timeout):
+        self._settimeout(timeout)
+        try:
+            return self._sock.recv_into(view)
+        except socket.timeout:
+            raise PyNUTTimeoutError("Timed out waiting for the server.")
+        except socket.error:
+            raise PyNUTConnectionError("Socket error.")
 
-        self._srv_handler.write(b"GET UPSDESC %s\n" % ups.encode('utf-8'))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
+    def start_tls(self, context, server_hostname=None, session=None,
+                  timeout=None):
+        if self._start != self._end:
+            raise PyNUTError("Unexpected data before the TLS handshake.")
+        self._settimeout(self._timeout if timeout is None else timeout)
         try:
-            return result.split('"')[1].strip()
-        except IndexError:
-            raise PyNUTError(result.replace("\n", ""))
+            self._sock = context.wrap_socket(
+                self._sock, server_hostname=server_hostname, session=session)
+        except socket.timeout:
+            raise PyNUTTimeoutError("Timed out during the TLS handshake.")
+        except socket.error as err:
+            # ssl.SSLError is a socket.error too.
+            raise PyNUTConnectionError("TLS handshake failed: %s" % err)
+        except ValueError as err:
+            # No server_hostname for a context that checks it.
+            raise PyNUTError("Cannot start TLS: %s" % err)
 
-    def list_ups(self):
-        """Returns the list of available UPS from the NUT server.
+    @property
+    def tls_session(self):
+        return getattr(self._sock, 'session', None)
 
-        The result is a dictionary containing 'key->val' pairs of
-        'UPSName' and 'UPS Description'.
-        """
-        logging.debug("list_ups from server")
+    @property
+    def tls_session_reused(self):
+        return getattr(self._sock, 'session_reused', False)
 
-        self._srv_handler.write(b"LIST UPS\n")
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "BEGIN LIST UPS\n":
-            raise PyNUTError(result.replace("\n", ""))
+    def close(self):
+        self._sock.close()
 
-        result = self._srv_handler.read_until(b"END LIST UPS\n",
-                                              self._timeout).decode('utf-8')
 
-        ups_dict = {}
-        for line in result.split("\n"):
-            if line.startswith("UPS"):
-                ups, desc = line[len("UPS "):-len('"')].split('"')[:2]
-                ups_dict[ups.strip()] = desc.strip()
+class TCPTransport(_SocketTransport):
+    """Transport over a TCP connection (the default)."""
 
-        return ups_dict
+    def __init__(self, host, port=3493, timeout=None):
+        _SocketTransport.__init__(
+            self, socket.create_connection((host, port), timeout), timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-    def list_vars(self, ups):
-        """Get all available vars from the specified UPS.
 
-        The result is a dictionary containing 'key->val' pairs of all
-        available vars.
-        """
-        logging.debug("list_vars called...")
+class UnixTransport(_SocketTransport):
+    """Transport over a Unix domain socket; host is the socket path.
 
-        self._srv_handler.write(b"LIST VAR %s\n" % ups.encode('utf-8'))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "BEGIN LIST VAR %s\n" % ups:
-            raise PyNUTError(result.replace("\n", ""))
+    With TLS, the server certificate is checked against server_hostname
+    rather than the path, so a context that checks host names needs
+    one::
 
-        result = self._srv_handler.read_until(b"END LIST VAR %s\n" % ups.encode('utf-8'),
-                                              self._timeout).decode('utf-8')
-        offset = len("VAR %s " % ups)
-        end_offset = 0 - (len("END LIST VAR %s\n" % ups) + 1)
+        transport = functools.partial(UnixTransport, server_hostname="nas")
+        client = PyNUTClient("/run/nut/upsd.sock", transport=transport,
+                             ssl_context=ssl.create_default_context())
+    """
 
-        ups_vars = {}
-        for current in result[:end_offset].split("\n"):
-            var, data = current[offset:].split('"')[:2]
-            ups_vars[var.strip()] = data
+    def __init__(self, host, port=None, timeout=None, server_hostname=None):
+        self.server_hostname = server_hostname
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(timeout)
+            sock.connect(host)
+        except socket.error:
+            sock.close()
+            raise
+        _SocketTransport.__init__(self, sock, timeout)
 
-        return ups_vars
+    def start_tls(self, context, server_hostname=None, session=None,
+                  timeout=None):
+        # The client passes its host, which is the socket path here.
+        _SocketTransport.start_tls(self, context, self.server_hostname,
+                                   session, timeout)
 
-    def list_commands(self, ups):
-        """Get all available commands for the specified UPS.
 
-        The result is a dict object with command name as key and a description
-        of the command as value.
-        """
-        logging.debug("list_commands called...")
+class LoopbackTransport(Transport):
+    """In-memory transport, mostly useful for tests.
 
-        self._srv_handler.write(b"LIST CMD %s\n" % ups.encode('utf-8'))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "BEGIN LIST CMD %s\n" % ups:
-            raise PyNUTError(result.replace("\n", ""))
+    handler is called with each request line sent by the client (as
+    bytes, including the newline) and returns the reply bytes.
+    """
 
-        result = self._srv_handler.read_until(b"END LIST CMD %s\n" % ups.encode('utf-8'),
-                                              self._timeout).decode('utf-8')
-        offset = len("CMD %s " % ups)
-        end_offset = 0 - (len("END LIST CMD %s\n" % ups) + 1)
+    def __init__(self, handler):
+        Transport.__init__(self)
+        self._handler = handler
+        self._pending = bytearray()
 
-        commands = {}
-        for current in result[:end_offset].split("\n"):
-            command = current[offset:].split('"')[0].strip()
+    def _send(self, data, timeout):
+        for line in data.splitlines(True):
+            self._pending += self._handler(line)
 
-            # For each var we try to get the available description
-            try:
-                self._srv_handler.write(b"GET CMDDESC %s %s\n" % (ups.encode('utf-8'), command.encode('utf-8')))
-                temp = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-                if temp.startswith("CMDDESC"):
-                    desc_offset = len("CMDDESC %s %s " % (ups, command))
-                    commands[command] = temp[desc_offset:-1].split('"')[1]
-                else:
-                    commands[command] = command
-            except IndexError:
-                commands[command] = command
+    def _recv_into(self, view, timeout):
+        if not self._pending:
+            raise PyNUTTimeoutError("Timed out waiting for the server.")
+        size = min(len(view), len(self._pending))
+        view[:size] = self._pending[:size]
+        del self._pending[:size]
+        return size
 
-        return commands
 
-    def list_clients(self, ups=None):
-        """Returns the list of connected clients from the NUT server.
+# A single protocol exchange: the request line to send, and for LIST
+# commands the expected BEGIN line and END terminator of the reply.
+# ``parse`` turns the decoded reply into the value returned to the
+# caller. Both clients build their requests from these so that the
+# wire format and error semantics are defined in one place.
+_Query = collections.namedtuple('_Query', 'line begin end parse')
 
-        The result is a dictionary containing 'key->val' pairs of
-        'UPSName' and a list of clients.
-        """
-        logging.debug("list_clients from '%s'...", ups or "server")
 
-        if ups and (ups not in self.list_ups()):
-            raise PyNUTError("%s is not a valid UPS" % ups)
+def _single(line, parse):
+    """Build a query whose reply is a single line."""
+    return _Query(line, None, None, parse)
 
-        if ups:
-            self._srv_handler.write(b"LIST CLIENTS %s\n" % ups.encode('utf-8'))
-        else:
-            self._srv_handler.write(b"LIST CLIENTS\n")
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "BEGIN LIST CLIENTS\n":
+
+def _listing(line, what, parse):
+    """Build a query whose reply is a BEGIN/END LIST block."""
+    return _Query(line, "BEGIN LIST %s\n" % what,
+                  b"END LIST %s\n" % what.encode('utf-8'), parse)
+
+
+# Reply lines are tokenized with compiled patterns, built from these
+# pieces: an unquoted word (captured or skipped), and a quoted value in
+# which quotes and backslashes are escaped with a backslash. Each reply
+# is scanned in a single pass, whether it is one line or a whole list.
+_WORD = r'([^ "\n]+)'
+_SKIP = r'[^ "\n]+'
+_VALUE = r'"([^"\\\n]*(?:\\.[^"\\\n]*)*)"'
+_ESCAPE = re.compile(r'\\(.)')
+# Characters that a request argument can only contain within quotes.
+_NEEDS_QUOTES = re.compile(r'[\s"\\]')
+
+
+def _tokenizer(*tokens):
+    """Compile a pattern matching lines made of the given tokens."""
+    return re.compile("^" + " ".join(tokens), re.M)
+
+
+_QUOTED = re.compile(_VALUE)
+_UPS_LINE = _tokenizer("UPS", _WORD, _VALUE)
+_VAR_LINE = _tokenizer("VAR", _SKIP, _WORD, _VALUE)
+_RW_LINE = _tokenizer("RW", _SKIP, _WORD, _VALUE)
+_CMD_LINE = _tokenizer("CMD", _SKIP, _WORD)
+_CLIENT_LINE = _tokenizer("CLIENT", _WORD, _WORD)
+_CMDDESC_LINE = _tokenizer("CMDDESC", _SKIP, _SKIP, _VALUE)
+_TYPE_LINE = _tokenizer("TYPE", _SKIP, _SKIP, r"([^\n]*[^\s])")
+_NUMLOGINS_LINE = _tokenizer("NUMLOGINS", _SKIP, r"(\d+)\s*$")
+_VALUES_LINES = {"ENUM": _tokenizer("ENUM", _SKIP, _SKIP, _VALUE),
+                 "RANGE": _tokenizer("RANGE", _SKIP, _SKIP, _VALUE)}
+
+
+def _unescape(value):
+    """Decode the backslash escapes of a quoted value."""
+    if "\\" not in value:
+        return value
+    return _ESCAPE.sub(r"\1", value)
+
+
+def _escape(value):
+    """Quote a value, escaping its quotes and backslashes."""
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _pairs(pattern, result):
+    """Return the (name, value) pairs of the lines of result matching
+    pattern, a tokenizer capturing a word and a quoted value.
+    """
+    pairs = pattern.findall(result)
+    if "\\" in result:
+        pairs = [(name, _unescape(value)) for name, value in pairs]
+    return pairs
+
+
+def _entry(pattern, line):
+    """Return the tokens of a single line, or raise PyNUTError."""
+    match = pattern.match(line)
+    if match is None:
+        raise PyNUTError(line)
+    return match.groups()
+
+
+def _quoted(result):
+    """Return the first quoted string of a reply line."""
+    match = _QUOTED.search(result)
+    if match is None:
+        raise PyNUTError(result.replace("\n", ""))
+    return _unescape(match.group(1)).strip()
+
+
+def _expect(expected):
+    """Return a parser checking that the reply is exactly ``expected``."""
+    def parse(result):
+        if result != expected:
             raise PyNUTError(result.replace("\n", ""))
+    return parse
 
-        result = self._srv_handler.read_until(b"END LIST CLIENTS\n",
-                                              self._timeout).decode('utf-8')
 
-        clients = {}
-        for line in result.split("\n"):
-            if line.startswith("CLIENT"):
-                host, ups = line[len("CLIENT "):].split(' ')[:2]
-                if ups not in clients:
-                    clients[ups] = []
-                clients[ups].append(host)
+def _raw(result):
+    return result
+
+
+def _description_query(ups):
+    return _single(b"GET UPSDESC %s\n" % ups.encode('utf-8'), _quoted)
+
+
+def _ups_entry(line):
+    """Parse a 'UPS <upsname> "<description>"' line."""
+    ups, desc = _entry(_UPS_LINE, line)
+    return ups, _unescape(desc).strip()
+
+
+def _var_entry(line, pattern=_VAR_LINE):
+    """Parse a 'VAR <upsname> <varname> "<value>"' line (or a RW line,
+    with pattern _RW_LINE).
+    """
+    var, data = _entry(pattern, line)
+    return var, _unescape(data)
+
+
+def _client_entry(line):
+    """Parse a 'CLIENT <client ip> <upsname>' line into (ups, ip)."""
+    host, ups = _entry(_CLIENT_LINE, line)
+    return ups, host
+
+
+def _list_ups_query():
+    def parse(result):
+        return dict((ups, desc.strip())
+                    for ups, desc in _pairs(_UPS_LINE, result))
+    return _listing(b"LIST UPS\n", "UPS", parse)
+
+
+def _list_vars_query(ups):
+    def parse(result):
+        return dict(_pairs(_VAR_LINE, result))
+    return _listing(b"LIST VAR %s\n" % ups.encode('utf-8'), "VAR %s" % ups,
+                    parse)
 
+
+def _list_cmd_query(ups):
+    def parse(result):
+        return _CMD_LINE.findall(result)
+    return _listing(b"LIST CMD %s\n" % ups.encode('utf-8'), "CMD %s" % ups,
+                    parse)
+
+
+def _cmddesc_fallback_query(ups, command):
+    """Like _command_description_query, but falls back to the command
+    name instead of raising when no description is available.
+    """
+    def parse(result):
+        match = _CMDDESC_LINE.match(result)
+        if match is None:
+            return command
+        return _unescape(match.group(1)).strip()
+    return _single(b"GET CMDDESC %s %s\n" % (ups.encode('utf-8'),
+                                             command.encode('utf-8')), parse)
+
+
+def _list_clients_query(ups=None):
+    def parse(result):
+        clients = {}
+        for host, ups in _CLIENT_LINE.findall(result):
+            if ups not in clients:
+                clients[ups] = []
+            clients[ups].append(host)
         return clients
+    if ups:
+        line = b"LIST CLIENTS %s\n" % ups.encode('utf-8')
+    else:
+        line = b"LIST CLIENTS\n"
+    return _listing(line, "CLIENTS", parse)
 
-    def list_rw_vars(self, ups):
-        """Get a list of all writable vars from the selected UPS.
 
-        The result is presented as a dictionary containing 'key->val'
-        pairs.
-        """
-        logging.debug("list_vars from '%s'...", ups)
+def _list_rw_vars_query(ups):
+    def parse(result):
+        return dict(_pairs(_RW_LINE, result))
+    return _listing(b"LIST RW %s\n" % ups.encode('utf-8'), "RW %s" % ups,
+                    parse)
 
-        self._srv_handler.write(b"LIST RW %s\n" % ups.encode('utf-8'))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "BEGIN LIST RW %s\n" % ups:
-            raise PyNUTError(result.replace("\n", ""))
 
-        result = self._srv_handler.read_until(b"END LIST RW %s\n" % ups.encode('utf-8'),
-                                              self._timeout).decode('utf-8')
-        offset = len("VAR %s" % ups)
-        end_offset = 0 - (len("END LIST RW %s\n" % ups) + 1)
+def _list_values_query(kind, ups, var):
+    """Build a LIST ENUM or LIST RANGE query."""
+    pattern = _VALUES_LINES[kind]
 
-        rw_vars = {}
-        for current in result[:end_offset].split("\n"):
-            var, data = current[offset:].split('"')[:2]
-            rw_vars[var.strip()] = data
+    def parse(result):
+        values = pattern.findall(result)
+        if "\\" in result:
+            values = [_unescape(value) for value in values]
+        return [value.strip() for value in values]
+    return _listing(b"LIST %s %s %s\n" % (kind.encode('utf-8'),
+                                          ups.encode('utf-8'),
+                                          var.encode('utf-8')),
+                    "%s %s %s" % (kind, ups, var), parse)
 
-        return rw_vars
 
-    def list_enum(self, ups, var):
-        """Get a list of valid values for an enum variable.
+def _set_var_query(ups, var, value):
+    if not value or _NEEDS_QUOTES.search(value):
+        value = _escape(value)
+    return _single(b"SET VAR %s %s %s\n" % (ups.encode('utf-8'),
+                                            var.encode('utf-8'),
+                                            value.encode('utf-8')),
+                   _expect("OK\n"))
 
-        The result is presented as a list.
-        """
-        logging.debug("list_enum from '%s'...", ups)
 
-        self._srv_handler.write(b"LIST ENUM %s %s\n" % (ups.encode('utf-8'), var.encode('utf-8')))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "BEGIN LIST ENUM %s %s\n" % (ups, var):
-            raise PyNUTError(result.replace("\n", ""))
+def _get_var_query(ups, var):
+    # result = 'VAR %s %s "%s"\n' % (ups, var, value)
+    return _single(b"GET VAR %s %s\n" % (ups.encode('utf-8'),
+                                         var.encode('utf-8')), _quoted)
 
-        result = self._srv_handler.read_until(b"END LIST ENUM %s %s\n" % (ups.encode('utf-8'), var.encode('utf-8')),
-                                              self._timeout).decode('utf-8')
-        offset = len("ENUM %s %s" % (ups, var))
-        end_offset = 0 - (len("END LIST ENUM %s %s\n" % (ups, var)) + 1)
 
-        try:
-            return [ c[offset:].split('"')[1].strip() 
-                     for c in result[:end_offset].split("\n") ]
-        except IndexError:
-            raise PyNUTError(result.replace("\n", ""))
+def _var_description_query(ups, var):
+    # result = 'DESC %s %s "%s"\n' % (ups, var, description)
+    return _single(b"GET DESC %s %s\n" % (ups.encode('utf-8'),
+                                          var.encode('utf-8')), _quoted)
 
-    def list_range(self, ups, var):
-        """Get a list of valid values for an range variable.
 
-        The result is presented as a list.
+def _var_type_query(ups, var):
+    def parse(result):
+        # result = 'TYPE %s %s %s\n' % (ups, var, type)
+        return _entry(_TYPE_LINE, result.rstrip("\n"))[0]
+    return _single(b"GET TYPE %s %s\n" % (ups.encode('utf-8'),
+                                          var.encode('utf-8')), parse)
+
+
+def _command_description_query(ups, command):
+    # result = 'CMDDESC %s %s "%s"' % (ups, command, description)
+    return _single(b"GET CMDDESC %s %s\n" % (ups.encode('utf-8'),
+                                             command.encode('utf-8')),
+                   _quoted)
+
+
+def _run_command_query(ups, command):
+    return _single(b"INSTCMD %s %s\n" % (ups.encode('utf-8'),
+                                         command.encode('utf-8')),
+                   _expect("OK\n"))
+
+
+def _master_query(ups):
+    def parse(result):
+        if result != "OK MASTER-GRANTED\n":
+            raise PyNUTError(("Master level function are not available", ""))
+    return _single(b"MASTER %s\n" % ups.encode('utf-8'), parse)
+
+
+def _fsd_query(ups):
+    return _single(b"FSD %s\n" % ups.encode('utf-8'), _expect("OK FSD-SET\n"))
+
+
+def _num_logins_query(ups):
+    def parse(result):
+        # result = "NUMLOGINS %s %s\n" % (ups, int(numlogins))
+        return int(_entry(_NUMLOGINS_LINE, result.rstrip("\n"))[0])
+    return _single(b"GET NUMLOGINS %s\n" % ups.encode('utf-8'), parse)
+
+
+def _login_queries(login, password):
+    """Return the USERNAME/PASSWORD queries needed to authenticate."""
+    queries = []
+    if login is not None:
+        queries.append(_single(b"USERNAME %s\n" % login.encode('utf-8'),
+                               _expect("OK\n")))
+    if password is not None:
+        queries.append(_single(b"PASSWORD %s\n" % password.encode('utf-8'),
+                               _expect("OK\n")))
+    return queries
+
+
+class Pipeline(object):
+    """Queue up requests and send them to the server in one round trip.
+
+    upsd answers the requests received on a connection strictly in
+    order, so all queued requests are written at once and the replies
+    are read back in sequence. Use it through PyNUTClient.pipeline()::
+
+        with client.pipeline() as pipe:
+            pipe.get_var("My_UPS", "battery.charge")
+            pipe.var_type("My_UPS", "battery.charge")
+        charge, type_ = pipe.results
+
+    Each queueing method returns the pipeline, so calls can also be
+    chained. Leaving the ``with`` block executes the pending requests.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._queries = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, trace):
+        if exc_t is None and self._queries:
+            self.execute()
+
+    def __len__(self):
+        return len(self._queries)
+
+    def _queue(self, query):
+        self._queries.append(query)
+        return self
+
+    def execute(self, raise_on_error=True):
+        """Send all queued requests and return the list of their results.
+
+        The results are also kept in the ``results`` attribute. A request
+        that failed has its PyNUTError in place of a result; unless
+        raise_on_error is False, the first such error is raised once
+        all the replies have been read.
         """
-        logging.debug("list_range from '%s'...", ups)
+        queries, self._queries = self._queries, []
+        client = self._client
+        if client._budget is None and client._deadline is not None:
+            with client.deadline(client._deadline, "pipeline"):
+                self.results = client._execute_many(queries)
+        else:
+            self.results = client._execute_many(queries)
+        return self._check(raise_on_error)
 
-        self._srv_handler.write(b"LIST RANGE %s %s\n" % (ups.encode('utf-8'), var.encode('utf-8')))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "BEGIN LIST RANGE %s %s\n" % (ups, var):
-            raise PyNUTError(result.replace("\n", ""))
+    def _check(self, raise_on_error):
+        if raise_on_error:
+            for result in self.results:
+                if isinstance(result, PyNUTError):
+                    raise result
+        return self.results
 
-        result = self._srv_handler.read_until(b"END LIST RANGE %s %s\n" % (ups.encode('utf-8'), var.encode('utf-8')),
-                                              self._timeout).decode('utf-8')
-        offset = len("RANGE %s %s" % (ups, var))
-        end_offset = 0 - (len("END LIST RANGE %s %s\n" % (ups, var)) + 1)
+    def description(self, ups):
+        """Queue a request for the description of a given UPS."""
+        return self._queue(_description_query(ups))
 
-        try:
-            return [ c[offset:].split('"')[1].strip() 
-                     for c in result[:end_offset].split("\n") ]
-        except IndexError:
-            raise PyNUTError(result.replace("\n", ""))
+    def list_ups(self):
+        """Queue a request for the list of available UPS."""
+        return self._queue(_list_ups_query())
 
-    def set_var(self, ups, var, value):
-        """Set a variable to the specified value on selected UPS.
+    def list_vars(self, ups):
+        """Queue a request for all available vars of the specified UPS."""
+        return self._queue(_list_vars_query(ups))
 
-        The variable must be a writable value (cf list_rw_vars) and you
-        must have the proper rights to set it (maybe login/password).
+    def list_clients(self, ups=None):
+        """Queue a request for the list of connected clients.
+
+        Unlike PyNUTClient.list_clients, the UPS name is not checked
+        against the list of available UPS beforehand.
         """
-        logging.debug("set_var '%s' from '%s' to '%s'", var, ups, value)
+        return self._queue(_list_clients_query(ups))
 
-        self._srv_handler.write(b"SET VAR %s %s %s\n" % (ups.encode('utf-8'), var.encode('utf-8'), value.encode('utf-8')))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "OK\n":
-            raise PyNUTError(result.replace("\n", ""))
+    def list_rw_vars(self, ups):
+        """Queue a request for all writable vars of the selected UPS."""
+        return self._queue(_list_rw_vars_query(ups))
 
-    def get_var(self, ups, var):
-        """Get the value of a variable."""
-        logging.debug("get_var called...")
+    def list_enum(self, ups, var):
+        """Queue a request for the valid values of an enum variable."""
+        return self._queue(_list_values_query("ENUM", ups, var))
 
-        self._srv_handler.write(b"GET VAR %s %s\n" % (ups.encode('utf-8'), var.encode('utf-8')))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        try:
-            # result = 'VAR %s %s "%s"\n' % (ups, var, value)
-            return result.split('"')[1].strip()
-        except IndexError:
-            raise PyNUTError(result.replace("\n", ""))
+    def list_range(self, ups, var):
+        """Queue a request for the valid values of a range variable."""
+        return self._queue(_list_values_query("RANGE", ups, var))
+
+    def set_var(self, ups, var, value):
+        """Queue a request setting a variable on the selected UPS."""
+        return self._queue(_set_var_query(ups, var, value))
+
+    def get_var(self, ups, var):
+        """Queue a request for the value of a variable."""
+        return self._queue(_get_var_query(ups, var))
 
     # Alias for convenience
     def get(self, ups, var):
-        """Get the value of a variable (alias for get_var)."""
+        """Queue a request for the value of a variable (alias for get_var)."""
         return self.get_var(ups, var)
 
     def var_description(self, ups, var):
-        """Get a variable's description."""
-        logging.debug("var_description called...")
-
-        self._srv_handler.write(b"GET DESC %s %s\n" % (ups.encode('utf-8'), var.encode('utf-8')))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        try:
-            # result = 'DESC %s %s "%s"\n' % (ups, var, description)
-            return result.split('"')[1].strip()
-        except IndexError:
-            raise PyNUTError(result.replace("\n", ""))
+        """Queue a request for a variable's description."""
+        return self._queue(_var_description_query(ups, var))
 
     def var_type(self, ups, var):
-        """Get a variable's type."""
-        logging.debug("var_type called...")
-
-        self._srv_handler.write(b"GET TYPE %s %s\n" % (ups.encode('utf-8'), var.encode('utf-8')))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        try:
-            # result = 'TYPE %s %s %s\n' % (ups, var, type)
-            type_ = ' '.join(result.split(' ')[3:]).strip()
-            # Ensure the response was valid.
-            assert(len(type_) > 0)
-            assert(result.startswith("TYPE"))
-            return type_
-        except AssertionError:
-            raise PyNUTError(result.replace("\n", ""))
+        """Queue a request for a variable's type."""
+        return self._queue(_var_type_query(ups, var))
 
     def command_description(self, ups, command):
-        """Get a command's description."""
-        logging.debug("command_description called...")
-
-        self._srv_handler.write(b"GET CMDDESC %s %s\n" % (ups.encode('utf-8'), command.encode('utf-8')))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        try:
-            # result = 'CMDDESC %s %s "%s"' % (ups, command, description)
-            return result.split('"')[1].strip()
-        except IndexError:
-            raise PyNUTError(result.replace("\n", ""))
+        """Queue a request for a command's description."""
+        return self._queue(_command_description_query(ups, command))
 
     def run_command(self, ups, command):
-        """Send a command to the specified UPS."""
-        logging.debug("run_command called...")
+        """Queue a command to send to the specified UPS."""
+        return self._queue(_run_command_query(ups, command))
 
-        self._srv_handler.write(b"INSTCMD %s %s\n" % (ups.encode('utf-8'), command.encode('utf-8')))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "OK\n":
-            raise PyNUTError(result.replace("\n", ""))
+    def num_logins(self, ups):
+        """Queue a request for the number of users logged into a UPS."""
+        return self._queue(_num_logins_query(ups))
 
-    def fsd(self, ups):
-        """Send MASTER and FSD commands."""
-        logging.debug("MASTER called...")
+    def help(self):
+        """Queue a HELP command."""
+        return self._queue(_single(b"HELP\n", _raw))
 
-        self._srv_handler.write(b"MASTER %s\n" % ups.encode('utf-8'))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "OK MASTER-GRANTED\n":
-            raise PyNUTError(("Master level function are not available", ""))
+    def ver(self):
+        """Queue a VER command."""
+        return self._queue(_single(b"VER\n", _raw))
 
-        logging.debug("FSD called...")
-        self._srv_handler.write(b"FSD %s\n" % ups.encode('utf-8'))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        if result != "OK FSD-SET\n":
-            raise PyNUTError(result.replace("\n", ""))
 
-    def num_logins(self, ups):
-        """Send GET NUMLOGINS command to get the number of users logged
-        into a given UPS.
+class AsyncPipeline(Pipeline):
+    """Pipeline for AsyncPyNUTClient.
+
+    Works like Pipeline, except that ``execute`` is a coroutine and the
+    pipeline is used as an async context manager.
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_t, exc_v, trace):
+        if exc_t is None and self._queries:
+            await self.execute()
+
+    def __enter__(self):
+        raise TypeError("use 'async with' with an AsyncPipeline")
+
+    async def execute(self, raise_on_error=True):
+        """Send all queued requests and return the list of their results."""
+        queries, self._queries = self._queries, []
+        self.results = await self._client._execute_many(queries)
+        return self._check(raise_on_error)
+
+
+_MISSING = object()
+
+# A variable change reported by PyNUTClient.watch. ``old`` is None for
+# a variable that just appeared, and ``new`` is None for one that is
+# gone; ``time`` is the time.time() of the poll that saw the change.
+VarChange = collections.namedtuple('VarChange', 'time ups var old new')
+
+
+def _diff_vars(ups, old_vars, new_vars, now):
+    """Return the list of VarChange between two {var: value} dicts."""
+    changes = []
+    for var, value in new_vars.items():
+        old = old_vars.get(var)
+        if old != value:
+            changes.append(VarChange(now, ups, var, old, value))
+    for var, old in old_vars.items():
+        if var not in new_vars:
+            changes.append(VarChange(now, ups, var, old, None))
+    return changes
+
+
+# Upper bounds, in seconds, of the LatencyHistogram buckets: 10us to
+# about 20s, doubling each time.
+_LATENCY_BOUNDS = tuple(1e-5 * 2 ** i for i in range(22))
+
+
+class LatencyHistogram(object):
+    """Histogram of durations, in seconds, with exponential buckets.
+
+    counts[i] is the number of durations up to bounds[i] (and above
+    bounds[i - 1]); the last count is for the longer ones.
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=_LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = array.array('L', [0] * (len(bounds) + 1))
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, duration):
+        self.counts[bisect.bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.sum += duration
+
+    def percentile(self, fraction):
+        """Return the upper bound of the bucket holding the given fraction
+        of the durations (inf if above all bounds, None if empty).
         """
-        logging.debug("num_logins called on '%s'...", ups)
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
 
-        self._srv_handler.write(b"GET NUMLOGINS %s\n" % ups.encode('utf-8'))
-        result = self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
-        try:
-            # result = "NUMLOGINS %s %s\n" % (ups, int(numlogins))
-            return int(result.split(' ')[2].strip())
-        except (ValueError, IndexError):
-            raise PyNUTError(result.replace("\n", ""))
 
-    def help(self):
-        """Send HELP command."""
-        logging.debug("HELP called...")
+class CommandStats(object):
+    """Counters and latency histograms of one protocol command.
 
-        self._srv_handler.write(b"HELP\n")
-        return self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
+    wire is the time between sending the request and receiving the whole
+    reply, parse the time spent decoding the reply afterwards.
+    """
 
+    __slots__ = ('count', 'errors', 'bytes_sent', 'bytes_received', 'wire',
+                 'parse')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.wire = LatencyHistogram()
+        self.parse = LatencyHistogram()
+
+
+# One request recorded by ClientStats. ``command`` is the protocol
+# command (like "GET VAR" or "INSTCMD"), ``error`` the PyNUTError it
+# failed with, if any; times are in seconds.
+RequestEvent = collections.namedtuple(
+    'RequestEvent', 'host port command bytes_sent bytes_received wire_time '
+    'parse_time error')
+
+
+def _command_name(line):
+    """Return the protocol command of a request line, like "LIST VAR"."""
+    words = line.split(b" ", 2)
+    if len(words) > 1 and words[0] in (b"GET", b"LIST", b"SET"):
+        return (words[0] + b" " + words[1]).rstrip(b"\n").decode('ascii')
+    return words[0].rstrip(b"\n").decode('ascii')
+
+
+class ClientStats(object):
+    """Statistics of the requests made by one or more PyNUTClient.
+
+    A client given a ClientStats (with its stats argument) records every
+    request in it: commands maps each protocol command to its
+    CommandStats. Each recorded RequestEvent is also passed to the
+    observers, callables which can export it elsewhere::
+
+        stats = ClientStats()
+        stats.add_observer(lambda event: print(event.command,
+                                               event.wire_time))
+        client = PyNUTClient(stats=stats)
+
+    Clients without stats do not measure anything.
+    """
+
+    def __init__(self, observers=()):
+        self.commands = {}
+        self.observers = list(observers)
+        self._lock = threading.Lock()
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def record(self, event):
+        """Account for a RequestEvent, and pass it to the observers."""
+        with self._lock:
+            stats = self.commands.get(event.command)
+            if stats is None:
+                stats = self.commands[event.command] = CommandStats()
+            stats.count += 1
+            if event.error is not None:
+                stats.errors += 1
+            stats.bytes_sent += event.bytes_sent
+            stats.bytes_received += event.bytes_received
+            stats.wire.observe(event.wire_time)
+            stats.parse.observe(event.parse_time)
+        for observer in self.observers:
+            observer(event)
+
+    def reset(self):
+        """Forget all the recorded requests."""
+        with self._lock:
+            self.commands = {}
+
+
+class MetadataCache(object):
+    """Cache for UPS metadata that practically never changes.
+
+    PyNUTClient uses it (when given one) for var_type, var_description,
+    command_description, list_enum and list_range. Entries expire ttl
+    seconds after they were stored, and once maxsize entries are held,
+    the least recently used one is evicted. A cache can be shared by
+    several clients, entries are keyed by server as well as by UPS.
+
+    The hits and misses attributes count lookups since creation (or
+    the last clear()).
+    """
+
+    def __init__(self, maxsize=4096, ttl=3600):
+        """maxsize : Maximum number of entries (defaults to 4096).
+        ttl     : Seconds after which an entry expires (defaults to an
+                  hour), or None to keep entries until evicted.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value cached for key, or default."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Store value for key."""
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, host=None, port=None, ups=None):
+        """Drop the entries matching all the given server and UPS names
+        (all entries if none is given).
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if ((host is None or key[0] == host) and
+                        (port is None or key[1] == port) and
+                        (ups is None or key[2] == ups)):
+                    del self._entries[key]
+
+    def clear(self):
+        """Drop all entries and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Return a dictionary of cache statistics."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class DiscoveryCache(object):
+    """Inventory of the UPS of NUT servers, kept in a file between runs.
+
+    For each UPS, it records the description, the variables and their
+    types, the writable variables, the values allowed by ENUM and RANGE
+    variables, and the commands with their descriptions::
+
+        discovery = DiscoveryCache("/var/cache/collector/nut.json")
+        for client in clients:
+            inventory = discovery.discover(client)
+        discovery.save()
+
+    discover() validates what was loaded with two round trips, LIST UPS
+    and a pipelined LIST VAR for all the UPS, and only rediscovers the
+    UPS that appeared or whose description or set of variables changed
+    (rediscovered maps each server, "host:port", to the list of them).
+    A UPS whose variables cannot be listed keeps its previous inventory.
+    The results also prime the MetadataCache of the client, if it has
+    one.
+    """
+
+    version = 1
+
+    def __init__(self, path=None):
+        """path : File the inventory is loaded from (if it exists) and
+               saved to.
+        """
+        self.path = path
+        self.servers = {}
+        self.rediscovered = {}
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def load(self, path=None):
+        """Read the inventory saved in path (defaults to self.path). A
+        file written by another version of this class, or that cannot be
+        parsed (a crash while writing it, say), is ignored: the inventory
+        is then rebuilt by discover() and replaces it on the next save().
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path to load the inventory from.")
+        try:
+            with open(path) as cache_file:
+                data = json.load(cache_file)
+        except ValueError as err:
+            logging.warning("Ignoring the unreadable inventory %s: %s",
+                            path, err)
+            return self
+        if (isinstance(data, dict) and data.get('version') == self.version
+                and isinstance(data.get('servers'), dict)):
+            self.servers = data['servers']
+        return self
+
+    def save(self, path=None):
+        """Write the inventory to path (defaults to self.path), replacing
+        the previous file atomically.
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError("No path to save the inventory to.")
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as cache_file:
+            json.dump({'version': self.version, 'servers': self.servers},
+                      cache_file, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def discover(self, client):
+        """Return the inventory of the server of client, {ups: {...}},
+        discovering the UPS that are not known or changed.
+        """
+        key = "%s:%s" % (client._host, client._port)
+        known = self.servers.get(key, {})
+        ups_list = client.list_ups()
+        ups_names = list(ups_list)
+        results = client._execute_many(
+            [_list_vars_query(ups) for ups in ups_names])
+
+        inventory = {}
+        rediscovered = self.rediscovered[key] = []
+        for ups, ups_vars in zip(ups_names, results):
+            entry = known.get(ups)
+            if isinstance(ups_vars, PyNUTError):
+                # Keep what is known until the UPS can be checked.
+                if entry is not None:
+                    inventory[ups] = entry
+                    self._prime(client, ups, entry)
+                continue
+            if (entry is None or entry['description'] != ups_list[ups] or
+                    entry['vars'] != sorted(ups_vars)):
+                entry = self._discover_ups(client, ups, ups_list[ups],
+                                           ups_vars)
+                rediscovered.append(ups)
+            inventory[ups] = entry
+            self._prime(client, ups, entry)
+        self.servers[key] = inventory
+        return inventory
+
+    def _discover_ups(self, client, ups, description, ups_vars):
+        variables = sorted(ups_vars)
+        replies = client._execute_many(
+            [_list_rw_vars_query(ups), _list_cmd_query(ups)] +
+            [_var_type_query(ups, var) for var in variables])
+        rw_vars, commands, types = replies[0], replies[1], replies[2:]
+        types = dict((var, type_) for var, type_ in zip(variables, types)
+                     if not isinstance(type_, PyNUTError))
+
+        queries = []
+        for var, type_ in sorted(types.items()):
+            for kind in ("ENUM", "RANGE"):
+                if kind in type_.split():
+                    queries.append((kind, var))
+        if isinstance(commands, PyNUTError):
+            commands = []
+        replies = client._execute_many(
+            [_list_values_query(kind, ups, var) for kind, var in queries] +
+            [_command_description_query(ups, command)
+             for command in commands])
+        values = {"ENUM": {}, "RANGE": {}}
+        for (kind, var), reply in zip(queries, replies):
+            if not isinstance(reply, PyNUTError):
+                values[kind][var] = reply
+        # Commands without a description map to None, as there is
+        # nothing to put in the metadata cache for them.
+        descriptions = [None if isinstance(reply, PyNUTError) else reply
+                        for reply in replies[len(queries):]]
+        return {'description': description,
+                'vars': variables,
+                'types': types,
+                'rw': sorted(rw_vars) if isinstance(rw_vars, dict) else [],
+                'enum': values["ENUM"],
+                'range': values["RANGE"],
+                'commands': dict(zip(commands, descriptions))}
+
+    def _prime(self, client, ups, entry):
+        cache = client._cache
+        if cache is None:
+            return
+        server = (client._host, client._port, ups)
+        for var, type_ in entry['types'].items():
+            cache.set(server + ("TYPE", var), type_)
+        for kind in ("ENUM", "RANGE"):
+            for var, values in entry[kind.lower()].items():
+                cache.set(server + (kind, var), values)
+        for command, description in entry['commands'].items():
+            if description is not None:
+                cache.set(server + ("CMDDESC", command), description)
+
+
+def _is_numeric_type(type_):
+    """Tell whether a var_type result describes a numeric variable."""
+    return "NUMBER" in type_.split()
+
+
+class UPSSchema(object):
+    """Key table shared by all the snapshots of UPS having the same
+    variables.
+
+    Variable names are interned and stored once per schema. Numeric
+    variables are given a position in the array of numbers of each
+    snapshot, and the others a position in its tuple of strings. Use
+    UPSSchema.get() rather than the constructor, so that UPS with the
+    same variables share the same schema. A schema is kept for as long
+    as a snapshot (or anything else) uses it.
+    """
+
+    __slots__ = ('names', 'numeric', 'layout', 'num_numbers', 'num_strings',
+                 '__weakref__')
+
+    _registry = weakref.WeakValueDictionary()
+    _registry_lock = threading.Lock()
+
+    def __init__(self, names, numeric):
+        self.names = tuple(sys.intern(name) for name in sorted(names))
+        self.numeric = frozenset(name for name in self.names
+                                 if name in numeric)
+        self.layout = {}
+        self.num_numbers = self.num_strings = 0
+        for name in self.names:
+            if name in self.numeric:
+                self.layout[name] = (True, self.num_numbers)
+                self.num_numbers += 1
+            else:
+                self.layout[name] = (False, self.num_strings)
+                self.num_strings += 1
+
+    @classmethod
+    def get(cls, names, numeric):
+        """Return the shared schema for the given variable names, of
+        which those in numeric hold numbers.
+        """
+        names = frozenset(names)
+        key = (names, frozenset(numeric) & names)
+        with cls._registry_lock:
+            schema = cls._registry.get(key)
+            if schema is None:
+                schema = cls._registry[key] = cls(*key)
+            return schema
+
+    def covers(self, names):
+        """Tell whether all the given variable names are in the schema."""
+        layout = self.layout
+        return all(name in layout for name in names)
+
+
+class UPSSnapshot(collections.abc.Mapping):
+    """Read-only, memory efficient mapping of the variables of a UPS.
+
+    Numeric variables are decoded once into a float array, and the
+    other values are kept as (interned) strings, so looking up a
+    variable returns a float or a str. Variables of the schema that
+    were missing from the poll are absent from the mapping.
+    """
+
+    __slots__ = ('schema', 'ups', 'time', '_numbers', '_strings', '_extra')
+
+    def __init__(self, schema, ups, ups_vars, time_=None):
+        """Build a snapshot of ups_vars, a {var: value} dictionary as
+        returned by list_vars, which must be covered by schema.
+        """
+        self.schema = schema
+        self.ups = ups
+        self.time = time.time() if time_ is None else time_
+        self._extra = None
+        numbers = array.array('d', [math.nan]) * schema.num_numbers
+        strings = [None] * schema.num_strings
+        layout = schema.layout
+        for name, value in ups_vars.items():
+            numeric, position = layout[name]
+            if not numeric:
+                strings[position] = sys.intern(value)
+                continue
+            try:
+                numbers[position] = float(value)
+            except ValueError:
+                # e.g. "unknown"; keep the text rather than losing it.
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[name] = sys.intern(value)
+        self._numbers = numbers
+        self._strings = tuple(strings)
+
+    def __getitem__(self, name):
+        numeric, position = self.schema.layout[name]
+        if numeric:
+            value = self._numbers[position]
+            if value == value:
+                return value
+            if self._extra is not None and name in self._extra:
+                return self._extra[name]
+        else:
+            value = self._strings[position]
+            if value is not None:
+                return value
+        raise KeyError(name)
+
+    def __iter__(self):
+        for name in self.schema.names:
+            if name in self:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __repr__(self):
+        return "<UPSSnapshot %s %r>" % (self.ups, dict(self))
+
+
+# Aggregate of the samples of a variable over a time window, as returned
+# by VarHistory.rollup. ``avg`` is the mean of the samples, not weighted
+# by time; all three are nan when ``count`` is 0.
+Rollup = collections.namedtuple('Rollup', 'min max avg count')
+
+# (resolution, buckets) of the rollups kept by default: 10 minutes by
+# 10 seconds, 2 hours by minute and 2 days by 10 minutes.
+_ROLLUP_LEVELS = ((10, 60), (60, 120), (600, 288))
+
+
+class _RollupRing(object):
+    """Ring of buckets, each holding the min, max, sum and count of the
+    samples of resolution seconds. A bucket is reset when a sample of a
+    newer period lands on it.
+    """
+
+    __slots__ = ('resolution', 'periods', 'mins', 'maxs', 'sums', 'counts')
+
+    def __init__(self, resolution, buckets):
+        self.resolution = resolution
+        self.periods = array.array('q', [-1]) * buckets
+        self.mins = array.array('d', [0.0]) * buckets
+        self.maxs = array.array('d', [0.0]) * buckets
+        self.sums = array.array('d', [0.0]) * buckets
+        self.counts = array.array('L', [0]) * buckets
+
+    @property
+    def span(self):
+        return self.resolution * len(self.periods)
+
+    def add(self, time_, value):
+        period = int(time_ // self.resolution)
+        i = period % len(self.periods)
+        if self.periods[i] != period:
+            self.periods[i] = period
+            self.mins[i] = self.maxs[i] = self.sums[i] = value
+            self.counts[i] = 1
+            return
+        if value < self.mins[i]:
+            self.mins[i] = value
+        elif value > self.maxs[i]:
+            self.maxs[i] = value
+        self.sums[i] += value
+        self.counts[i] += 1
+
+    def rollup(self, window, now):
+        last = int(now // self.resolution)
+        buckets = min(len(self.periods),
+                      int(math.ceil(window / self.resolution)))
+        low, high, total, count = math.inf, -math.inf, 0.0, 0
+        for period in range(last - buckets + 1, last + 1):
+            i = period % len(self.periods)
+            if self.periods[i] != period:
+                continue
+            low = min(low, self.mins[i])
+            high = max(high, self.maxs[i])
+            total += self.sums[i]
+            count += self.counts[i]
+        if not count:
+            return Rollup(math.nan, math.nan, math.nan, 0)
+        return Rollup(low, high, total / count, count)
+
+
+class VarHistory(object):
+    """Recent samples of one numeric variable, with their rollups.
+
+    The last capacity (time, value) samples are kept in two fixed-size
+    float arrays used as a ring, and each sample also updates the
+    rollups: rings of buckets of min, max, sum and count for each
+    (resolution, buckets) of levels. Samples must be added in time
+    order; older ones are ignored.
+    """
+
+    __slots__ = ('capacity', 'times', 'values', 'size', '_next', '_levels')
+
+    def __init__(self, capacity=3600, levels=_ROLLUP_LEVELS):
+        self.capacity = capacity
+        self.times = array.array('d', [0.0]) * capacity
+        self.values = array.array('d', [0.0]) * capacity
+        self.size = 0
+        self._next = 0
+        self._levels = [_RollupRing(resolution, buckets)
+                        for resolution, buckets in sorted(levels)]
+
+    def __len__(self):
+        return self.size
+
+    def append(self, time_, value):
+        """Add a sample; return False if it was older than the last one."""
+        i = self._next
+        if self.size and time_ < self.times[i - 1]:
+            return False
+        self.times[i] = time_
+        self.values[i] = value
+        self._next = (i + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+        for level in self._levels:
+            level.add(time_, value)
+        return True
+
+    def latest(self):
+        """Return the last (time, value) sample, or None."""
+        if not self.size:
+            return None
+        i = self._next - 1
+        return self.times[i], self.values[i]
+
+    def _position(self, since):
+        # Binary search of the first sample at or after since, counting
+        # from the oldest one.
+        times, capacity = self.times, self.capacity
+        oldest = self._next - self.size
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if times[(oldest + middle) % capacity] < since:
+                low = middle + 1
+            else:
+                high = middle
+        return oldest + low
+
+    def last(self, seconds, now=None):
+        """Return the list of (time, value) samples of the last seconds
+        (up to now, defaulting to time.time()), oldest first. Only
+        these samples are copied.
+        """
+        if now is None:
+            now = time.time()
+        times, values, capacity = self.times, self.values, self.capacity
+        samples = []
+        for position in range(self._position(now - seconds), self._next):
+            i = position % capacity
+            if times[i] > now:
+                break
+            samples.append((times[i], values[i]))
+        return samples
+
+    def rollup(self, window, now=None):
+        """Return the Rollup of the samples of the last window seconds.
+
+        It is computed from the finest level spanning the window, whose
+        buckets are summed: the window is rounded up to whole buckets,
+        and capped at the span of the coarsest level.
+        """
+        if now is None:
+            now = time.time()
+        for level in self._levels:
+            if level.span >= window:
+                break
+        return level.rollup(window, now)
+
+
+class HistoryStore(object):
+    """Recent history of the numeric variables of UPS, for trends.
+
+    Polling code feeds it the variables it reads, and it keeps a
+    VarHistory for each (ups, var) holding a number::
+
+        history = HistoryStore(vars=["battery.charge", "ups.load"])
+        for changes in client.watch("My_UPS"):
+            history.add_vars("My_UPS", client.list_vars("My_UPS"))
+            load = history.rollup("My_UPS", "ups.load", 3600)
+
+    Values which are not numbers (like ups.status) are skipped. When
+    UPS of several servers have the same name, use names like
+    "My_UPS@host" to tell them apart.
+    """
+
+    def __init__(self, capacity=3600, levels=_ROLLUP_LEVELS, vars=None):
+        """capacity : Number of samples kept for each variable.
+        levels   : (resolution, buckets) of the rollups, resolution
+                   being in seconds.
+        vars     : Optional names of the only variables to keep.
+        """
+        self.capacity = capacity
+        self.levels = tuple(levels)
+        self.vars = frozenset(vars) if vars is not None else None
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._series)
+
+    def keys(self):
+        """Return the (ups, var) having samples."""
+        return list(self._series)
+
+    def series(self, ups, var):
+        """Return the VarHistory of var, or None if it has no samples."""
+        return self._series.get((ups, var))
+
+    def add(self, ups, var, value, time_=None):
+        """Record a value of var (a number or its text as read from the
+        server) at time_ (defaulting to now).
+        """
+        self.add_vars(ups, {var: value}, time_)
+
+    def add_vars(self, ups, ups_vars, time_=None):
+        """Record the variables of ups, a mapping like the result of
+        list_vars or a UPSSnapshot, read at time_ (defaulting to now).
+        """
+        if time_ is None:
+            time_ = time.time()
+        with self._lock:
+            for var, value in ups_vars.items():
+                if self.vars is not None and var not in self.vars:
+                    continue
+                try:
+                    value = float(value)
+                except ValueError:
+                    continue
+                series = self._series.get((ups, var))
+                if series is None:
+                    series = self._series[(ups, var)] = VarHistory(
+                        self.capacity, self.levels)
+                series.append(time_, value)
+
+    def add_changes(self, changes):
+        """Record the new values of a list of VarChange, as yielded by
+        PyNUTClient.watch or PollScheduler.run.
+        """
+        for change in changes:
+            if change.new is not None:
+                self.add(change.ups, change.var, change.new, change.time)
+
+    def last(self, ups, var, seconds, now=None):
+        """Return the (time, value) samples of var of the last seconds."""
+        series = self.series(ups, var)
+        if series is None:
+            return []
+        with self._lock:
+            return series.last(seconds, now)
+
+    def rollup(self, ups, var, window, now=None):
+        """Return the Rollup of var over the last window seconds."""
+        series = self.series(ups, var)
+        if series is None:
+            return Rollup(math.nan, math.nan, math.nan, 0)
+        with self._lock:
+            return series.rollup(window, now)
+
+
+# A sample read back from a SampleLog; ``value`` is the text read from
+# the server.
+Sample = collections.namedtuple('Sample', 'time ups var value')
+
+# Header of a record of a SampleLog segment: time, id of the (ups, var)
+# and length of the value which follows.
+_RECORD = struct.Struct('<dIH')
+# Entry of the index of a segment: time and offset of a record.
+_INDEX_ENTRY = struct.Struct('<dQ')
+
+
+class _Segment(object):
+    """One file of a SampleLog, with the sparse time index of its
+    records (kept in memory and in a file next to it).
+    """
+
+    __slots__ = ('number', 'path', 'index_path', 'times', 'offsets', 'size')
+
+    def __init__(self, directory, number):
+        self.number = number
+        self.path = os.path.join(directory, "%020d.log" % number)
+        self.index_path = os.path.join(directory, "%020d.idx" % number)
+        self.times = array.array('d')
+        self.offsets = array.array('Q')
+        self.size = 0
+
+    def load(self):
+        with open(self.index_path, 'rb') as index_file:
+            data = index_file.read()
+        # A partly written last entry is ignored.
+        data = data[:len(data) - len(data) % _INDEX_ENTRY.size]
+        for time_, offset in _INDEX_ENTRY.iter_unpack(data):
+            self.times.append(time_)
+            self.offsets.append(offset)
+        self.size = os.path.getsize(self.path)
+
+    @property
+    def first_time(self):
+        return self.times[0] if self.times else None
+
+    def remove(self):
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class SampleLog(object):
+    """Append-only binary log of the values of UPS variables, on disk.
+
+    Each value is stored as a record of its time, the id of its
+    (ups, var) and its text. Ids are given on first use and saved in
+    the keys file of the directory. Records go to segment files of
+    about segment_size bytes, each with a sparse index of the time of
+    one record every index_every bytes::
+
+        with SampleLog("/var/lib/collector/samples", retention=86400) as log:
+            log.append_vars("My_UPS", client.list_vars("My_UPS"))
+            ...
+            for sample in log.query(t0, t1, "My_UPS", ["ups.status"]):
+                print(sample.time, sample.value)
+
+    query() maps only the segments overlapping the time range with
+    mmap, and starts reading them at the indexed record preceding the
+    start of the range. When a new segment is started, the oldest ones
+    are deleted beyond max_segments, or once all their records are
+    older than retention seconds.
+
+    Times must not go backwards: a sample older than the previous one is
+    stored with the time of the previous one, so that records stay in
+    time order.
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024,
+                 max_segments=None, retention=None, index_every=4096):
+        """directory    : Directory of the log, created if needed.
+        segment_size : Size, in bytes, above which a new segment is
+                       started.
+        max_segments : Maximum number of segments kept (None for no
+                       limit).
+        retention    : Seconds after which samples are deleted (None
+                       for never), with a granularity of one segment.
+        index_every  : Bytes between two indexed records.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.retention = retention
+        self.index_every = index_every
+        self._keys = []
+        self._ids = {}
+        self._segments = []
+        self._file = self._index_file = self._keys_file = None
+        self._next_index = 0
+        self._last_time = -math.inf
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        keys_path = os.path.join(self.directory, "keys")
+        if os.path.exists(keys_path):
+            end = 0
+            with open(keys_path, 'rb') as keys_file:
+                for line in keys_file:
+                    if not line.endswith(b"\n"):
+                        break
+                    self._intern(*json.loads(line.decode('utf-8')))
+                    end += len(line)
+            # Drop a key that a crash left half written, so that the
+            # next one starts on a line of its own.
+            if end < os.path.getsize(keys_path):
+                with open(keys_path, 'r+b') as keys_file:
+                    keys_file.truncate(end)
+        self._keys_file = open(keys_path, 'ab')
+
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                         if name.endswith(".log") and name[:-4].isdigit())
+        for number in numbers:
+            segment = _Segment(self.directory, number)
+            if not os.path.exists(segment.index_path):
+                open(segment.index_path, 'wb').close()
+            segment.load()
+            self._segments.append(segment)
+        if not self._segments:
+            self._start_segment(0)
+            return
+
+        # Find the end of the last complete record of the last segment,
+        # dropping what a crash may have left after it, as well as the
+        # index entries past it.
+        segment = self._segments[-1]
+        while segment.offsets and segment.offsets[-1] >= segment.size:
+            segment.times.pop()
+            segment.offsets.pop()
+        offset = segment.offsets[-1] if segment.offsets else 0
+        with open(segment.path, 'rb') as log_file:
+            log_file.seek(offset)
+            data = log_file.read()
+        end = 0
+        while end + _RECORD.size <= len(data):
+            time_, key, length = _RECORD.unpack_from(data, end)
+            if (end + _RECORD.size + length > len(data) or
+                    key >= len(self._keys)):
+                break
+            if not segment.offsets:
+                segment.times.append(time_)
+                segment.offsets.append(0)
+            self._last_time = time_
+            end += _RECORD.size + length
+        segment.size = offset + end
+        with open(segment.path, 'r+b') as log_file:
+            log_file.truncate(segment.size)
+        with open(segment.index_path, 'wb') as index_file:
+            for entry in zip(segment.times, segment.offsets):
+                index_file.write(_INDEX_ENTRY.pack(*entry))
+        self._file = open(segment.path, 'ab')
+        self._index_file = open(segment.index_path, 'ab')
+        self._next_index = (segment.offsets[-1] + self.index_every
+                            if segment.offsets else 0)
+        self._apply_retention(self._last_time)
+
+    def _start_segment(self, number):
+        segment = _Segment(self.directory, number)
+        self._file = open(segment.path, 'wb')
+        self._index_file = open(segment.index_path, 'wb')
+        self._segments.append(segment)
+        self._next_index = 0
+
+    def _rotate(self):
+        self._file.close()
+        self._index_file.close()
+        self._start_segment(self._segments[-1].number + 1)
+        self._apply_retention(self._last_time)
+
+    def _apply_retention(self, now):
+        segments = self._segments
+        while len(segments) > 1:
+            # The records of a segment are all older than the first one
+            # of the next segment.
+            following = segments[1].first_time
+            if not ((self.max_segments is not None and
+                     len(segments) > self.max_segments) or
+                    (self.retention is not None and following is not None and
+                     following < now - self.retention)):
+                break
+            segments.pop(0).remove()
+
+    @property
+    def segments(self):
+        """Paths of the segment files, oldest first."""
+        return [segment.path for segment in self._segments]
+
+    def _intern(self, ups, var):
+        key = (sys.intern(ups), sys.intern(var))
+        self._ids[key] = len(self._keys)
+        self._keys.append(key)
+        return self._ids[key]
+
+    def append(self, ups, var, value, time_=None):
+        """Log a value of var (as returned by get_var) read at time_
+        (defaulting to now).
+        """
+        self.append_vars(ups, {var: value}, time_)
+
+    def append_vars(self, ups, ups_vars, time_=None):
+        """Log the variables of ups, as returned by list_vars, read at
+        time_ (defaulting to now).
+        """
+        if time_ is None:
+            time_ = time.time()
+        with self._lock:
+            if self._file is None:
+                raise PyNUTError("The sample log is closed")
+            time_ = max(time_, self._last_time)
+            segment = self._segments[-1]
+            if segment.size >= self.segment_size:
+                self._rotate()
+                segment = self._segments[-1]
+            records = []
+            for var, value in ups_vars.items():
+                key = self._ids.get((ups, var))
+                if key is None:
+                    key = self._intern(ups, var)
+                    self._keys_file.write(
+                        json.dumps([ups, var]).encode('utf-8') + b"\n")
+                value = value.encode('utf-8')[:0xffff]
+                if segment.size >= self._next_index:
+                    self._index_file.write(_INDEX_ENTRY.pack(time_,
+                                                             segment.size))
+                    segment.times.append(time_)
+                    segment.offsets.append(segment.size)
+                    self._next_index = segment.size + self.index_every
+                records.append(_RECORD.pack(time_, key, len(value)))
+                records.append(value)
+                segment.size += _RECORD.size + len(value)
+            # Keys reach the disk before the records using them.
+            self._keys_file.flush()
+            self._file.write(b"".join(records))
+            self._last_time = time_
+
+    def flush(self):
+        """Write the buffered records to the segment file."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._file is not None:
+            self._keys_file.flush()
+            self._file.flush()
+            self._index_file.flush()
+
+    def query(self, start, end, ups=None, vars=None):
+        """Yield the Samples logged from start to end (times included),
+        in time order, optionally only those of ups and of the variables
+        named in vars.
+        """
+        with self._lock:
+            # Flushed along with reading the sizes, so that no record
+            # counted in them is still buffered.
+            self._flush()
+            ids = None
+            if ups is not None or vars is not None:
+                vars = None if vars is None else frozenset(vars)
+                ids = frozenset(
+                    key for key, (key_ups, key_var) in enumerate(self._keys)
+                    if (ups is None or key_ups == ups) and
+                    (vars is None or key_var in vars))
+                if not ids:
+                    return
+            keys = list(self._keys)
+            segments = list(self._segments)
+            sizes = [segment.size for segment in segments]
+
+        for i, segment in enumerate(segments):
+            if segment.first_time is None or segment.first_time > end:
+                break
+            if (i + 1 < len(segments) and
+                    segments[i + 1].first_time is not None and
+                    segments[i + 1].first_time < start):
+                continue
+            for sample in self._scan(segment, sizes[i], start, end, ids,
+                                     keys):
+                yield sample
+
+    @staticmethod
+    def _scan(segment, size, start, end, ids, keys):
+        try:
+            log_file = open(segment.path, 'rb')
+        except FileNotFoundError:
+            # Deleted by the retention since the query started.
+            return
+        with log_file, contextlib.closing(mmap.mmap(
+                log_file.fileno(), size, access=mmap.ACCESS_READ)) as view:
+            position = max(0, bisect.bisect_left(segment.times, start) - 1)
+            offset = segment.offsets[position]
+            while offset < size:
+                time_, key, length = _RECORD.unpack_from(view, offset)
+                if time_ > end:
+                    break
+                offset += _RECORD.size
+                if time_ >= start and (ids is None or key in ids):
+                    ups, var = keys[key]
+                    yield Sample(time_, ups, var,
+                                 view[offset:offset + length].decode('utf-8'))
+                offset += length
+
+    def close(self):
+        with self._lock:
+            for log_file in (self._file, self._index_file, self._keys_file):
+                if log_file is not None:
+                    log_file.close()
+            self._file = self._index_file = self._keys_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, trace):
+        self.close()
+
+
+# TLS sessions to resume, by SSLContext and then by (host, port).
+_tls_sessions = weakref.WeakKeyDictionary()
+
+
+class PyNUTClient(object):
+    """Access NUT (Network UPS Tools) servers."""
+
+    def __init__(self, host="127.0.0.1", port=3493, login=None, password=None, debug=False, timeout=5, connect=True, transport=None, cache=None, deadline=None, stats=None, ssl_context=None):
+        """Class initialization method.
+
+        host      : Host to connect (defaults to 127.0.0.1).
+        port      : Port where NUT listens for connections (defaults to 3493).
+        login     : Login used to connect to NUT server (defaults to None
+                    for no authentication).
+        password  : Password used when using authentication (defaults to None).
+        debug     : Boolean, put class in debug mode (prints everything
+                    on console, defaults to False).
+        timeout   : Timeout used to wait for network response (defaults
+                    to 5 seconds).
+        deadline  : Maximum total time, in seconds, of each method call
+                    (pipeline, or iteration of an iter_* method), across
+                    all its network exchanges, TLS handshake included. A
+                    PyNUTTimeoutError is raised when it is exceeded
+                    (defaults to None, only timeout applies).
+        transport : Callable used to open the connection, called as
+                    transport(host, port, timeout=timeout) and returning
+                    a Transport (defaults to TCPTransport). Pass
+                    UnixTransport to use host as a Unix socket path.
+        cache     : MetadataCache used for var_type, var_description,
+                    command_description, list_enum and list_range
+                    (defaults to None, no caching).
+        stats     : ClientStats recording every request (defaults to
+                    None, no instrumentation).
+        ssl_context : ssl.SSLContext used to switch the connection to TLS
+                    with STARTTLS before logging in (defaults to None,
+                    plaintext). The TLS session is kept per server and
+                    context, and resumed by the next connection to the
+                    same server; tls_session_reused tells whether it was.
+        """
+        if debug:
+            # Print DEBUG messages to the console.
+            logging.getLogger().setLevel(logging.DEBUG)
+
+        logging.debug("Class initialization...")
+        logging.debug(" -> Host = %s (port %s)", host, port)
+        logging.debug(" -> Login = '%s' / '%s'", login, password)
+
+        self._host = host
+        self._port = port
+        self._login = login
+        self._password = password
+        self._timeout = timeout
+        self._transport = transport
+        self._cache = cache
+        self._deadline = deadline
+        self._stats = stats
+        self._ssl_context = ssl_context
+        self.tls_session_reused = None
+        self._budget = None
+        self._schemas = {}
+        self._numeric_vars = {}
+        self._srv_handler = None
+
+        if connect:
+            self._connect()
+
+    def __del__(self):
+        # Try to disconnect cleanly when class is deleted.
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, trace):
+        self.close()
+
+    def close(self):
+        """Log out and close the connection to the server."""
+        handler = getattr(self, '_srv_handler', None)
+        if handler and getattr(self, '_ssl_context', None) is not None:
+            self._save_tls_session()
+        self._srv_handler = None
+        if handler:
+            try:
+                handler.write(b"LOGOUT\n")
+                handler.close()
+            except (PyNUTError, socket.error, AttributeError):
+                # The socket is already disconnected.
+                pass
+
+    @_operation
+    def _connect(self):
+        """Connects to the defined server.
+
+        If login/pass was specified, the class tries to authenticate.
+        An error is raised if something goes wrong.
+        """
+        logging.debug("Connecting to host")
+
+        transport = self._transport or TCPTransport
+        timeout = self._timeout
+        if self._budget is not None:
+            timeout = self._budget.timeout(timeout)
+        try:
+            self._srv_handler = transport(self._host, self._port,
+                                          timeout=timeout)
+        except socket.timeout:
+            raise PyNUTTimeoutError("Timed out connecting to the server.")
+        except socket.error:
+            raise PyNUTConnectionError("Socket error.")
+
+        if self._ssl_context is not None:
+            self._start_tls()
+        for query in _login_queries(self._login, self._password):
+            self._execute(query)
+
+    def _start_tls(self):
+        """Switch the connection to TLS, resuming the last TLS session
+        with this server if there is one.
+        """
+        logging.debug("Starting TLS")
+
+        self._execute(_single(b"STARTTLS\n", _expect("OK STARTTLS\n")))
+        sessions = _tls_sessions.get(self._ssl_context, {})
+        session = sessions.get((self._host, self._port))
+        budget = self._budget
+        if budget is None:
+            self._srv_handler.start_tls(self._ssl_context, self._host,
+                                        session, self._timeout)
+        else:
+            try:
+                self._srv_handler.start_tls(
+                    self._ssl_context, self._host, session,
+                    budget.timeout(self._timeout))
+            except PyNUTTimeoutError as err:
+                raise budget.error(str(err))
+        self.tls_session_reused = self._srv_handler.tls_session_reused
+        self._save_tls_session()
+
+    def _save_tls_session(self):
+        # With TLS 1.3, the resumable session only arrives after the
+        # handshake, so this is done again when closing.
+        session = self._srv_handler.tls_session
+        if session is not None:
+            sessions = _tls_sessions.setdefault(self._ssl_context, {})
+            sessions[(self._host, self._port)] = session
+
+    @contextlib.contextmanager
+    def deadline(self, seconds, operation="operation"):
+        """Context manager running its block under a single deadline.
+
+        All the requests made in the block must complete within seconds
+        in total, or PyNUTTimeoutError is raised::
+
+            with client.deadline(2):
+                commands = client.list_commands("My_UPS")
+                charge = client.get_var("My_UPS", "battery.charge")
+
+        A block nested in another one is part of the outer operation.
+        """
+        if self._budget is not None:
+            yield
+            return
+        self._budget = _Deadline(operation, seconds)
+        try:
+            yield
+        finally:
+            self._budget = None
+
+    def _write(self, data):
+        """Send data to the server, within the deadline."""
+        budget = self._budget
+        if budget is None:
+            self._srv_handler.write(data, self._timeout)
+            return
+        try:
+            self._srv_handler.write(data, budget.timeout(self._timeout))
+        except PyNUTTimeoutError as err:
+            raise budget.error(str(err))
+
+    def _read_until(self, terminator):
+        """Read from the server up to terminator, within the deadline."""
+        budget = self._budget
+        if budget is None:
+            return self._srv_handler.read_until(terminator, self._timeout)
+        try:
+            return self._srv_handler.read_until(terminator,
+                                                budget.timeout(self._timeout))
+        except PyNUTTimeoutError as err:
+            raise budget.error(str(err))
+
+    def _execute(self, query):
+        """Send a single query and return its parsed reply."""
+        if self._stats is not None:
+            result, = self._execute_many([query])
+            if isinstance(result, PyNUTError):
+                raise result
+            return result
+        self._write(query.line)
+        return query.parse(self._read_reply(query))
+
+    def _execute_many(self, queries):
+        """Send all queries in a single write, then read their replies.
+
+        Returns the list of parsed replies, with the PyNUTError raised
+        while parsing a reply in place of its result.
+        """
+        self._write(b"".join(query.line for query in queries))
+        return list(self._replies(queries))
+
+    def _replies(self, queries):
+        """Return an iterator over the parsed replies to queries, which
+        were sent in a single write. The PyNUTError raised while parsing
+        a reply is yielded in place of its result, connection errors are
+        raised.
+        """
+        if self._stats is not None:
+            return self._measure_replies(queries)
+        return self._parse_replies(queries)
+
+    def _parse_replies(self, queries):
+        for query in queries:
+            try:
+                yield query.parse(self._read_reply(query))
+            except PyNUTConnectionError:
+                raise
+            except PyNUTError as err:
+                yield err
+
+    def _measure_replies(self, queries):
+        # Like _parse_replies, recording each exchange in the stats. The
+        # wire time of a pipelined reply starts after the previous one.
+        handler = self._srv_handler
+        start = time.perf_counter()
+        for query in queries:
+            received = handler.bytes_received
+            error = None
+            try:
+                try:
+                    reply = self._read_reply(query)
+                finally:
+                    wire_end = time.perf_counter()
+                result = query.parse(reply)
+            except PyNUTError as err:
+                result = error = err
+            end = time.perf_counter()
+            self._stats.record(RequestEvent(
+                self._host, self._port, _command_name(query.line),
+                len(query.line), handler.bytes_received - received,
+                wire_end - start, end - wire_end, error))
+            if isinstance(error, PyNUTConnectionError):
+                raise error
+            yield result
+            start = end
+
+    def _execute_cached(self, query, kind, ups, name):
+        """Like _execute, but look up the result in the metadata cache
+        first and store it there on a miss.
+        """
+        if self._cache is None:
+            return self._execute(query)
+
+        key = (self._host, self._port, ups, kind, name)
+        result = self._cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = self._execute(query)
+            self._cache.set(key, result)
+        return result
+
+    def invalidate_cache(self, ups=None):
+        """Drop the cached metadata of the given UPS (of all UPS on this
+        server if ups is None).
+        """
+        if self._cache is not None:
+            self._cache.invalidate(self._host, self._port, ups)
+
+    def _iter_listing(self, query):
+        """Send a LIST query and return an iterator over the lines of its
+        reply (without the trailing newline), yielded as they are
+        received.
+
+        If the caller stops iterating early, the rest of the reply is
+        skipped so the connection can still be used.
+        """
+        if self._stats is not None:
+            return self._measure_listing(query)
+        return self._stream_listing(query)
+
+    def _measure_listing(self, query):
+        # The wire time includes the time the caller spent on each line,
+        # there is no separate parse time.
+        handler = self._srv_handler
+        received = handler.bytes_received
+        start = time.perf_counter()
+        error = None
+        try:
+            yield from self._stream_listing(query)
+        except PyNUTError as err:
+            error = err
+            raise
+        finally:
+            self._stats.record(RequestEvent(
+                self._host, self._port, _command_name(query.line),
+                len(query.line), handler.bytes_received - received,
+                time.perf_counter() - start, 0.0, error))
+
+    def _stream_listing(self, query):
+        self._write(query.line)
+        result = self._read_until(b"\n").decode('utf-8')
+        if result != query.begin:
+            raise PyNUTError(result.replace("\n", ""))
+
+        while True:
+            line = self._read_until(b"\n")
+            if line == query.end:
+                return
+            try:
+                yield line[:-1].decode('utf-8')
+            except GeneratorExit:
+                self._read_until(query.end)
+                raise
+
+    def _read_reply(self, query):
+        """Read the complete reply to ``query`` from the server."""
+        result = self._read_until(b"\n").decode('utf-8')
+        if query.begin is not None:
+            if result != query.begin:
+                raise PyNUTError(result.replace("\n", ""))
+            result = self._read_until(query.end).decode('utf-8')
+        if self._budget is not None:
+            self._budget.replies.append(result)
+        return result
+
+    def pipeline(self):
+        """Return a Pipeline to send several requests in one round trip."""
+        return Pipeline(self)
+
+    @_operation
+    def description(self, ups):
+        """Returns the description for a given UPS."""
+        return self._execute(_description_query(ups))
+
+    @_operation
+    def list_ups(self):
+        """Returns the list of available UPS from the NUT server.
+
+        The result is a dictionary containing 'key->val' pairs of
+        'UPSName' and 'UPS Description'.
+        """
+        return self._execute(_list_ups_query())
+
+    @_operation
+    def list_vars(self, ups):
+        """Get all available vars from the specified UPS.
+
+        The result is a dictionary containing 'key->val' pairs of all
+        available vars.
+        """
+        return self._execute(_list_vars_query(ups))
+
+    @_operation
+    def iter_ups(self):
+        """Like list_ups, but yields ('UPSName', 'UPS Description')
+        pairs as they are received from the server.
+        """
+        for line in self._iter_listing(_list_ups_query()):
+            if line.startswith("UPS"):
+                yield _ups_entry(line)
+
+    @_operation
+    def iter_vars(self, ups):
+        """Like list_vars, but yields (var, value) pairs as they are
+        received from the server.
+
+        Nothing is sent until the iteration starts, and the connection
+        can not be used for anything else until it is over. Stopping
+        early (with break or close()) skips the rest of the list.
+        """
+        for line in self._iter_listing(_list_vars_query(ups)):
+            yield _var_entry(line)
+
+    @_operation
+    def list_commands(self, ups, describe=True):
+        """Get all available commands for the specified UPS.
+
+        The result is a dict object with command name as key and a description
+        of the command as value. The descriptions are all requested in a
+        single pipelined round trip.
+
+        If describe is False, only the list of command names is returned,
+        without requesting the descriptions at all.
+        """
+        commands = self._execute(_list_cmd_query(ups))
+        if not describe:
+            return commands
+        if not commands:
+            return {}
+
+        # For each command we try to get the available description
+        return dict(zip(commands, self._execute_many(
+            [_cmddesc_fallback_query(ups, command) for command in commands])))
+
+    @_operation
+    def list_clients(self, ups=None):
+        """Returns the list of connected clients from the NUT server.
+
+        The result is a dictionary containing 'key->val' pairs of
+        'UPSName' and a list of clients.
+        """
+        if ups and (ups not in self.list_ups()):
+            raise PyNUTError("%s is not a valid UPS" % ups)
+
+        return self._execute(_list_clients_query(ups))
+
+    @_operation
+    def iter_clients(self, ups=None):
+        """Like list_clients, but yields ('UPSName', client) pairs as
+        they are received from the server.
+        """
+        if ups and (ups not in self.list_ups()):
+            raise PyNUTError("%s is not a valid UPS" % ups)
+
+        for line in self._iter_listing(_list_clients_query(ups)):
+            if line.startswith("CLIENT"):
+                yield _client_entry(line)
+
+    @_operation
+    def list_rw_vars(self, ups):
+        """Get a list of all writable vars from the selected UPS.
+
+        The result is presented as a dictionary containing 'key->val'
+        pairs.
+        """
+        return self._execute(_list_rw_vars_query(ups))
+
+    @_operation
+    def iter_rw_vars(self, ups):
+        """Like list_rw_vars, but yields (var, value) pairs as they are
+        received from the server.
+        """
+        for line in self._iter_listing(_list_rw_vars_query(ups)):
+            yield _var_entry(line, _RW_LINE)
+
+    @_operation
+    def list_enum(self, ups, var):
+        """Get a list of valid values for an enum variable.
+
+        The result is presented as a list.
+        """
+        return list(self._execute_cached(_list_values_query("ENUM", ups, var),
+                                         "ENUM", ups, var))
+
+    @_operation
+    def list_range(self, ups, var):
+        """Get a list of valid values for an range variable.
+
+        The result is presented as a list.
+        """
+        return list(self._execute_cached(_list_values_query("RANGE", ups, var),
+                                         "RANGE", ups, var))
+
+    @_operation
+    def set_var(self, ups, var, value):
+        """Set a variable to the specified value on selected UPS.
+
+        The variable must be a writable value (cf list_rw_vars) and you
+        must have the proper rights to set it (maybe login/password).
+        """
+        self._execute(_set_var_query(ups, var, value))
+
+    @_operation
+    def get_var(self, ups, var):
+        """Get the value of a variable."""
+        return self._execute(_get_var_query(ups, var))
+
+    # Alias for convenience
+    def get(self, ups, var):
+        """Get the value of a variable (alias for get_var)."""
+        return self.get_var(ups, var)
+
+    @_operation
+    def var_description(self, ups, var):
+        """Get a variable's description."""
+        return self._execute_cached(_var_description_query(ups, var),
+                                    "DESC", ups, var)
+
+    @_operation
+    def var_type(self, ups, var):
+        """Get a variable's type."""
+        return self._execute_cached(_var_type_query(ups, var),
+                                    "TYPE", ups, var)
+
+    @_operation
+    def command_description(self, ups, command):
+        """Get a command's description."""
+        return self._execute_cached(_command_description_query(ups, command),
+                                    "CMDDESC", ups, command)
+
+    @_operation
+    def run_command(self, ups, command):
+        """Send a command to the specified UPS."""
+        self._execute(_run_command_query(ups, command))
+
+    @_operation
+    def fsd(self, ups):
+        """Send MASTER and FSD commands."""
+        self._execute(_master_query(ups))
+        self._execute(_fsd_query(ups))
+
+    @_operation
+    def num_logins(self, ups):
+        """Send GET NUMLOGINS command to get the number of users logged
+        into a given UPS.
+        """
+        return self._execute(_num_logins_query(ups))
+
+    @_operation
+    def help(self):
+        """Send HELP command."""
+        return self._execute(_single(b"HELP\n", _raw))
+
+    @_operation
     def ver(self):
         """Send VER command."""
-        logging.debug("VER called...")
+        return self._execute(_single(b"VER\n", _raw))
+
+    @_operation
+    def snapshot(self, ups):
+        """Get all available vars from the specified UPS as a UPSSnapshot.
+
+        The types of the variables are requested (in a single pipelined
+        round trip) the first time they are seen, and the snapshot
+        schema is reused by the following calls while the set of
+        variables does not change.
+        """
+        ups_vars = self.list_vars(ups)
+        schema = self._schemas.get(ups)
+        if schema is None or not schema.covers(ups_vars):
+            numeric = self._numeric_vars.setdefault(ups, {})
+            unknown = [var for var in ups_vars if var not in numeric]
+            if unknown:
+                types = self._execute_many(
+                    [_var_type_query(ups, var) for var in unknown])
+                for var, type_ in zip(unknown, types):
+                    numeric[var] = (not isinstance(type_, PyNUTError) and
+                                    _is_numeric_type(type_))
+            schema = UPSSchema.get(ups_vars, [var for var in ups_vars
+                                              if numeric[var]])
+            self._schemas[ups] = schema
+        return UPSSnapshot(schema, ups, ups_vars)
+
+    def watch(self, ups, interval=5, vars=None, polls=None):
+        """Poll a UPS periodically and yield only what changed.
+
+        The UPS is polled every interval seconds, with LIST VAR or, if
+        vars is a list of variable names, with pipelined GET VAR
+        requests for just those variables (unsupported ones are treated
+        as absent). Each poll that found differences with the previous
+        one yields a list of VarChange tuples; the first poll reports
+        every variable as added. polls limits the number of polls
+        (defaults to None, poll until the generator is closed).
+        """
+        logging.debug("watch '%s' every %s seconds", ups, interval)
+
+        last = {}
+        next_poll = time.monotonic()
+        done = 0
+        while polls is None or done < polls:
+            delay = next_poll - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            # Skip the ticks that were missed rather than polling in a burst.
+            next_poll = max(next_poll + interval, time.monotonic())
+
+            if vars is None:
+                current = self.list_vars(ups)
+            else:
+                results = self._execute_many(
+                    [_get_var_query(ups, var) for var in vars])
+                current = dict((var, value)
+                               for var, value in zip(vars, results)
+                               if not isinstance(value, PyNUTError))
+            done += 1
+
+            changes = _diff_vars(ups, last, current, time.time())
+            last = current
+            if changes:
+                yield changes
+
+
+class PollScheduler(object):
+    """Polls the variables of a UPS, each at its own pace.
+
+    Each variable has a poll interval, either given in intervals or
+    learned: it is halved (down to min_interval) when a poll finds the
+    value changed, and doubled (up to max_interval) when it did not, so
+    that variables like ups.status or input.voltage end up being polled
+    often and device.serial hardly ever.
+
+    At each tick, the variables that are due are read with pipelined
+    GET VAR requests, sent in a single write, or with a single LIST VAR
+    when more than list_threshold of all the variables are due. A LIST
+    VAR is also done every full_interval seconds, to notice variables
+    that appeared. While ups.status contains OB or LB, learned intervals
+    are divided by alert_factor.
+
+    The lists and gets attributes count the LIST VAR and GET VAR
+    requests sent::
+
+        scheduler = PollScheduler(client, "My_UPS", min_interval=2)
+        for changes in scheduler.run():
+            ...
+    """
+
+    def __init__(self, client, ups, intervals=None, min_interval=1,
+                 max_interval=300, list_threshold=0.5, full_interval=600,
+                 alert_factor=8):
+        """client         : PyNUTClient (or SharedPyNUTClient) to poll with.
+        ups            : Name of the UPS to poll.
+        intervals      : Optional {var: seconds} of fixed intervals.
+        min_interval   : Shortest learned interval (also the interval of
+                         ups.status, unless given in intervals).
+        max_interval   : Longest learned interval.
+        list_threshold : Fraction of variables due above which LIST VAR
+                         is used instead of GET VAR requests.
+        full_interval  : Seconds between two LIST VAR (None for never,
+                         besides the first poll).
+        alert_factor   : Interval divisor while on battery or low battery.
+        """
+        self.client = client
+        self.ups = ups
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.list_threshold = list_threshold
+        self.full_interval = full_interval
+        self.alert_factor = alert_factor
+        self.values = {}
+        self.lists = 0
+        self.gets = 0
+        self._fixed = dict(intervals or {})
+        self._fixed.setdefault('ups.status', min_interval)
+        self._intervals = {}
+        self._due = {}
+        self._next_list = None
+
+    @property
+    def alert(self):
+        """True while ups.status reports being on battery or low battery."""
+        flags = self.values.get('ups.status', '').split()
+        return 'OB' in flags or 'LB' in flags
+
+    def interval(self, var):
+        """Return the current poll interval of var, in seconds."""
+        if var in self._fixed:
+            return self._fixed[var]
+        interval = self._intervals.get(var, self.min_interval)
+        if self.alert:
+            interval = max(self.min_interval, interval / self.alert_factor)
+        return interval
+
+    def next_poll_time(self):
+        """Return the time.monotonic() time at which a variable is due."""
+        if self._next_list is None:
+            return time.monotonic()
+        return min([self._next_list] + list(self._due.values()))
+
+    def _learn(self, var, changed):
+        if var in self._fixed:
+            return
+        interval = self._intervals.get(var, self.min_interval)
+        if changed:
+            interval = max(self.min_interval, interval / 2.0)
+        else:
+            interval = min(self.max_interval, interval * 2)
+        self._intervals[var] = interval
+
+    def poll(self, now=None):
+        """Read the variables that are due, and return the list of
+        VarChange found (the first poll reports every variable as added).
+        """
+        if now is None:
+            now = time.monotonic()
+        due = [var for var, when in self._due.items() if when <= now]
+
+        if (self._next_list is None or now >= self._next_list or
+                len(due) > self.list_threshold * len(self._due)):
+            polled = list(self._due) if self._next_list is not None else []
+            old = dict(self.values)
+            current = self.client.list_vars(self.ups)
+            self.lists += 1
+            if self.full_interval is not None:
+                self._next_list = now + self.full_interval
+            else:
+                self._next_list = float('inf')
+        elif due:
+            polled = due
+            old = dict((var, self.values[var]) for var in due
+                       if var in self.values)
+            results = self.client._execute_many(
+                [_get_var_query(self.ups, var) for var in due])
+            self.gets += len(due)
+            current = dict((var, value) for var, value in zip(due, results)
+                           if not isinstance(value, PyNUTError))
+        else:
+            return []
+
+        alert = self.alert
+        changes = _diff_vars(self.ups, old, current, time.time())
+        changed = set(change.var for change in changes)
+        for var in polled:
+            self._learn(var, var in changed)
+        for var in old:
+            if var not in current:
+                self.values.pop(var, None)
+                self._due.pop(var, None)
+        self.values.update(current)
+        for var in current:
+            # Variables read early by a LIST VAR keep their schedule.
+            if var in due or var not in self._due or var in changed:
+                self._due[var] = now + self.interval(var)
+        if self.alert and not alert:
+            # Going on battery: bring the already scheduled polls closer.
+            for var, when in self._due.items():
+                self._due[var] = min(when, now + self.interval(var))
+        return changes
+
+    def run(self, polls=None):
+        """Poll whenever a variable is due and yield the lists of changes,
+        like PyNUTClient.watch. polls limits the number of polls (defaults
+        to None, poll until the generator is closed).
+        """
+        done = 0
+        while polls is None or done < polls:
+            delay = self.next_poll_time() - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            changes = self.poll()
+            done += 1
+            if changes:
+                yield changes
+
+
+class _SharedRequest(object):
+    """A query submitted to a SharedPyNUTClient, and its outcome."""
+
+    __slots__ = ('query', 'outcome', 'done')
+
+    def __init__(self, query):
+        self.query = query
+        self.outcome = None
+        self.done = False
+
+
+class SharedPyNUTClient(PyNUTClient):
+    """A PyNUTClient that can be shared between threads.
+
+    The connection is used by one thread at a time. Requests made by
+    threads while another one is busy with the server are queued, and
+    the next thread to get the connection sends all the queued requests
+    in a single pipelined write, reads all the replies and hands them
+    out to the waiting threads.
+
+    Identical GET and LIST requests that are queued or on their way to
+    the server at the same time are only sent once, and their result is
+    given to all the threads that asked for it. The ``batches`` and
+    ``coalesced`` attributes count the pipelined writes and the requests
+    that were saved this way.
+
+    The constructor arguments are the same as for PyNUTClient. Deadlines
+    are tracked per thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._local = threading.local()
+        # Held by the thread talking to the server.
+        self._io_lock = threading.Lock()
+        # Protects the two following attributes.
+        self._queue_lock = threading.Lock()
+        self._pending = []
+        self._inflight = {}
+        self.batches = 0
+        self.coalesced = 0
+        PyNUTClient.__init__(self, *args, **kwargs)
+
+    @property
+    def _budget(self):
+        return getattr(self._local, 'budget', None)
+
+    @_budget.setter
+    def _budget(self, budget):
+        self._local.budget = budget
+
+    def _submit(self, queries):
+        """Queue queries, and return their requests once all are done."""
+        requests = []
+        with self._queue_lock:
+            for query in queries:
+                request = None
+                coalesce = query.line.startswith((b"GET ", b"LIST "))
+                if coalesce:
+                    request = self._inflight.get(query.line)
+                if request is None:
+                    request = _SharedRequest(query)
+                    self._pending.append(request)
+                    if coalesce:
+                        self._inflight[query.line] = request
+                else:
+                    self.coalesced += 1
+                requests.append(request)
+
+        while not all(request.done for request in requests):
+            with self._io_lock:
+                # Another thread may have sent our requests while we were
+                # waiting for the connection.
+                if not all(request.done for request in requests):
+                    self._flush()
+        return requests
+
+    def _flush(self):
+        """Send all the queued requests and dispatch their replies."""
+        with self._queue_lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self.batches += 1
+        error = PyNUTError("Request aborted.")
+        try:
+            queries = [request.query for request in batch]
+            self._write(b"".join(query.line for query in queries))
+            for request, outcome in zip(batch, self._replies(queries)):
+                request.outcome = outcome
+                self._finish(request)
+        except PyNUTError as err:
+            error = err
+        finally:
+            # If the connection broke, fail everything not answered yet.
+            for request in batch:
+                if not request.done:
+                    request.outcome = error
+                    self._finish(request)
+
+    def _finish(self, request):
+        with self._queue_lock:
+            if self._inflight.get(request.query.line) is request:
+                del self._inflight[request.query.line]
+        request.done = True
+
+    def _execute(self, query):
+        outcome = self._submit([query])[0].outcome
+        if isinstance(outcome, PyNUTError):
+            raise outcome
+        return outcome
+
+    def _execute_many(self, queries):
+        results = [request.outcome for request in self._submit(queries)]
+        for result in results:
+            if isinstance(result, PyNUTConnectionError):
+                raise result
+        return results
+
+    def _iter_listing(self, query):
+        # Streaming needs the connection for the whole iteration.
+        with self._io_lock:
+            for line in PyNUTClient._iter_listing(self, query):
+                yield line
+
+
+class PyNUTCircuitOpenError(PyNUTConnectionError):
+    """Raised by ConnectionPool, without trying to connect, for a server
+    that failed too many times in a row.
+    """
+
+
+class _CircuitBreaker(object):
+    """Tracks the consecutive connection failures of one server."""
+
+    __slots__ = ('failures', 'open_until')
+
+    def __init__(self):
+        self.failures = 0
+        self.open_until = None
+
+    def allow(self):
+        # Once reset_timeout has passed, let requests through again; the
+        # first failure re-opens the circuit right away.
+        return self.open_until is None or time.monotonic() >= self.open_until
+
+    def success(self):
+        self.failures = 0
+        self.open_until = None
+
+    def failure(self, threshold, reset_timeout):
+        self.failures += 1
+        if self.failures >= threshold:
+            self.open_until = time.monotonic() + reset_timeout
+
+
+class ConnectionPool(object):
+    """Pool of authenticated PyNUTClient sessions.
+
+    Sessions are keyed by (host, port, login) and reused, so the
+    USERNAME/PASSWORD handshake is only done when a new connection is
+    opened. A session idle for more than keepalive seconds is checked
+    with a VER request before being handed out, and replaced if it is
+    dead. A session that raised PyNUTConnectionError is dropped.
+
+    After failure_threshold consecutive connection failures, a server
+    is considered down: for reset_timeout seconds, requests to it fail
+    immediately with PyNUTCircuitOpenError instead of waiting for the
+    timeout.
+
+    Use connection() to borrow a client, run() to have a function
+    retried on a new connection when the server connection breaks, or
+    client() for an object with the PyNUTClient methods doing that::
+
+        pool = ConnectionPool(timeout=2)
+        ups1 = pool.client("ups1.example.com", login="user",
+                           password="pass")
+        ups1.list_vars("My_UPS")
+    """
+
+    def __init__(self, max_idle=4, keepalive=30, retries=2, backoff=0.1,
+                 max_backoff=5, failure_threshold=3, reset_timeout=30,
+                 client_class=PyNUTClient, **client_kwargs):
+        """max_idle          : Maximum number of idle sessions kept per key.
+        keepalive         : Idle time, in seconds, after which a session
+                            is checked before use (None to never check).
+        retries           : Number of times run() retries on a new
+                            connection after a connection error.
+        backoff           : Delay before the first retry, doubled for
+                            each following one up to max_backoff.
+        failure_threshold : Consecutive connection failures after which
+                            requests to a server fail fast.
+        reset_timeout     : Seconds during which they fail fast.
+        client_class      : Class of the pooled clients; the remaining
+                            keyword arguments (timeout, deadline,
+                            transport...) are passed to it.
+        """
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._client_class = client_class
+        self._client_kwargs = client_kwargs
+        self._idle = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._keepalive_thread = None
+        self._closed = threading.Event()
+
+    def _breaker(self, host, port):
+        with self._lock:
+            breaker = self._breakers.get((host, port))
+            if breaker is None:
+                breaker = self._breakers[(host, port)] = _CircuitBreaker()
+            return breaker
+
+    def _failure(self, breaker):
+        with self._lock:
+            breaker.failure(self.failure_threshold, self.reset_timeout)
+
+    def _acquire(self, host, port, login, password):
+        breaker = self._breaker(host, port)
+        if not breaker.allow():
+            raise PyNUTCircuitOpenError("%s:%s is failing, not trying to "
+                                        "connect." % (host, port))
+
+        key = (host, port, login)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                client, last_used = idle.pop()
+            if (self.keepalive is None or
+                    time.monotonic() - last_used < self.keepalive):
+                return client
+            try:
+                client.ver()
+                return client
+            except PyNUTConnectionError:
+                client.close()
+
+        try:
+            client = self._client_class(host, port, login, password,
+                                        **self._client_kwargs)
+        except PyNUTConnectionError:
+            self._failure(breaker)
+            raise
+        with self._lock:
+            breaker.success()
+        return client
+
+    def _release(self, key, client):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle and not self._closed.is_set():
+                idle.append((client, time.monotonic()))
+                return
+        client.close()
+
+    @contextlib.contextmanager
+    def connection(self, host, port=3493, login=None, password=None):
+        """Context manager borrowing a connected client from the pool.
+
+        The client goes back to the pool at the end of the block, unless
+        it raised PyNUTConnectionError.
+        """
+        client = self._acquire(host, port, login, password)
+        try:
+            yield client
+        except PyNUTConnectionError:
+            client.close()
+            self._failure(self._breaker(host, port))
+            raise
+        except BaseException:
+            self._release((host, port, login), client)
+            raise
+        self._release((host, port, login), client)
+
+    def run(self, func, host, port=3493, login=None, password=None):
+        """Return func(client) for a client borrowed from the pool.
+
+        On PyNUTConnectionError, func is called again with a new
+        connection, up to retries times with exponential backoff. func
+        may thus run more than once, which is to be kept in mind for
+        requests that are not idempotent, like run_command or fsd.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.connection(host, port, login, password) as client:
+                    return func(client)
+            except PyNUTCircuitOpenError:
+                raise
+            except PyNUTConnectionError:
+                if attempt >= self.retries:
+                    raise
+                time.sleep(min(self.max_backoff, self.backoff * 2 ** attempt))
+                attempt += 1
+
+    def client(self, host, port=3493, login=None, password=None):
+        """Return an object with the request methods of PyNUTClient
+        (list_vars, get_var, ...), each run through run().
+        """
+        return _PooledClient(self, host, port, login, password)
+
+    def keepalive_idle(self):
+        """Check the sessions idle for more than keepalive seconds with a
+        VER request, and drop the dead ones. Does nothing if keepalive
+        is None.
+        """
+        if self.keepalive is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            stale = []
+            for key, idle in self._idle.items():
+                for entry in list(idle):
+                    if now - entry[1] >= self.keepalive:
+                        idle.remove(entry)
+                        stale.append((key, entry[0]))
+        for key, client in stale:
+            try:
+                client.ver()
+            except PyNUTConnectionError:
+                client.close()
+            else:
+                self._release(key, client)
+
+    def start_keepalive(self):
+        """Run keepalive_idle() every keepalive seconds in a daemon thread,
+        until close() is called (not if keepalive is None).
+        """
+        if self.keepalive is None:
+            return
+
+        def run():
+            while not self._closed.wait(self.keepalive):
+                self.keepalive_idle()
+
+        if self._keepalive_thread is None:
+            self._keepalive_thread = threading.Thread(target=run)
+            self._keepalive_thread.daemon = True
+            self._keepalive_thread.start()
+
+    def close(self):
+        """Close all idle sessions, and stop the keepalive thread."""
+        self._closed.set()
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for sessions in idle.values():
+            for client, _ in sessions:
+                client.close()
+
+
+class _PooledClient(object):
+    """PyNUTClient look-alike running each request through a pool."""
+
+    def __init__(self, pool, host, port, login, password):
+        self._pool = pool
+        self._target = (host, port, login, password)
+
+    def __getattr__(self, name):
+        if (name.startswith('_') or name.startswith('iter_') or
+                name in ('watch', 'pipeline', 'deadline', 'close') or
+                not callable(getattr(PyNUTClient, name, None))):
+            raise AttributeError("%s is not available on pooled clients, "
+                                 "use ConnectionPool.connection()" % name)
+
+        def method(*args, **kwargs):
+            return self._pool.run(
+                lambda client: getattr(client, name)(*args, **kwargs),
+                *self._target)
+        method.__name__ = name
+        return method
+
+
+class AsyncPyNUTClient(object):
+    """Access NUT (Network UPS Tools) servers from asyncio code.
+
+    The API mirrors PyNUTClient, except that every method is a
+    coroutine and the connection is opened explicitly, either with
+    ``await client.connect()`` or by using the client as an async
+    context manager::
+
+        async with AsyncPyNUTClient("upsd.example.com") as client:
+            ups_vars = await client.list_vars("My_UPS")
+    """
+
+    def __init__(self, host="127.0.0.1", port=3493, login=None, password=None, debug=False, timeout=5):
+        """Class initialization method.
+
+        The arguments have the same meaning as for PyNUTClient.
+        """
+        if debug:
+            # Print DEBUG messages to the console.
+            logging.getLogger().setLevel(logging.DEBUG)
+
+        logging.debug("Class initialization...")
+        logging.debug(" -> Host = %s (port %s)", host, port)
+
+        self._host = host
+        self._port = port
+        self._login = login
+        self._password = password
+        self._timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_t, exc_v, trace):
+        await self.close()
+
+    async def connect(self):
+        """Connects to the defined server.
+
+        If login/pass was specified, the client tries to authenticate.
+        An error is raised if something goes wrong.
+        """
+        logging.debug("Connecting to host")
+
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self._host, self._port),
+                self._timeout)
+        except (OSError, asyncio.TimeoutError):
+            raise PyNUTConnectionError("Socket error.")
+        # Replies are matched to requests by order, so concurrent
+        # coroutines must not interleave their exchanges.
+        self._lock = asyncio.Lock()
+
+        try:
+            for query in _login_queries(self._login, self._password):
+                await self._execute(query)
+        except PyNUTError:
+            await self.close()
+            raise
+
+    async def close(self):
+        """Log out and close the connection to the server."""
+        if self._writer is None:
+            return
+        writer, self._writer, self._reader = self._writer, None, None
+        try:
+            writer.write(b"LOGOUT\n")
+            writer.close()
+            await writer.wait_closed()
+        except OSError:
+            # The socket is already disconnected.
+            pass
+
+    async def _readline(self):
+        try:
+            line = await asyncio.wait_for(self._reader.readuntil(b"\n"),
+                                          self._timeout)
+        except asyncio.TimeoutError:
+            raise PyNUTTimeoutError("Timed out waiting for the server.")
+        except (asyncio.IncompleteReadError, OSError):
+            raise PyNUTConnectionError("Socket error.")
+        return line.decode('utf-8')
+
+    async def _execute(self, query):
+        """Send a single query and return its parsed reply."""
+        if self._writer is None:
+            raise PyNUTError("Not connected.")
+        async with self._lock:
+            self._writer.write(query.line)
+            result = await self._read_reply(query)
+        return query.parse(result)
+
+    async def _execute_many(self, queries):
+        """Send all queries in a single write, then read their replies."""
+        if self._writer is None:
+            raise PyNUTError("Not connected.")
+        async with self._lock:
+            self._writer.write(b"".join(query.line for query in queries))
+            replies = []
+            for query in queries:
+                try:
+                    replies.append(await self._read_reply(query))
+                except PyNUTConnectionError:
+                    raise
+                except PyNUTError as err:
+                    replies.append(err)
+        results = []
+        for query, reply in zip(queries, replies):
+            if not isinstance(reply, PyNUTError):
+                try:
+                    reply = query.parse(reply)
+                except PyNUTError as err:
+                    reply = err
+            results.append(reply)
+        return results
+
+    async def _read_reply(self, query):
+        """Read the complete reply to ``query`` from the server."""
+        result = await self._readline()
+        if query.begin is None:
+            return result
+        if result != query.begin:
+            raise PyNUTError(result.replace("\n", ""))
+
+        # Read line by line, so large replies are not limited by the
+        # stream reader's buffer size.
+        end = query.end.decode('utf-8')
+        lines = []
+        while True:
+            line = await self._readline()
+            lines.append(line)
+            if line == end:
+                return "".join(lines)
+
+    def pipeline(self):
+        """Return an AsyncPipeline to send several requests in one round
+        trip.
+        """
+        return AsyncPipeline(self)
+
+    async def description(self, ups):
+        """Returns the description for a given UPS."""
+        return await self._execute(_description_query(ups))
+
+    async def list_ups(self):
+        """Returns the list of available UPS from the NUT server."""
+        return await self._execute(_list_ups_query())
+
+    async def list_vars(self, ups):
+        """Get all available vars from the specified UPS."""
+        return await self._execute(_list_vars_query(ups))
+
+    async def list_commands(self, ups, describe=True):
+        """Get all available commands for the specified UPS."""
+        commands = await self._execute(_list_cmd_query(ups))
+        if not describe:
+            return commands
+        if not commands:
+            return {}
+
+        return dict(zip(commands, await self._execute_many(
+            [_cmddesc_fallback_query(ups, command) for command in commands])))
+
+    async def list_clients(self, ups=None):
+        """Returns the list of connected clients from the NUT server."""
+        if ups and (ups not in await self.list_ups()):
+            raise PyNUTError("%s is not a valid UPS" % ups)
+
+        return await self._execute(_list_clients_query(ups))
+
+    async def list_rw_vars(self, ups):
+        """Get a list of all writable vars from the selected UPS."""
+        return await self._execute(_list_rw_vars_query(ups))
+
+    async def list_enum(self, ups, var):
+        """Get a list of valid values for an enum variable."""
+        return await self._execute(_list_values_query("ENUM", ups, var))
+
+    async def list_range(self, ups, var):
+        """Get a list of valid values for an range variable."""
+        return await self._execute(_list_values_query("RANGE", ups, var))
+
+    async def set_var(self, ups, var, value):
+        """Set a variable to the specified value on selected UPS."""
+        await self._execute(_set_var_query(ups, var, value))
+
+    async def get_var(self, ups, var):
+        """Get the value of a variable."""
+        return await self._execute(_get_var_query(ups, var))
+
+    # Alias for convenience
+    async def get(self, ups, var):
+        """Get the value of a variable (alias for get_var)."""
+        return await self.get_var(ups, var)
+
+    async def var_description(self, ups, var):
+        """Get a variable's description."""
+        return await self._execute(_var_description_query(ups, var))
+
+    async def var_type(self, ups, var):
+        """Get a variable's type."""
+        return await self._execute(_var_type_query(ups, var))
+
+    async def command_description(self, ups, command):
+        """Get a command's description."""
+        return await self._execute(_command_description_query(ups, command))
+
+    async def run_command(self, ups, command):
+        """Send a command to the specified UPS."""
+        await self._execute(_run_command_query(ups, command))
+
+    async def fsd(self, ups):
+        """Send MASTER and FSD commands."""
+        await self._execute(_master_query(ups))
+        await self._execute(_fsd_query(ups))
+
+    async def num_logins(self, ups):
+        """Send GET NUMLOGINS command to get the number of users logged
+        into a given UPS.
+        """
+        return await self._execute(_num_logins_query(ups))
+
+    async def help(self):
+        """Send HELP command."""
+        return await self._execute(_single(b"HELP\n", _raw))
+
+    async def ver(self):
+        """Send VER command."""
+        return await self._execute(_single(b"VER\n", _raw))
+
+
+# A NUT server polled by FleetPoller.
+FleetTarget = collections.namedtuple('FleetTarget', 'host port login password')
+FleetTarget.__new__.__defaults__ = (3493, None, None)
+
+# The outcome of polling one FleetTarget: ``ups_vars`` maps each UPS to
+# its variables, ``ups_errors`` maps the UPS that could not be read to
+# their PyNUTError, and ``error`` is set when the whole server failed.
+# ``elapsed`` is the time spent on the server, in seconds.
+PollResult = collections.namedtuple('PollResult',
+                                    'target ups_vars ups_errors error elapsed')
+
+
+class FleetPoller(object):
+    """Poll the UPS of many NUT servers concurrently.
+
+    Every server is polled with LIST UPS, then one pipelined batch of
+    LIST VAR requests, over a session that is kept open between polls.
+    At most concurrency servers are polled at the same time, and a
+    failing server is reported in its PollResult without affecting the
+    others (its session is reopened on the next poll).
+
+    From asyncio code, iterate over poll(); from blocking code, call
+    sweep(). A poller should only be used from one of them::
+
+        poller = FleetPoller([("ups1.example.com",),
+                              ("ups2.example.com", 3493, "user", "pass")])
+        for result in poller.sweep():
+            print(result.target.host, result.error or result.ups_vars)
+    """
+
+    def __init__(self, targets, concurrency=64, timeout=5):
+        """targets     : Sequence of (host, port, login, password) tuples;
+                      the trailing items may be omitted.
+        concurrency : Maximum number of servers polled at once (defaults
+                      to 64).
+        timeout     : Timeout used for each network operation (defaults
+                      to 5 seconds).
+        """
+        self.targets = [FleetTarget(*target) for target in targets]
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.last_sweep_time = None
+        self._sessions = {}
+        self._loop = None
+
+    async def _session(self, target):
+        client = self._sessions.get(target)
+        if client is None:
+            client = AsyncPyNUTClient(target.host, target.port, target.login,
+                                      target.password, timeout=self.timeout)
+            await client.connect()
+            self._sessions[target] = client
+        return client
+
+    async def _drop(self, target):
+        client = self._sessions.pop(target, None)
+        if client is not None:
+            await client.close()
+
+    async def _poll_target(self, target, semaphore):
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                client = await self._session(target)
+                ups_names = list(await client.list_ups())
+                pipe = client.pipeline()
+                for ups in ups_names:
+                    pipe.list_vars(ups)
+                results = await pipe.execute(raise_on_error=False)
+            except asyncio.CancelledError:
+                # The exchange may have been interrupted half way.
+                await self._drop(target)
+                raise
+            except Exception as err:
+                # Whatever went wrong with this server, the others are
+                # still polled.
+                await self._drop(target)
+                return PollResult(target, {}, {}, _wrap_error(err),
+                                  time.monotonic() - start)
+
+            ups_vars, ups_errors = {}, {}
+            for ups, result in zip(ups_names, results):
+                if isinstance(result, PyNUTError):
+                    ups_errors[ups] = result
+                else:
+                    ups_vars[ups] = result
+            return PollResult(target, ups_vars, ups_errors, None,
+                              time.monotonic() - start)
+
+    async def poll(self):
+        """Poll all the targets, and yield their PollResult as they
+        complete.
+        """
+        start = time.monotonic()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [asyncio.ensure_future(self._poll_target(target, semaphore))
+                 for target in self.targets]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
+        self.last_sweep_time = time.monotonic() - start
+
+    async def aclose(self):
+        """Close all the sessions."""
+        sessions, self._sessions = self._sessions, {}
+        for client in sessions.values():
+            await client.close()
+
+    def sweep(self):
+        """Blocking version of poll(), returning the list of results in
+        the order they completed.
+        """
+        async def collect():
+            return [result async for result in self.poll()]
+
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(collect())
+
+    def close(self):
+        """Close all the sessions opened by sweep()."""
+        if self._loop is not None:
+            self._loop.run_until_complete(self.aclose())
+            self._loop.close()
+            self._loop = None
+
+
+# A UPS targeted by FleetExecutor.
+ActionTarget = collections.namedtuple('ActionTarget',
+                                      'host ups port login password')
+ActionTarget.__new__.__defaults__ = (3493, None, None)
+
+# The outcome of an action on one ActionTarget: ``error`` is the
+# PyNUTError it failed with (None if it succeeded), and ``elapsed`` the
+# time from the start of the fan-out to the reply, in seconds.
+ActionResult = collections.namedtuple('ActionResult', 'target error elapsed')
+
+
+class FleetExecutor(object):
+    """Run set_var, run_command or fsd on many UPS at once.
+
+    The targets are grouped by server (and credentials). Each server
+    gets up to per_host connections at a time, whatever credentials
+    they use, over which its UPS are spread; each connection sends the
+    requests for all its UPS in a single pipelined write. Servers are all handled
+    concurrently, so the whole fleet gets the command within about one
+    connection setup and one round trip.
+
+    The coroutines return one ActionResult per target, in the order of
+    the targets. Targets not done within deadline seconds get a
+    PyNUTTimeoutError::
+
+        executor = FleetExecutor(deadline=5)
+        report = asyncio.run(executor.fsd(
+            [("nas1", "ups1"), ("nas2", "ups1", 3493, "admin", "secret")]))
+        failed = [result for result in report if result.error]
+    """
+
+    def __init__(self, per_host=4, timeout=5, deadline=10):
+        """per_host : Maximum number of connections to each server.
+        timeout  : Timeout used for each network operation (defaults to
+                   5 seconds).
+        deadline : Time, in seconds, within which the whole fan-out must
+                   be done (None for no limit).
+        """
+        self.per_host = per_host
+        self.timeout = timeout
+        self.deadline = deadline
+
+    async def set_var(self, targets, var, value):
+        """Set var to value on each target, a sequence of (host, ups,
+        port, login, password) tuples (the trailing items may be omitted).
+        """
+        return await self._fan_out("set_var", targets, lambda ups: [
+            _set_var_query(ups, var, value)])
+
+    async def run_command(self, targets, command):
+        """Run command on each target (see set_var)."""
+        return await self._fan_out("run_command", targets, lambda ups: [
+            _run_command_query(ups, command)])
+
+    async def fsd(self, targets):
+        """Send MASTER and FSD commands to each target (see set_var)."""
+        return await self._fan_out("fsd", targets, lambda ups: [
+            _master_query(ups), _fsd_query(ups)])
+
+    async def _fan_out(self, operation, targets, queries):
+        targets = [ActionTarget(*target) for target in targets]
+        start = time.monotonic()
+        servers = collections.OrderedDict()
+        for index, target in enumerate(targets):
+            key = (target.host, target.port, target.login, target.password)
+            servers.setdefault(key, []).append(index)
+
+        results = {}
+        tasks = []
+        limits = {}
+        for key, indexes in servers.items():
+            limit = limits.get(key[:2])
+            if limit is None:
+                limit = limits[key[:2]] = asyncio.Semaphore(self.per_host)
+            count = min(self.per_host, len(indexes))
+            for i in range(count):
+                batch = [(index, targets[index])
+                         for index in indexes[i::count]]
+                tasks.append(asyncio.ensure_future(self._run_batch(
+                    key, limit, batch, queries, results, start)))
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=self.deadline)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+        elapsed = time.monotonic() - start
+        report = []
+        for index, target in enumerate(targets):
+            result = results.get(index)
+            if result is None:
+                # Only the batches cancelled at the deadline have no
+                # result.
+                error = PyNUTTimeoutError(
+                    "%s exceeded its deadline of %.3gs." % (
+                        operation, self.deadline or 0), operation, elapsed)
+                result = ActionResult(target, error, elapsed)
+            report.append(result)
+        return report
+
+    async def _run_batch(self, key, limit, batch, queries, results,
+                         start):
+        """Send the queries for a batch of (index, target) of one server
+        over one connection, once the server's semaphore limit lets it,
+        and store their ActionResult in results.
+        """
+        async with limit:
+            await self._send_batch(key, batch, queries, results, start)
+
+    async def _send_batch(self, key, batch, queries, results, start):
+        client = AsyncPyNUTClient(*key, timeout=self.timeout)
+        try:
+            await client.connect()
+            requests = [queries(target.ups) for _, target in batch]
+            replies = iter(await client._execute_many(
+                [query for target_queries in requests
+                 for query in target_queries]))
+            elapsed = time.monotonic() - start
+            for (index, target), target_queries in zip(batch, requests):
+                errors = [reply for _, reply in zip(target_queries, replies)
+                          if isinstance(reply, PyNUTError)]
+                results[index] = ActionResult(
+                    target, errors[0] if errors else None, elapsed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            elapsed = time.monotonic() - start
+            error = _wrap_error(err)
+            for index, target in batch:
+                results.setdefault(index, ActionResult(target, error,
+                                                       elapsed))
+        finally:
+            await client.close()
+
+
+# Layout of a ShardedPoller result slot: a sequence number, odd while
+# the slot is being written, then the poll time (time.time()), the
+# time spent polling, the length of the data and its kind (one of the
+# _SLOT_* values), then the data. The data of a poll is a run of
+# NUL-terminated fields, with for each UPS either "+" and its name, its
+# var, value pairs and an empty field, or "!" and its name followed by
+# the error it could not be read with. That of a failure is the error
+# message.
+_SLOT_SEQ = struct.Struct('<Q')
+_SLOT_HEADER = struct.Struct('<ddIB')
+_SLOT_DATA = _SLOT_SEQ.size + _SLOT_HEADER.size
+_SLOT_VARS = 1
+_SLOT_ERROR = 2
+
+
+def _write_slot(buf, offset, size, started, elapsed, kind, data):
+    """Publish data into a slot of buf, seqlock style."""
+    if len(data) > size - _SLOT_DATA:
+        kind = _SLOT_ERROR
+        data = b"Poll result too large for its slot."
+    seq = _SLOT_SEQ.unpack_from(buf, offset)[0]
+    # A worker killed while writing leaves the sequence odd.
+    seq += seq & 1
+    _SLOT_SEQ.pack_into(buf, offset, seq + 1)
+    _SLOT_HEADER.pack_into(buf, offset + _SLOT_SEQ.size, started, elapsed,
+                           len(data), kind)
+    buf[offset + _SLOT_DATA:offset + _SLOT_DATA + len(data)] = data
+    _SLOT_SEQ.pack_into(buf, offset, seq + 2)
+
+
+def _read_slot(buf, offset, timeout=0.1):
+    """Return (started, elapsed, kind, data) from a slot of buf, or None
+    if it was never written. A slot still being written after timeout
+    seconds (its worker was killed while writing) is reported as an
+    error.
+    """
+    expires = time.monotonic() + timeout
+    while True:
+        seq = _SLOT_SEQ.unpack_from(buf, offset)[0]
+        if seq == 0:
+            return None
+        if seq % 2:
+            if time.monotonic() > expires:
+                return (0.0, 0.0, _SLOT_ERROR,
+                        b"Poll result left half written.")
+            time.sleep(0)
+            continue
+        started, elapsed, length, kind = _SLOT_HEADER.unpack_from(
+            buf, offset + _SLOT_SEQ.size)
+        data = bytes(buf[offset + _SLOT_DATA:offset + _SLOT_DATA + length])
+        if _SLOT_SEQ.unpack_from(buf, offset)[0] == seq:
+            return started, elapsed, kind, data
+
+
+def _poll_shard(shard, name, size, targets, commands, done,
+                client_kwargs):
+    """Worker process shard of a ShardedPoller: poll targets, a list of
+    (slot, FleetTarget), whenever a round number arrives on commands,
+    then put (shard, round) on done.
+    """
+    memory = shared_memory.SharedMemory(name)
+    sessions = {}
+    try:
+        for round_ in iter(commands.get, None):
+            for slot, target in targets:
+                started = time.time()
+                start = time.monotonic()
+                try:
+                    client = sessions.get(target)
+                    if client is None:
+                        client = sessions[target] = PyNUTClient(
+                            target.host, target.port, target.login,
+                            target.password, **client_kwargs)
+                    ups_list = list(client.list_ups())
+                    results = client._execute_many(
+                        [_list_vars_query(ups) for ups in ups_list])
+                    fields = []
+                    for ups, result in zip(ups_list, results):
+                        if isinstance(result, PyNUTError):
+                            fields.extend(("!" + ups, str(result)))
+                        else:
+                            fields.append("+" + ups)
+                            for item in result.items():
+                                fields.extend(item)
+                            fields.append("")
+                    kind, data = _SLOT_VARS, "".join(
+                        field + "\0" for field in fields)
+                except Exception as err:
+                    # Whatever went wrong with this server, the others are
+                    # still polled.
+                    client = sessions.pop(target, None)
+                    if client is not None:
+                        client.close()
+                    kind, data = _SLOT_ERROR, str(_wrap_error(err))
+                _write_slot(memory.buf, slot * size, size, started,
+                            time.monotonic() - start, kind,
+                            data.encode('utf-8', 'replace'))
+            done.put((shard, round_))
+    finally:
+        for client in sessions.values():
+            client.close()
+        memory.close()
+
+
+class ShardedPoller(object):
+    """Poll the UPS of many NUT servers from several processes.
+
+    The servers are spread over processes worker processes, each polling
+    its share with its own PyNUTClient sessions (LIST UPS, then one
+    pipelined batch of LIST VAR), so that parsing runs on several
+    cores. Workers publish each result into a slot of slot_size bytes in
+    a shared memory block, rather than sending it pickled; the parent
+    only copies and decodes the slots it reads.
+
+    Results are PollResult tuples, as for FleetPoller::
+
+        with ShardedPoller(targets, processes=8) as poller:
+            for result in poller.sweep():
+                print(result.target.host, result.error or result.ups_vars)
+
+    If a worker process dies, the servers of its shard are reported as
+    failed by the sweep, and it is started again by the next one.
+
+    Requires Python 3.8 (multiprocessing.shared_memory).
+    """
+
+    def __init__(self, targets, processes=None, slot_size=65536,
+                 context=None, **client_kwargs):
+        """targets     : Sequence of (host, port, login, password) tuples;
+                      the trailing items may be omitted.
+        processes   : Number of worker processes (defaults to the number
+                      of CPUs, at most one per server).
+        slot_size   : Bytes available for the result of one server; a
+                      larger result is reported as an error.
+        context     : multiprocessing context used to start the workers
+                      (defaults to the default one).
+
+        The other keyword arguments (timeout, deadline...) are passed to
+        the PyNUTClient of the workers.
+        """
+        if shared_memory is None:
+            raise PyNUTError("ShardedPoller requires Python 3.8+.")
+        self.targets = [FleetTarget(*target) for target in targets]
+        self.processes = max(1, min(processes or os.cpu_count() or 1,
+                                    len(self.targets)))
+        self.slot_size = slot_size
+        self._context = context or multiprocessing.get_context()
+        self._client_kwargs = client_kwargs
+        self._memory = None
+        self._workers = []
+        self._round = 0
+
+    def _start_worker(self, shard):
+        commands = self._context.Queue()
+        targets = [(slot, self.targets[slot]) for slot in
+                   range(shard, len(self.targets), self.processes)]
+        process = self._context.Process(
+            target=_poll_shard,
+            args=(shard, self._memory.name, self.slot_size, targets,
+                  commands, self._done, self._client_kwargs))
+        process.daemon = True
+        process.start()
+        return process, commands
+
+    def start(self):
+        """Start the worker processes (done by the first sweep())."""
+        if self._memory is not None:
+            return
+        self._memory = shared_memory.SharedMemory(
+            create=True, size=max(1, len(self.targets)) * self.slot_size)
+        self._done = self._context.Queue()
+        self._workers = [self._start_worker(shard)
+                         for shard in range(self.processes)]
+
+    def sweep(self):
+        """Poll all the servers once, and return their PollResult, in
+        the order of targets.
+        """
+        self.start()
+        for shard, (process, _) in enumerate(self._workers):
+            if not process.is_alive():
+                process.join()
+                self._workers[shard] = self._start_worker(shard)
+        self._round += 1
+        for _, commands in self._workers:
+            commands.put(self._round)
+
+        pending = set(range(len(self._workers)))
+        dead = set()
+        while pending:
+            try:
+                shard, round_ = self._done.get(timeout=0.1)
+            except queue.Empty:
+                # Do not wait for workers which died in the meantime.
+                for shard in list(pending):
+                    if not self._workers[shard][0].is_alive():
+                        pending.discard(shard)
+                        dead.add(shard)
+                continue
+            if round_ == self._round:
+                pending.discard(shard)
+
+        # The slots of a dead worker are not read: it may have died
+        # while writing one.
+        return [PollResult(target, {}, {}, PyNUTError(
+                    "The worker process polling %s:%s died." % (
+                        target.host, target.port)), 0)
+                if index % self.processes in dead else self.read(index)
+                for index, target in enumerate(self.targets)]
+
+    def read(self, index):
+        """Return the last PollResult of targets[index] (None if it was
+        never polled), without polling it.
+        """
+        slot = _read_slot(self._memory.buf, index * self.slot_size)
+        if slot is None:
+            return None
+        _, elapsed, kind, data = slot
+        text = data.decode('utf-8')
+        if kind == _SLOT_ERROR:
+            return PollResult(self.targets[index], {}, {},
+                              PyNUTError(text), elapsed)
+        ups_vars = {}
+        ups_errors = {}
+        fields = iter(text.split("\0"))
+        for field in fields:
+            if field.startswith("!"):
+                ups_errors[field[1:]] = PyNUTError(next(fields))
+            elif field.startswith("+"):
+                variables = ups_vars[field[1:]] = {}
+                for var in iter(fields.__next__, ""):
+                    variables[var] = next(fields)
+        return PollResult(self.targets[index], ups_vars, ups_errors, None,
+                          elapsed)
+
+    def close(self):
+        """Stop the workers and release the shared memory."""
+        for _, commands in self._workers:
+            commands.put(None)
+        for process, _ in self._workers:
+            process.join()
+        self._workers = []
+        if self._memory is not None:
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, trace):
+        self.close()
+
+
+class FleetColumns(object):
+    """Latest variables of many UPS, stored by column for analytics.
+
+    Each UPS has a row (ups lists their keys, like (host, port, ups)
+    for poll results), and each numeric variable a column: a contiguous
+    float64 array with a value per row, along with a mask telling which
+    rows have one. Missing values are nan in the column and False in
+    the mask. Other variables are kept as lists of strings (None where
+    missing) in text.
+
+    Columns are numpy arrays when numpy is installed, sharing memory
+    with the array.array they were built into, which are exposed
+    otherwise::
+
+        columns = FleetColumns.from_results(poller.sweep())
+        load = columns["ups.load"][columns.mask("ups.load")].mean()
+        low = [key for key, charge in zip(columns.ups,
+                                          columns["battery.charge"])
+               if charge < 20]
+    """
+
+    def __init__(self, rows, vars=None):
+        """rows : Iterable of (key, ups_vars) pairs, ups_vars being a
+               mapping like the result of list_vars or a UPSSnapshot.
+        vars : Optional names of the only variables to collect.
+        """
+        rows = list(rows)
+        count = len(rows)
+        self.ups = [key for key, _ in rows]
+        wanted = frozenset(vars) if vars is not None else None
+        numbers = {}
+        masks = {}
+        text = {}
+        for row, (_, ups_vars) in enumerate(rows):
+            for var, value in ups_vars.items():
+                if wanted is not None and var not in wanted:
+                    continue
+                try:
+                    number = float(value)
+                except ValueError:
+                    if var not in numbers:
+                        if var not in text:
+                            text[var] = [None] * count
+                        text[var][row] = value
+                    continue
+                column = numbers.get(var)
+                if column is None:
+                    column = numbers[var] = array.array('d', [math.nan]) * \
+                        count
+                    masks[var] = array.array('B', [0]) * count
+                    # Values read before the variable was seen numeric
+                    # are missing from the column.
+                    text.pop(var, None)
+                column[row] = number
+                masks[var][row] = 1
+        self.names = sorted(numbers)
+        self.text = text
+        if numpy is not None:
+            numbers = dict((var, numpy.frombuffer(column, numpy.float64))
+                           for var, column in numbers.items())
+            masks = dict((var, numpy.frombuffer(mask, numpy.bool_))
+                         for var, mask in masks.items())
+        self._numbers = numbers
+        self._masks = masks
+
+    @classmethod
+    def from_results(cls, results, vars=None):
+        """Build the columns of the UPS read in a list of PollResult (as
+        returned by FleetPoller.sweep or ShardedPoller.sweep), keyed by
+        (host, port, ups).
+        """
+        return cls((((result.target.host, result.target.port, ups),
+                     ups_vars)
+                    for result in results if result.ups_vars
+                    for ups, ups_vars in sorted(result.ups_vars.items())),
+                   vars)
+
+    def __len__(self):
+        return len(self.ups)
+
+    def __contains__(self, var):
+        return var in self._numbers
+
+    def __getitem__(self, var):
+        """Return the column of a numeric variable."""
+        return self._numbers[var]
+
+    def mask(self, var):
+        """Return the mask of the rows having a value of var."""
+        return self._masks[var]
+
+    def row(self, key):
+        """Return the index of the row of a UPS."""
+        return self.ups.index(key)
+
+
+# An upstream server of a NUTProxy. Its UPS are served under their own
+# name prefixed with ``prefix``.
+ProxyUpstream = collections.namedtuple('ProxyUpstream',
+                                       'host port login password prefix')
+ProxyUpstream.__new__.__defaults__ = (3493, None, None, "")
+
+# A word or a quoted value of a request line.
+_REQUEST_WORD = re.compile(_VALUE + r'|([^ "\r\n]+)')
+
+
+def _request_words(line):
+    """Split a request line into its words, unquoting quoted values."""
+    return [_unescape(quoted) if quoted else word
+            for quoted, word in _REQUEST_WORD.findall(line)]
+
+
+def _error_reply(err):
+    """Return the ERR line relaying a PyNUTError to a proxy client."""
+    if isinstance(err, PyNUTConnectionError):
+        return "ERR DRIVER-NOT-CONNECTED\n"
+    message = str(err)
+    if message.startswith("ERR "):
+        return message + "\n"
+    return "ERR ACCESS-DENIED\n"
+
+
+class _ProxyFetch(object):
+    """An upstream request of a NUTProxy, whose outcome is shared by
+    all the clients missing the same cache entry meanwhile.
+    """
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _ProxySession(object):
+    """State of one client connection to a NUTProxy."""
+
+    __slots__ = ('login', 'password')
+
+    def __init__(self):
+        self.login = None
+        self.password = None
+
+
+class _ProxyHandler(socketserver.StreamRequestHandler):
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        proxy = self.server.proxy
+        session = _ProxySession()
+        for line in self.rfile:
+            words = _request_words(line.decode('utf-8', 'replace'))
+            if words == ["LOGOUT"]:
+                self.wfile.write(b"OK Goodbye\n")
+                break
+            self.wfile.write(proxy.reply(session, words).encode('utf-8'))
+
+
+class _ProxyServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class NUTProxy(object):
+    """NUT server relaying the UPS of one or more upstream servers.
+
+    Clients (upsmon, upsc, dashboards...) connect to the proxy as they
+    would to upsd. Reads are answered from a cache filled through a few
+    pooled upstream sessions: LIST UPS, LIST VAR and GET VAR (answered
+    from the LIST VAR of the UPS) for ttl seconds, other metadata like
+    GET TYPE or LIST CMD for meta_ttl seconds.
+
+    SET VAR, INSTCMD, MASTER and FSD are sent straight to the upstream
+    server, on a connection authenticated with the USERNAME and PASSWORD
+    the client gave to the proxy, and the reply is relayed. They drop
+    the cached data of the UPS.
+
+    While an entry is being fetched from upstream, the clients missing
+    it wait for that fetch rather than sending the same request.
+
+    The UPS of all the upstream servers are served together, each under
+    the prefix of its upstream::
+
+        proxy = NUTProxy([("nas1", 3493, "monuser", "secret", "nas1-"),
+                          ("nas2", 3493, "monuser", "secret", "nas2-")],
+                         port=3493)
+        proxy.serve_forever()
+
+    The upstream credentials are used for reads only.
+    """
+
+    def __init__(self, upstreams, host="127.0.0.1", port=3493, ttl=2,
+                 meta_ttl=300, max_idle=2, **client_kwargs):
+        """upstreams : Sequence of (host, port, login, password, prefix)
+                    tuples; the trailing items may be omitted.
+        host      : Address to listen on (defaults to 127.0.0.1).
+        port      : Port to listen on (defaults to 3493, 0 to pick one).
+        ttl       : Seconds during which UPS lists and variables are
+                    served from the cache.
+        meta_ttl  : Same for the other, static, data.
+        max_idle  : Upstream sessions kept per upstream server.
+
+        The other keyword arguments (timeout, transport...) are passed
+        to the upstream PyNUTClient.
+        """
+        self.upstreams = [ProxyUpstream(*upstream) for upstream in upstreams]
+        self.ttl = ttl
+        self.meta_ttl = meta_ttl
+        self.hits = 0
+        self.misses = 0
+        self.pool = ConnectionPool(max_idle=max_idle, **client_kwargs)
+        self._client_kwargs = client_kwargs
+        self._cache = {}
+        self._fetches = {}
+        self._lock = threading.Lock()
+        self._server = _ProxyServer((host, port), _ProxyHandler)
+        self._server.proxy = self
+        self._serving = False
+        self._thread = None
+
+    @property
+    def address(self):
+        """The (host, port) the proxy listens on."""
+        return self._server.server_address[:2]
+
+    def start(self):
+        """Serve clients in a background thread."""
+        self._serving = True
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """Serve clients until shutdown() is called."""
+        self._serving = True
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stop serving, and close the upstream sessions."""
+        if self._serving:
+            self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        self.pool.close()
+
+    def invalidate(self, upstream=None, ups=None):
+        """Drop the cached data of a UPS (of all the UPS of upstream if
+        ups is None, of everything if upstream is None too).
+        """
+        with self._lock:
+            for key in list(self._cache):
+                if (upstream is None or (key[0] == upstream and
+                                         (ups is None or key[2] == ups))):
+                    del self._cache[key]
+
+    def _cached(self, upstream, method, ups, *args):
+        """Return the result of a PyNUTClient method called on upstream,
+        from the cache if it is fresh enough.
+        """
+        key = (upstream, method, ups) + args
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            fetch = self._fetches.get(key)
+            if fetch is None:
+                fetch = self._fetches[key] = _ProxyFetch()
+                self.misses += 1
+                leader = True
+            else:
+                self.hits += 1
+                leader = False
+
+        if not leader:
+            # Another client is already asking upstream: share its reply.
+            fetch.done.wait()
+            if fetch.error is not None:
+                raise fetch.error
+            return fetch.result
+
+        call_args = (ups,) + args if ups is not None else args
+        try:
+            fetch.result = self.pool.run(
+                lambda client: getattr(client, method)(*call_args),
+                upstream.host, upstream.port, upstream.login,
+                upstream.password)
+        except Exception as err:
+            fetch.error = err
+            raise
+        finally:
+            ttl = self.ttl if method in ('list_ups', 'list_vars') else \
+                self.meta_ttl
+            with self._lock:
+                if fetch.error is None:
+                    self._cache[key] = (time.monotonic() + ttl, fetch.result)
+                del self._fetches[key]
+            fetch.done.set()
+        return fetch.result
+
+    def list_ups(self):
+        """Return {name: (upstream, upstream UPS name, description)} for
+        the UPS of all the upstream servers that could be reached.
+        """
+        ups_map = {}
+        for upstream in self.upstreams:
+            try:
+                ups_list = self._cached(upstream, 'list_ups', None)
+            except PyNUTError as err:
+                logging.warning("Cannot list the UPS of %s:%s: %s",
+                                upstream.host, upstream.port, err)
+                continue
+            for ups, desc in ups_list.items():
+                ups_map[upstream.prefix + ups] = (upstream, ups, desc)
+        return ups_map
+
+    def _resolve(self, name):
+        for upstream in self.upstreams:
+            if name.startswith(upstream.prefix):
+                ups = name[len(upstream.prefix):]
+                try:
+                    if ups in self._cached(upstream, 'list_ups', None):
+                        return upstream, ups
+                except PyNUTError:
+                    pass
+        raise PyNUTError("ERR UNKNOWN-UPS")
+
+    def _write(self, session, name, func):
+        """Run func on an upstream connection opened with the client's
+        credentials, and drop the cached data of the UPS.
+        """
+        upstream, ups = self._resolve(name)
+        try:
+            with PyNUTClient(upstream.host, upstream.port, session.login,
+                             session.password,
+                             **self._client_kwargs) as client:
+                func(client, ups)
+        finally:
+            self.invalidate(upstream, ups)
+
+    def reply(self, session, words):
+        """Return the reply to a request, given as a list of words."""
+        try:
+            return self._reply(session, words)
+        except PyNUTError as err:
+            return _error_reply(err)
+
+    def _reply(self, session, words):
+        command = " ".join(words[:2])
+        if not words:
+            return "ERR UNKNOWN-COMMAND\n"
+        if words == ["VER"]:
+            return "Network UPS Tools upsd proxy (nut2)\n"
+        if words == ["LIST", "UPS"]:
+            return "BEGIN LIST UPS\n%sEND LIST UPS\n" % "".join(
+                "UPS %s %s\n" % (name, _escape(entry[2]))
+                for name, entry in sorted(self.list_ups().items()))
+        if words[0] == "USERNAME" and len(words) == 2:
+            session.login = words[1]
+            return "OK\n"
+        if words[0] == "PASSWORD" and len(words) == 2:
+            session.password = words[1]
+            return "OK\n"
+
+        if words[0] in ("LOGIN", "MASTER", "FSD") and len(words) == 2:
+            name = words[1]
+            if words[0] == "LOGIN":
+                self._resolve(name)
+                return "OK\n"
+            if words[0] == "MASTER":
+                self._write(session, name, lambda client, ups:
+                            client._execute(_master_query(ups)))
+                return "OK MASTER-GRANTED\n"
+            self._write(session, name, lambda client, ups: client.fsd(ups))
+            return "OK FSD-SET\n"
+        if words[0] == "INSTCMD" and len(words) == 3:
+            self._write(session, words[1], lambda client, ups:
+                        client.run_command(ups, words[2]))
+            return "OK\n"
+        if command == "SET VAR" and len(words) == 5:
+            self._write(session, words[2], lambda client, ups:
+                        client.set_var(ups, words[3], words[4]))
+            return "OK\n"
+
+        if len(words) < 3 or words[0] not in ("GET", "LIST"):
+            return "ERR UNKNOWN-COMMAND\n"
+        name = words[2]
+        upstream, ups = self._resolve(name)
+        args = tuple(words[3:])
+        if command == "GET UPSDESC" and not args:
+            return "UPSDESC %s %s\n" % (
+                name, _escape(self._cached(upstream, 'list_ups', None)[ups]))
+        if command == "LIST VAR" and not args:
+            return "BEGIN LIST VAR %s\n%sEND LIST VAR %s\n" % (
+                name, "".join("VAR %s %s %s\n" % (name, var, _escape(value))
+                              for var, value in self._cached(
+                                  upstream, 'list_vars', ups).items()),
+                name)
+        if command == "GET VAR" and len(args) == 1:
+            value = self._cached(upstream, 'list_vars', ups).get(args[0])
+            if value is None:
+                return "ERR VAR-NOT-SUPPORTED\n"
+            return "VAR %s %s %s\n" % (name, args[0], _escape(value))
+        if command == "LIST RW" and not args:
+            return "BEGIN LIST RW %s\n%sEND LIST RW %s\n" % (
+                name, "".join("RW %s %s %s\n" % (name, var, _escape(value))
+                              for var, value in self._cached(
+                                  upstream, 'list_rw_vars', ups).items()),
+                name)
+        if command == "LIST CMD" and not args:
+            return "BEGIN LIST CMD %s\n%sEND LIST CMD %s\n" % (
+                name, "".join("CMD %s %s\n" % (name, cmd)
+                              for cmd in self._cached(
+                                  upstream, 'list_commands', ups, False)),
+                name)
+        if command == "LIST ENUM" and len(args) == 1:
+            return "BEGIN LIST ENUM %s %s\n%sEND LIST ENUM %s %s\n" % (
+                name, args[0], "".join(
+                    "ENUM %s %s %s\n" % (name, args[0], _escape(value))
+                    for value in self._cached(upstream, 'list_enum', ups,
+                                              args[0])),
+                name, args[0])
+        if command == "GET TYPE" and len(args) == 1:
+            return "TYPE %s %s %s\n" % (name, args[0], self._cached(
+                upstream, 'var_type', ups, args[0]))
+        if command == "GET DESC" and len(args) == 1:
+            return "DESC %s %s %s\n" % (name, args[0], _escape(self._cached(
+                upstream, 'var_description', ups, args[0])))
+        if command == "GET CMDDESC" and len(args) == 1:
+            return "CMDDESC %s %s %s\n" % (name, args[0], _escape(
+                self._cached(upstream, 'command_description', ups, args[0])))
+        if command == "GET NUMLOGINS" and not args:
+            return "NUMLOGINS %s %d\n" % (name, self._cached(
+                upstream, 'num_logins', ups))
+        return "ERR INVALID-ARGUMENT\n"
+
+
+# Flags of ups.status always exported by MetricsExporter (as 0 when
+# absent), so that their series do not come and go.
+_STATUS_FLAGS = ('OL', 'OB', 'LB', 'HB', 'RB', 'CHRG', 'DISCHRG', 'BYPASS',
+                 'CAL', 'OFF', 'OVER', 'TRIM', 'BOOST', 'FSD')
+
+_METRIC_NAME = re.compile(r'[^a-zA-Z0-9_]')
+_LABEL_ESCAPE = re.compile(r'[\\"\n]')
+
+_PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+_OPENMETRICS_TYPE = ("application/openmetrics-text; version=1.0.0; "
+                     "charset=utf-8")
+
+
+def _label_value(value):
+    return _LABEL_ESCAPE.sub(
+        lambda match: {'\\': '\\\\', '"': '\\"', '\n': '\\n'}[match.group()],
+        value)
+
+
+def _metric_value(number):
+    # repr gives inf and nan, which the exposition formats spell
+    # differently.
+    if math.isnan(number):
+        return "NaN"
+    if math.isinf(number):
+        return "+Inf" if number > 0 else "-Inf"
+    return repr(number)
+
+
+def _metric_header(family, help_text):
+    return ("# HELP %s %s\n# TYPE %s gauge\n" % (
+        family, help_text, family)).encode('utf-8')
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        openmetrics = ("application/openmetrics-text" in
+                       self.headers.get("Accept", ""))
+        compress = (self.server.exporter.gzip and
+                    "gzip" in self.headers.get("Accept-Encoding", ""))
+        body = self.server.exporter.exposition(openmetrics, compress)
+        self.send_response(200)
+        self.send_header("Content-Type", _OPENMETRICS_TYPE if openmetrics
+                         else _PROMETHEUS_TYPE)
+        if compress:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics: " + format, *args)
+
+
+class _MetricsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsExporter(object):
+    """Prometheus (and OpenMetrics) exporter of the UPS of NUT servers.
+
+    The servers are polled every interval seconds by a FleetPoller, in a
+    thread of their own, and scrapes are served from the exposition
+    rendered after the last poll, so that they cost the same however
+    many Prometheus scrape it and however slow upsd is::
+
+        exporter = MetricsExporter([("nas1",), ("nas2", 3493, "mon", "pw")],
+                                   host="0.0.0.0", port=9199)
+        exporter.serve_forever()
+
+    Each numeric variable is exported as a gauge named after it (like
+    nut_battery_charge for battery.charge), with ups and server labels.
+    ups.status is exported as nut_ups_status, with one series per flag
+    set to 1 or 0, and nut_up tells whether each server could be polled.
+
+    Only the series whose value changed are rendered again after a
+    poll, and only the metric families holding them are joined again.
+    The full text (compressed with gzip for the scrapes accepting it,
+    if gzip is True) is then built on the first scrape that needs it.
+    """
+
+    def __init__(self, targets, host="127.0.0.1", port=9199, interval=15,
+                 gzip=True, concurrency=64, timeout=5):
+        """targets     : Sequence of (host, port, login, password) tuples;
+                      the trailing items may be omitted.
+        host        : Address to listen on (defaults to 127.0.0.1).
+        port        : HTTP port to listen on (0 to pick one).
+        interval    : Seconds between the start of two polls.
+        gzip        : Whether to compress scrapes accepting gzip.
+        concurrency : Maximum number of servers polled at once.
+        timeout     : Timeout used for each network operation.
+        """
+        self.poller = FleetPoller(targets, concurrency, timeout)
+        self.interval = interval
+        self.gzip = gzip
+        self.polls = 0
+        self._servers = {}
+        self._help = {"nut_up": "Whether the NUT server could be polled.",
+                      "nut_ups_status": "Flags of the UPS status."}
+        self._lines = {}
+        self._blocks = {}
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = _MetricsServer((host, port), _MetricsHandler)
+        self._server.exporter = self
+        self._serving = False
+        self._threads = []
+
+    @property
+    def address(self):
+        """The (host, port) the exporter listens on."""
+        return self._server.server_address[:2]
+
+    def _series(self, result, old):
+        """Return the {(family, labels): (value, line)} of a PollResult,
+        reusing the lines of old whose value did not change.
+        """
+        server = "%s:%s" % (result.target.host, result.target.port)
+        series = {}
+
+        def add(family, labels, value):
+            key = (family, labels)
+            previous = old.get(key)
+            if previous is not None and previous[0] == value:
+                series[key] = previous
+            else:
+                series[key] = (value, ("%s{%s} %s\n" % (
+                    family, labels, value)).encode('utf-8'))
+
+        add("nut_up", 'server="%s"' % _label_value(server),
+            "0" if result.error is not None else "1")
+        for ups, ups_vars in (result.ups_vars or {}).items():
+            labels = 'server="%s",ups="%s"' % (_label_value(server),
+                                               _label_value(ups))
+            for var, value in ups_vars.items():
+                if var == "ups.status":
+                    flags = value.split()
+                    for flag in _STATUS_FLAGS + tuple(
+                            flag for flag in flags
+                            if flag not in _STATUS_FLAGS):
+                        add("nut_ups_status", '%s,flag="%s"' % (
+                            labels, _label_value(flag)),
+                            "1" if flag in flags else "0")
+                    continue
+                try:
+                    number = float(value)
+                except ValueError:
+                    continue
+                family = "nut_" + _METRIC_NAME.sub("_", var)
+                if family not in self._help:
+                    self._help[family] = "Value of the NUT variable %s." % var
+                add(family, labels, _metric_value(number))
+        return series
+
+    def update(self, results):
+        """Update the exposition with a list of PollResult, as returned
+        by FleetPoller.sweep or ShardedPoller.sweep. The series of the
+        servers of results which are no longer reported are dropped.
+        """
+        dirty = set()
+        with self._lock:
+            for result in results:
+                server = (result.target.host, result.target.port)
+                old = self._servers.get(server, {})
+                series = self._series(result, old)
+                for (family, labels), entry in series.items():
+                    if old.get((family, labels)) is not entry:
+                        self._lines.setdefault(family, {})[
+                            (server, labels)] = entry[1]
+                        dirty.add(family)
+                for family, labels in old:
+                    if (family, labels) not in series:
+                        del self._lines[family][(server, labels)]
+                        dirty.add(family)
+                self._servers[server] = series
+            for family in dirty:
+                lines = self._lines[family]
+                if not lines:
+                    del self._lines[family]
+                    del self._blocks[family]
+                    continue
+                self._blocks[family] = b"".join(
+                    [_metric_header(family, self._help[family])] +
+                    [lines[key] for key in sorted(lines)])
+            if dirty:
+                self._bodies = {}
+            self.polls += 1
+
+    def exposition(self, openmetrics=False, compress=False):
+        """Return the text served to scrapes, in the OpenMetrics format
+        rather than the Prometheus one if openmetrics is True, and
+        compressed with gzip if compress is True.
+        """
+        variant = (openmetrics, compress)
+        body = self._bodies.get(variant)
+        if body is not None:
+            return body
+        with self._lock:
+            body = self._bodies.get(variant)
+            if body is None:
+                body = b"".join(self._blocks[family]
+                                for family in sorted(self._blocks))
+                if openmetrics:
+                    body += b"# EOF\n"
+                if compress:
+                    body = gzip.compress(body, 6)
+                self._bodies[variant] = body
+            return body
+
+    def poll(self):
+        """Poll all the servers once, and update the exposition."""
+        self.update(self.poller.sweep())
+
+    def _poll_forever(self):
+        while not self._stopped.is_set():
+            start = time.monotonic()
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("Polling for the metrics failed")
+            self._stopped.wait(self.interval - (time.monotonic() - start))
+
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def start(self):
+        """Poll and serve scrapes in background threads."""
+        self._serving = True
+        self._start_thread(self._poll_forever)
+        self._start_thread(self._server.serve_forever)
+        return self
+
+    def serve_forever(self):
+        """Poll in a background thread, and serve scrapes until
+        shutdown() is called.
+        """
+        self._serving = True
+        self._start_thread(self._poll_forever)
+        self._server.serve_forever()
 
-        self._srv_handler.write(b"VER\n")
-        return self._srv_handler.read_until(b"\n", self._timeout).decode('utf-8')
+    def shutdown(self):
+        """Stop polling and serving, and close the server sessions."""
+        self._stopped.set()
+        if self._serving:
+            self._server.shutdown()
+        self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self.poller.close()
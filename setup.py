@@ -14,6 +14,7 @@ setup(
     py_modules=['nut2'],
     include_package_data=True,
     install_requires=[],
+    python_requires='>=3.7',
     license='GPL3',
     description='A Python abstraction class to access NUT servers.',
     long_description=README,
@@ -27,8 +28,8 @@ setup(
         'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
+        'Framework :: AsyncIO',
         'Topic :: Software Development :: Libraries',
         'Topic :: System :: Power (UPS)',
         'Topic :: System :: Systems Administration',
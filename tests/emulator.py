@@ -0,0 +1,178 @@
+"""A NUT server emulator listening on a real TCP port.
+
+Unlike MockServer, it goes through the network stack, answers pipelined
+requests in order and serves many connections at once, so it can be
+used to measure the client. The number of UPS, variables and commands,
+the size of the values and the delay before each reply are
+configurable::
+
+    with UPSEmulator(ups_count=10, var_count=100, latency=0.001) as upsd:
+        client = PyNUTClient(port=upsd.port)
+"""
+
+import random
+import socketserver
+import threading
+import time
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        emulator = self.server.emulator
+        session = {}
+        for line in self.rfile:
+            if line == b"LOGOUT\n":
+                self.wfile.write(b"OK Goodbye\n")
+                break
+            emulator.wait()
+            self.wfile.write(emulator.reply(line, session))
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UPSEmulator(object):
+    """upsd emulator serving ups_count UPS named ups0, ups1...
+
+    Each UPS has var_count variables (var0, var1...) whose values are
+    value_size characters long, and command_count commands (cmd0,
+    cmd1...). Each reply is sent after latency seconds, plus a random
+    delay of up to jitter seconds.
+
+    Any USERNAME and PASSWORD is accepted, but if users ({login:
+    password}) is given, SET, INSTCMD, MASTER and FSD are only allowed
+    after logging in as one of them.
+    """
+
+    def __init__(self, ups_count=1, var_count=20, command_count=10,
+                 value_size=8, latency=0, jitter=0, host="127.0.0.1",
+                 port=0, users=None):
+        self.users = users
+        self.latency = latency
+        self.jitter = jitter
+        self.ups = ["ups%d" % i for i in range(ups_count)]
+        self.vars = dict(("var%d" % i, ("%d" % i).rjust(value_size, "0"))
+                         for i in range(var_count))
+        self.commands = ["cmd%d" % i for i in range(command_count)]
+        self.requests = 0
+        self._replies = {}
+        self._build()
+        self._server = _Server((host, port), _Handler)
+        self._server.emulator = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def _build(self):
+        # Replies are prepared once so that serving them costs little
+        # next to the client being measured.
+        replies = self._replies
+        replies[b"VER"] = b"Network UPS Tools upsd 2.7.4 - emulator\n"
+        replies[b"HELP"] = b"Commands: HELP VER GET LIST SET INSTCMD\n"
+        replies[b"LIST UPS"] = self._listing(
+            "UPS", ['UPS %s "Emulated UPS %s"' % (ups, ups)
+                    for ups in self.ups])
+        # Lines as the client parses them: the client address, then
+        # the UPS.
+        replies[b"LIST CLIENTS"] = self._listing(
+            "CLIENTS", ["CLIENT 127.0.0.1 %s" % ups for ups in self.ups])
+        for ups in self.ups:
+            replies[b"GET UPSDESC " + ups.encode()] = (
+                b'UPSDESC %s "Emulated UPS %s"\n' % (ups.encode(),
+                                                     ups.encode()))
+            replies[b"GET NUMLOGINS " + ups.encode()] = (
+                b"NUMLOGINS %s 1\n" % ups.encode())
+            replies[b"LIST VAR " + ups.encode()] = self._listing(
+                "VAR " + ups, ['VAR %s %s "%s"' % (ups, var, value)
+                               for var, value in self.vars.items()])
+            replies[b"LIST RW " + ups.encode()] = self._listing(
+                "RW " + ups, [])
+            replies[b"LIST CMD " + ups.encode()] = self._listing(
+                "CMD " + ups, ["CMD %s %s" % (ups, command)
+                               for command in self.commands])
+            replies[b"LIST CLIENTS " + ups.encode()] = self._listing(
+                "CLIENTS", ["CLIENT 127.0.0.1 %s" % ups])
+            for var, value in self.vars.items():
+                key = ("%s %s" % (ups, var)).encode()
+                replies[b"GET VAR " + key] = b'VAR %s "%s"\n' % (
+                    key, value.encode())
+                replies[b"GET TYPE " + key] = b"TYPE %s NUMBER\n" % key
+                replies[b"GET DESC " + key] = b'DESC %s "Variable"\n' % key
+            for command in self.commands:
+                key = ("%s %s" % (ups, command)).encode()
+                replies[b"GET CMDDESC " + key] = (
+                    b'CMDDESC %s "Command"\n' % key)
+                replies[b"INSTCMD " + key] = b"OK\n"
+
+    @staticmethod
+    def _listing(name, lines):
+        return ("BEGIN LIST %s\n%sEND LIST %s\n" % (
+            name, "".join(line + "\n" for line in lines), name)).encode()
+
+    def wait(self):
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def reply(self, line, session=None):
+        """Return the reply to a request line, session being a dict
+        holding the state of the connection.
+        """
+        self.requests += 1
+        request = line.rstrip(b"\r\n")
+        words = request.split(b" ")
+        if (self.users is not None and
+                words[0] in (b"SET", b"INSTCMD", b"MASTER", b"FSD")):
+            login = (session or {}).get(b"USERNAME")
+            if (login is None or self.users.get(login.decode()) !=
+                    session.get(b"PASSWORD", b"").decode()):
+                return b"ERR ACCESS-DENIED\n"
+        reply = self._replies.get(request)
+        if reply is not None:
+            return reply
+        if words[0] in (b"USERNAME", b"PASSWORD"):
+            if session is not None and len(words) == 2:
+                session[words[0]] = words[1]
+            return b"OK\n"
+        if words[0] == b"SET":
+            return b"OK\n"
+        if words[0] in (b"LOGIN", b"MASTER", b"FSD"):
+            if words[-1].decode() not in self.ups:
+                return b"ERR UNKNOWN-UPS\n"
+            return {b"LOGIN": b"OK\n", b"MASTER": b"OK MASTER-GRANTED\n",
+                    b"FSD": b"OK FSD-SET\n"}[words[0]]
+        if words[0] == b"INSTCMD" and len(words) > 2:
+            if words[1].decode() not in self.ups:
+                return b"ERR UNKNOWN-UPS\n"
+            return b"ERR CMD-NOT-SUPPORTED\n"
+        if words[0] in (b"GET", b"LIST") and len(words) > 2:
+            if words[2].decode() not in self.ups:
+                return b"ERR UNKNOWN-UPS\n"
+            if words[1] == b"CMDDESC":
+                return b"ERR CMD-NOT-SUPPORTED\n"
+            return b"ERR VAR-NOT-SUPPORTED\n"
+        return b"ERR UNKNOWN-COMMAND\n"
+
+    def start(self):
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_t, exc_v, trace):
+        self.stop()
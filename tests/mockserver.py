@@ -8,13 +8,27 @@ class MockServer(object):
         self.broken = broken
         self.ok = ok
         self.broken_username = broken_username
+        self.replies = b""
+        self.writes = 0
 
-    def write(self, text):
-        self.command = text
-        self.first = True
+    def write(self, text, timeout=None):
+        # Requests may be pipelined, so queue a full reply for each line.
+        self.writes += 1
+        for line in text.splitlines(True):
+            self.command = line
+            self.first = True
+            reply = self.run_command()
+            if reply.startswith(b"BEGIN"):
+                reply += self.run_command()
+            if not reply.endswith(b"\n"):
+                reply += b"\n"
+            self.replies += reply
 
     def read_until(self, text=None, timeout=None):
-        return self.run_command().split(text)[0] + text
+        index = self.replies.find(text)
+        end = len(self.replies) if index < 0 else index + len(text)
+        result, self.replies = self.replies[:end], self.replies[end:]
+        return result
 
     def close(self):
         pass
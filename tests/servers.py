@@ -0,0 +1,105 @@
+"""Servers shared by the tests: threads answering like MockServer on
+real sockets, over TLS, or with a reply that is not valid UTF-8.
+"""
+
+import os
+import socket
+import ssl
+import threading
+from mockserver import MockServer
+
+
+def mock_handler(line):
+    server = MockServer(broken=False)
+    server.write(line)
+    return server.replies
+
+
+CERTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "selfsigned.pem")
+
+
+def serve_tls(listener, context, connections):
+    """Answer requests on connections connections to listener, switching
+    to TLS with context on STARTTLS.
+    """
+    for _ in range(connections):
+        try:
+            conn, _ = listener.accept()
+        except OSError:
+            # The listener was closed by the test.
+            return
+        with conn:
+            reader = conn.makefile('rb')
+            while True:
+                line = reader.readline()
+                if not line or line == b"LOGOUT\n":
+                    break
+                if line != b"STARTTLS\n":
+                    conn.sendall(mock_handler(line))
+                    continue
+                conn.sendall(b"OK STARTTLS\n")
+                reader.close()
+                try:
+                    conn = context.wrap_socket(conn, server_side=True)
+                except ssl.SSLError:
+                    break
+                reader = conn.makefile('rb')
+            reader.close()
+            conn.close()
+
+
+def serve(listener, chunk_size=None):
+    """Answer requests on the first connection to listener, optionally
+    sending the replies back in small chunks.
+    """
+    conn, _ = listener.accept()
+    with conn:
+        reader = conn.makefile('rb')
+        for line in reader:
+            if line == b"LOGOUT\n":
+                break
+            reply = mock_handler(line)
+            size = chunk_size or len(reply)
+            for i in range(0, len(reply), size):
+                conn.sendall(reply[i:i + size])
+
+
+def serve_garbled(listener):
+    """Answer requests on connections to listener until it is closed,
+    with a LIST UPS reply which is not valid UTF-8.
+    """
+    listener.settimeout(0.05)
+    while True:
+        try:
+            conn, _ = listener.accept()
+        except socket.timeout:
+            continue
+        except OSError:
+            # The listener was closed by the test.
+            return
+        conn.settimeout(None)
+        with conn:
+            reader = conn.makefile('rb')
+            for line in reader:
+                if line == b"LOGOUT\n":
+                    break
+                if line == b"LIST UPS\n":
+                    conn.sendall(b'BEGIN LIST UPS\nUPS \xff "UPS"\n'
+                                 b'END LIST UPS\n')
+                else:
+                    conn.sendall(mock_handler(line))
+            reader.close()
+
+
+def start_garbled_server(test):
+    """Start serve_garbled in a thread for test, and return its port."""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(8)
+    thread = threading.Thread(target=serve_garbled, args=(listener,))
+    thread.daemon = True
+    thread.start()
+    test.addCleanup(thread.join, 5)
+    test.addCleanup(listener.close)
+    return listener.getsockname()[1]
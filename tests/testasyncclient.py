@@ -0,0 +1,303 @@
+import asyncio
+import socket
+import threading
+import unittest
+from unittest.mock import patch
+from mockserver import MockServer
+from servers import serve, start_garbled_server
+
+from nut2 import (AsyncPyNUTClient, PyNUTError, PyNUTTimeoutError,
+                  FleetPoller, FleetExecutor)
+
+
+def mock_reply(line, **kwargs):
+    """Return the full MockServer reply (including list bodies) to line."""
+    server = MockServer(**kwargs)
+    server.write(line)
+    return server.replies
+
+
+class AsyncServerTestCase(unittest.TestCase):
+    """Runs a mock upsd on a local port for each test."""
+
+    def setUp(self):
+        self.valid = "test"
+        self.invalid = "does_not_exist"
+        self.valid_desc = "Test UPS 1"
+        self.connections = 0
+        self.open = self.peak = 0
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle, "127.0.0.1", 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self.open += 1
+        self.peak = max(self.peak, self.open)
+        while True:
+            line = await reader.readline()
+            if not line or line == b"LOGOUT\n":
+                break
+            writer.write(mock_reply(line, broken=False))
+        self.open -= 1
+        writer.close()
+
+
+class TestAsyncClient(AsyncServerTestCase):
+
+    def run_client(self, coro_func, **kwargs):
+        async def main():
+            async with AsyncPyNUTClient(port=self.port, **kwargs) as client:
+                return await coro_func(client)
+        return self.loop.run_until_complete(main())
+
+    def test_connect_credentials(self):
+        self.assertEqual(self.run_client(lambda c: c.ver(),
+                                         login=self.valid,
+                                         password=self.valid),
+                         'Network UPS Tools upsd 2.7.1 - http://www.networkupstools.org/\n')
+
+    def test_connect_bad_credentials(self):
+        self.assertRaises(PyNUTError, self.run_client, lambda c: c.ver(),
+                          login=self.invalid)
+
+    def test_connect_refused(self):
+        port = self.port
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        client = AsyncPyNUTClient(port=port, timeout=1)
+        self.assertRaises(PyNUTError, self.loop.run_until_complete,
+                          client.connect())
+
+    def test_list_ups(self):
+        ups_list = self.run_client(lambda c: c.list_ups())
+        self.assertEqual(len(ups_list), 2)
+        self.assertEqual(ups_list[self.valid], self.valid_desc)
+
+    def test_list_vars(self):
+        ups_vars = self.run_client(lambda c: c.list_vars(self.valid))
+        self.assertEqual(ups_vars, {'battery.charge': '100',
+                                    'battery.voltage': '14.44'})
+
+    def test_list_vars_invalid_ups(self):
+        self.assertRaises(PyNUTError, self.run_client,
+                          lambda c: c.list_vars(self.invalid))
+
+    def test_list_commands(self):
+        self.assertEqual(self.run_client(lambda c: c.list_commands(self.valid)),
+                         {self.valid: self.valid_desc})
+
+    def test_list_commands_no_describe(self):
+        self.assertEqual(self.run_client(
+            lambda c: c.list_commands(self.valid, describe=False)),
+            [self.valid])
+
+    def test_list_clients(self):
+        self.assertEqual(self.run_client(lambda c: c.list_clients(self.valid)),
+                         {self.valid: [self.valid]})
+
+    def test_list_clients_invalid(self):
+        self.assertRaises(PyNUTError, self.run_client,
+                          lambda c: c.list_clients(self.invalid))
+
+    def test_get_var(self):
+        self.assertEqual(self.run_client(lambda c: c.get_var(self.valid,
+                                                             self.valid)),
+                         '100')
+
+    def test_get_var_invalid(self):
+        self.assertRaises(PyNUTError, self.run_client,
+                          lambda c: c.get(self.valid, self.invalid))
+
+    def test_var_type(self):
+        self.assertEqual(self.run_client(lambda c: c.var_type(self.valid,
+                                                              self.valid)),
+                         "RW STRING:3")
+
+    def test_set_var_and_run_command(self):
+        async def main(client):
+            await client.set_var(self.valid, self.valid, self.valid)
+            await client.run_command(self.valid, self.valid)
+            await client.fsd(self.valid)
+        self.run_client(main)
+
+    def test_run_command_invalid(self):
+        self.assertRaises(PyNUTError, self.run_client,
+                          lambda c: c.run_command(self.invalid, self.invalid))
+
+    def test_concurrent_requests(self):
+        async def main(client):
+            return await asyncio.gather(
+                client.num_logins(self.valid),
+                client.description(self.valid),
+                client.list_enum(self.valid, self.valid),
+                client.list_range(self.valid, self.valid))
+        self.assertEqual(self.run_client(main),
+                         [1, self.valid_desc, [self.valid_desc],
+                          [self.valid_desc]])
+
+    def test_pipeline(self):
+        async def main(client):
+            async with client.pipeline() as pipe:
+                pipe.get_var(self.valid, self.valid)
+                pipe.get_var(self.valid, self.invalid)
+                pipe.list_vars(self.valid)
+            return pipe
+        self.assertRaises(PyNUTError, self.run_client, main)
+
+        async def main(client):
+            pipe = client.pipeline().get_var(self.valid, self.valid)
+            pipe.get_var(self.valid, self.invalid).list_vars(self.valid)
+            return await pipe.execute(raise_on_error=False)
+        results = self.run_client(main)
+        self.assertEqual(results[0], '100')
+        self.assertIsInstance(results[1], PyNUTError)
+        self.assertEqual(len(results[2]), 2)
+
+
+class TestFleetPoller(AsyncServerTestCase):
+
+    def closed_port(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        return port
+
+    def poll(self, poller):
+        async def collect():
+            return [result async for result in poller.poll()]
+        return self.loop.run_until_complete(collect())
+
+    def test_poll(self):
+        poller = FleetPoller([("127.0.0.1", self.port),
+                              ("127.0.0.1", self.closed_port()),
+                              ("127.0.0.1", self.port, self.invalid)],
+                             concurrency=2, timeout=1)
+        results = dict((result.target, result)
+                       for result in self.poll(poller))
+        self.assertEqual(len(results), 3)
+
+        good = results[poller.targets[0]]
+        self.assertEqual(good.error, None)
+        self.assertEqual(good.ups_vars, {self.valid: {
+            'battery.charge': '100', 'battery.voltage': '14.44'}})
+        self.assertEqual(list(good.ups_errors), ['Test_UPS2'])
+        self.assertTrue(good.elapsed >= 0)
+        self.assertTrue(isinstance(results[poller.targets[1]].error,
+                                   PyNUTError))
+        self.assertTrue(isinstance(results[poller.targets[2]].error,
+                                   PyNUTError))
+        self.assertTrue(poller.last_sweep_time >= 0)
+
+        # The working session is kept, the failed login is retried.
+        self.poll(poller)
+        self.assertEqual(self.connections, 3)
+        self.loop.run_until_complete(poller.aclose())
+
+    def test_garbled_reply(self):
+        garbled = ("127.0.0.1", start_garbled_server(self))
+        poller = FleetPoller([("127.0.0.1", self.port), garbled], timeout=1)
+        for _ in range(2):
+            results = dict((result.target, result)
+                           for result in self.poll(poller))
+            self.assertEqual(results[poller.targets[0]].error, None)
+            error = results[poller.targets[1]].error
+            self.assertTrue(isinstance(error, PyNUTError))
+            self.assertTrue(isinstance(error.__cause__, UnicodeDecodeError))
+        # The session of the garbled server was dropped.
+        self.assertEqual(list(poller._sessions), [poller.targets[0]])
+        self.loop.run_until_complete(poller.aclose())
+
+    def test_sweep(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        thread = threading.Thread(target=serve, args=(listener,))
+        thread.daemon = True
+        thread.start()
+
+        poller = FleetPoller([("127.0.0.1", listener.getsockname()[1])])
+        for _ in range(2):
+            results = poller.sweep()
+            self.assertEqual(len(results), 1)
+            self.assertEqual(results[0].error, None)
+            self.assertEqual(len(results[0].ups_vars), 1)
+        poller.close()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+
+class TestFleetExecutor(AsyncServerTestCase):
+
+    def execute(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def closed_port(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        return port
+
+    def test_fan_out(self):
+        executor = FleetExecutor(per_host=2, timeout=1)
+        targets = [("127.0.0.1", self.valid, self.port)] * 5 + [
+            ("127.0.0.1", self.invalid, self.port),
+            ("127.0.0.1", self.valid, self.closed_port())]
+        for action in (executor.fsd(targets),
+                       executor.run_command(targets, self.valid),
+                       executor.set_var(targets, self.valid, self.valid)):
+            report = self.execute(action)
+            self.assertEqual([result.target.ups for result in report],
+                             [target[1] for target in targets])
+            for result in report[:5]:
+                self.assertEqual(result.error, None)
+                self.assertTrue(result.elapsed >= 0)
+            self.assertTrue(isinstance(report[5].error, PyNUTError))
+            self.assertTrue(isinstance(report[6].error, PyNUTError))
+        self.assertEqual(self.connections, 3 * 2)
+
+    def test_per_host_across_credentials(self):
+        executor = FleetExecutor(per_host=1, timeout=1)
+        report = self.execute(executor.fsd(
+            [("127.0.0.1", self.valid, self.port),
+             ("127.0.0.1", self.valid, self.port, self.valid),
+             ("127.0.0.1", self.valid, self.port, self.valid, self.valid)]))
+        self.assertEqual([result.error for result in report], [None] * 3)
+        self.assertEqual(self.connections, 3)
+        self.assertEqual(self.peak, 1)
+
+    def test_unexpected_error(self):
+        targets = [("127.0.0.1", self.valid, self.port)] * 2
+        with patch("nut2.AsyncPyNUTClient._execute_many",
+                   side_effect=UnicodeDecodeError("utf-8", b"\xff", 0, 1,
+                                                  "invalid start byte")):
+            for deadline in (5, None):
+                executor = FleetExecutor(timeout=1, deadline=deadline)
+                for result in self.execute(executor.fsd(targets)):
+                    self.assertTrue(isinstance(result.error, PyNUTError))
+                    self.assertFalse(isinstance(result.error,
+                                                PyNUTTimeoutError))
+                    self.assertTrue(isinstance(result.error.__cause__,
+                                               UnicodeDecodeError))
+
+    def test_deadline(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        executor = FleetExecutor(timeout=5, deadline=0.2)
+        report = self.execute(executor.fsd(
+            [("127.0.0.1", self.valid, self.port),
+             ("127.0.0.1", self.valid, listener.getsockname()[1])]))
+        self.assertEqual(report[0].error, None)
+        self.assertTrue(isinstance(report[1].error, PyNUTTimeoutError))
+        self.assertTrue(report[1].elapsed < 1)
@@ -1,12 +1,25 @@
+import gc
+import math
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from mockserver import MockServer
-import telnetlib
 try:
-    from mock import Mock
+    from mock import Mock, patch
 except ImportError:
-    from unittest.mock import Mock
+    from unittest.mock import Mock, patch
 
-from nut2 import PyNUTClient, PyNUTError
+import nut2
+from nut2 import (PyNUTClient, PyNUTError, PyNUTTimeoutError, MetadataCache,
+        UPSSchema, UPSSnapshot, LoopbackTransport, SharedPyNUTClient,
+        ConnectionPool, PyNUTConnectionError, PyNUTCircuitOpenError,
+        PollScheduler, ClientStats, LatencyHistogram, HistoryStore,
+        VarHistory, VarChange, SampleLog, Sample, FleetColumns, FleetTarget,
+        PollResult)
 
 class TestClient(unittest.TestCase):
 
@@ -24,7 +37,9 @@ class TestClient(unittest.TestCase):
         self.valid_desc = self.valid_ups_name
         self.valid_value = '100'
         self.valid_command_desc = self.valid_desc
-        telnetlib.Telnet = Mock()
+        patcher = patch('nut2.TCPTransport', Mock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_init_with_args(self):
         PyNUTClient(connect=False, login='test', password='test',
@@ -50,9 +65,8 @@ class TestClient(unittest.TestCase):
             assert(False)
 
     def test_connect_broken(self):
-        telnetlib.Telnet = MockServer
         client = PyNUTClient(login=self.valid, password=self.valid,
-                connect=False)
+                connect=False, transport=MockServer)
         self.assertRaises(PyNUTError, client._connect)
 
     def test_connect_credentials(self):
@@ -68,9 +82,8 @@ class TestClient(unittest.TestCase):
 
     def test_connect_credentials_username_ok(self):
         try:
-            telnetlib.Telnet = MockServer
             PyNUTClient(login=self.valid, password=self.valid,
-                    debug=True)
+                    debug=True, transport=MockServer)
         except TypeError:
             pass
         except PyNUTError:
@@ -93,6 +106,62 @@ class TestClient(unittest.TestCase):
         self.assertEquals(len(vars), 2)
         self.assertEquals(vars['battery.charge'], '100')
 
+    def test_iter_vars(self):
+        self.assertEqual(list(self.client.iter_vars(self.valid)),
+                [('battery.charge', '100'), ('battery.voltage', '14.44')])
+
+    def test_iter_vars_stop_early(self):
+        for var, value in self.client.iter_vars(self.valid):
+            break
+        self.assertEqual(var, 'battery.charge')
+        # The rest of the list was skipped.
+        self.assertEqual(self.client.get_var(self.valid, self.valid),
+                self.valid_value)
+
+    def test_iter_vars_invalid_ups(self):
+        self.assertRaises(PyNUTError, list,
+                self.client.iter_vars(self.invalid))
+
+    def test_iter_ups(self):
+        self.assertEqual(dict(self.client.iter_ups()),
+                self.client.list_ups())
+
+    def test_iter_rw_vars(self):
+        self.assertEqual(list(self.client.iter_rw_vars(self.valid)),
+                [(self.valid, self.valid)])
+
+    def test_iter_clients(self):
+        self.assertEqual(list(self.client.iter_clients(self.valid)),
+                [(self.valid, self.valid)])
+        self.assertRaises(PyNUTError, list,
+                self.client.iter_clients(self.invalid))
+
+    def test_watch(self):
+        self.client.list_vars = Mock(side_effect=[
+            {'ups.status': 'OL', 'battery.charge': '100'},
+            {'ups.status': 'OL', 'battery.charge': '100'},
+            {'ups.status': 'OB', 'battery.charge': '100', 'input.freq': '50'},
+            {'ups.status': 'OB', 'input.freq': '50'},
+        ])
+        polls = list(self.client.watch(self.valid, interval=0, polls=4))
+        self.assertEqual(len(polls), 3)
+        self.assertEqual(sorted((c.var, c.old, c.new) for c in polls[0]),
+                [('battery.charge', None, '100'), ('ups.status', None, 'OL')])
+        self.assertEqual(sorted((c.var, c.old, c.new) for c in polls[1]),
+                [('input.freq', None, '50'), ('ups.status', 'OL', 'OB')])
+        self.assertEqual([(c.ups, c.var, c.old, c.new) for c in polls[2]],
+                [(self.valid, 'battery.charge', '100', None)])
+        self.assertTrue(polls[2][0].time >= polls[0][0].time)
+
+    def test_watch_vars(self):
+        polls = list(self.client.watch(self.valid, interval=0, polls=2,
+                vars=[self.valid, self.invalid]))
+        self.assertEqual([(c.var, c.old, c.new) for c in polls[0]],
+                [(self.valid, None, self.valid_value)])
+        self.assertEqual(len(polls), 1)
+        # One pipelined write per poll.
+        self.assertEqual(self.client._srv_handler.writes, 2)
+
     def test_get_ups_vars_invalid_ups(self):
         self.assertRaises(PyNUTError, self.client.list_vars, self.invalid)
 
@@ -105,6 +174,16 @@ class TestClient(unittest.TestCase):
         self.assertEquals(len(commands), 1)
         self.assertEquals(commands[self.valid], self.valid_command_desc)
 
+    def test_get_ups_commands_single_round_trip(self):
+        self.client.list_commands(self.valid)
+        # One write for LIST CMD, one for all the GET CMDDESC requests.
+        self.assertEqual(self.client._srv_handler.writes, 2)
+
+    def test_get_ups_commands_no_describe(self):
+        commands = self.client.list_commands(self.valid, describe=False)
+        self.assertEqual(commands, [self.valid])
+        self.assertEqual(self.client._srv_handler.writes, 1)
+
     def test_get_ups_commands_invalid_ups(self):
         self.assertRaises(PyNUTError, self.client.list_commands, self.invalid)
 
@@ -251,3 +330,797 @@ class TestClient(unittest.TestCase):
     def test_var_type_broken(self):
         self.assertRaises(PyNUTError, self.broken_client.var_type,
                 self.valid, self.valid)
+
+    def test_pipeline(self):
+        with self.client.pipeline() as pipe:
+            pipe.get_var(self.valid, self.valid)
+            pipe.var_type(self.valid, self.valid)
+            pipe.list_vars(self.valid)
+            pipe.description(self.valid)
+        self.assertEqual(self.client._srv_handler.writes, 1)
+        self.assertEqual(pipe.results[:2], [self.valid_value, "RW STRING:3"])
+        self.assertEqual(pipe.results[2]['battery.charge'], '100')
+        self.assertEqual(pipe.results[3], self.valid_desc)
+
+    def test_pipeline_chaining(self):
+        results = self.client.pipeline().get(self.valid, self.valid) \
+                .num_logins(self.valid).ver().execute()
+        self.assertEqual(results[:2], [self.valid_value, 1])
+
+    def test_pipeline_error_per_command(self):
+        pipe = self.client.pipeline()
+        pipe.get_var(self.valid, self.invalid)
+        pipe.list_vars(self.invalid)
+        pipe.get_var(self.valid, self.valid)
+        self.assertEqual(len(pipe), 3)
+        results = pipe.execute(raise_on_error=False)
+        self.assertTrue(isinstance(results[0], PyNUTError))
+        self.assertTrue(isinstance(results[1], PyNUTError))
+        self.assertEqual(results[2], self.valid_value)
+
+    def test_pipeline_raises_first_error(self):
+        pipe = self.client.pipeline().get_var(self.valid, self.valid)
+        pipe.set_var(self.invalid, self.invalid, self.invalid)
+        self.assertRaises(PyNUTError, pipe.execute)
+        # The following replies were still consumed.
+        self.assertEqual(self.client.get_var(self.valid, self.valid),
+                self.valid_value)
+
+
+class TestEscapes(unittest.TestCase):
+
+    replies = {
+        b"LIST VAR ups\n": b'BEGIN LIST VAR ups\n'
+                           b'VAR ups ups.mfr "ACME \\"Power\\" Inc."\n'
+                           b'VAR ups ups.path "C:\\\\UPS"\n'
+                           b'VAR ups ups.model "Smart"\n'
+                           b'END LIST VAR ups\n',
+        b"GET VAR ups ups.mfr\n": b'VAR ups ups.mfr "ACME \\"Power\\""\n',
+        b"LIST ENUM ups input.mode\n": b'BEGIN LIST ENUM ups input.mode\n'
+                                       b'ENUM ups input.mode "a \\"b\\""\n'
+                                       b'ENUM ups input.mode "c"\n'
+                                       b'END LIST ENUM ups input.mode\n',
+        b"LIST CMD ups\n": b'BEGIN LIST CMD ups\nCMD ups say\nCMD ups off\n'
+                          b'END LIST CMD ups\n',
+        b"GET CMDDESC ups say\n": b'CMDDESC ups say "Say \\"hi\\" now"\n',
+        b"GET CMDDESC ups off\n": b'ERR CMD-NOT-SUPPORTED\n',
+        b"GET TYPE ups input.mode\n": b'TYPE ups input.mode RW ENUM\n',
+        b"GET TYPE ups ups.mfr\n": b'TYPE ups ups.mfr\n',
+        b"GET NUMLOGINS ups\n": b'NUMLOGINS ups 2\n',
+        b"GET NUMLOGINS bad\n": b'NUMLOGINS bad many\n',
+    }
+
+    def setUp(self):
+        self.client = PyNUTClient(transport=lambda host, port, timeout:
+                LoopbackTransport(self.handler))
+
+    def handler(self, line):
+        return self.replies.get(line, b"OK\n")
+
+    def test_list_vars(self):
+        expected = {'ups.mfr': 'ACME "Power" Inc.', 'ups.path': 'C:\\UPS',
+                    'ups.model': 'Smart'}
+        self.assertEqual(self.client.list_vars("ups"), expected)
+        self.assertEqual(dict(self.client.iter_vars("ups")), expected)
+
+    def test_get_var(self):
+        self.assertEqual(self.client.get_var("ups", "ups.mfr"),
+                         'ACME "Power"')
+
+    def test_list_enum(self):
+        self.assertEqual(self.client.list_enum("ups", "input.mode"),
+                         ['a "b"', 'c'])
+
+    def test_command_descriptions(self):
+        self.assertEqual(self.client.list_commands("ups"),
+                         {'say': 'Say "hi" now', 'off': 'off'})
+        self.assertEqual(self.client.command_description("ups", "say"),
+                         'Say "hi" now')
+
+    def test_type_and_num_logins(self):
+        self.assertEqual(self.client.var_type("ups", "input.mode"),
+                         "RW ENUM")
+        self.assertRaises(PyNUTError, self.client.var_type, "ups", "ups.mfr")
+        self.assertEqual(self.client.num_logins("ups"), 2)
+        self.assertRaises(PyNUTError, self.client.num_logins, "bad")
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = MetadataCache(maxsize=2, ttl=60)
+        self.client = PyNUTClient(connect=False, cache=self.cache)
+        self.client._srv_handler = MockServer(broken=False)
+        self.valid = "test"
+        self.invalid = "does_not_exist"
+
+    def test_cached_metadata(self):
+        for _ in range(3):
+            self.assertEqual(self.client.var_type(self.valid, self.valid),
+                    "RW STRING:3")
+            self.assertEqual(self.client.list_enum(self.valid, self.valid),
+                    ["Test UPS 1"])
+        self.assertEqual(self.client._srv_handler.writes, 2)
+        self.assertEqual(self.cache.stats(), {'hits': 4, 'misses': 2,
+                'size': 2, 'maxsize': 2})
+
+    def test_dynamic_values_not_cached(self):
+        self.client.get_var(self.valid, self.valid)
+        self.client.get_var(self.valid, self.valid)
+        self.client.list_vars(self.valid)
+        self.assertEqual(self.client._srv_handler.writes, 3)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_errors_not_cached(self):
+        self.assertRaises(PyNUTError, self.client.var_type, self.valid,
+                self.invalid)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction(self):
+        self.client.var_type(self.valid, self.valid)
+        self.client.var_description(self.valid, self.valid)
+        self.client.var_type(self.valid, self.valid)
+        self.client.command_description(self.valid, self.valid)
+        # var_description was the least recently used entry.
+        self.client.var_type(self.valid, self.valid)
+        self.client.var_description(self.valid, self.valid)
+        self.assertEqual(self.client._srv_handler.writes, 4)
+
+    def test_ttl_expiry(self):
+        self.cache.ttl = 0
+        self.client.var_type(self.valid, self.valid)
+        self.client.var_type(self.valid, self.valid)
+        self.assertEqual(self.client._srv_handler.writes, 2)
+
+    def test_invalidate(self):
+        self.client.var_type(self.valid, self.valid)
+        self.cache.set(("127.0.0.1", 3493, "other", "TYPE", "x"), "NUMBER")
+        self.client.invalidate_cache(self.valid)
+        self.assertEqual(len(self.cache), 1)
+        self.client.var_type(self.valid, self.valid)
+        self.assertEqual(self.client._srv_handler.writes, 2)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.client = PyNUTClient(connect=False)
+        self.client._srv_handler = MockServer(broken=False)
+        self.valid = "test"
+        self.types = {'battery.charge': 'NUMBER',
+                      'battery.voltage': 'NUMBER',
+                      'ups.status': 'STRING:32'}
+
+    def test_snapshot(self):
+        snapshot = self.client.snapshot(self.valid)
+        # The mock server types every variable as a string.
+        self.assertEqual(dict(snapshot), {'battery.charge': '100',
+                                          'battery.voltage': '14.44'})
+        self.assertEqual(snapshot.ups, self.valid)
+        self.assertFalse(hasattr(snapshot, '__dict__'))
+        again = self.client.snapshot(self.valid)
+        self.assertTrue(again.schema is snapshot.schema)
+        # One LIST VAR and one GET TYPE batch, then a single LIST VAR.
+        self.assertEqual(self.client._srv_handler.writes, 3)
+
+    def test_numeric_values(self):
+        schema = UPSSchema.get(self.types, ['battery.charge',
+                                            'battery.voltage'])
+        snapshot = UPSSnapshot(schema, "ups1", {
+            'battery.charge': '100', 'battery.voltage': 'unknown',
+            'ups.status': 'OL'})
+        self.assertEqual(snapshot['battery.charge'], 100.0)
+        self.assertEqual(snapshot['battery.voltage'], 'unknown')
+        self.assertEqual(snapshot['ups.status'], 'OL')
+        self.assertEqual(len(snapshot), 3)
+
+    def test_missing_values(self):
+        schema = UPSSchema.get(self.types, ['battery.charge'])
+        snapshot = UPSSnapshot(schema, "ups1", {'ups.status': 'OL'})
+        self.assertEqual(list(snapshot), ['ups.status'])
+        self.assertRaises(KeyError, lambda: snapshot['battery.charge'])
+        self.assertEqual(snapshot.get('battery.voltage', 'n/a'), 'n/a')
+        self.assertFalse('battery.charge' in snapshot)
+
+    def test_shared_schema(self):
+        schema = UPSSchema.get(self.types, ['battery.charge'])
+        self.assertTrue(UPSSchema.get(list(self.types),
+                                      {'battery.charge'}) is schema)
+        self.assertFalse(UPSSchema.get(self.types, []) is schema)
+        self.assertTrue(schema.covers(['ups.status']))
+        self.assertFalse(schema.covers(['ups.load']))
+
+    def test_schema_released(self):
+        names = ['ups.released.%d' % i for i in range(3)]
+        snapshot = UPSSnapshot(UPSSchema.get(names, []), "ups1", {})
+        key = (frozenset(names), frozenset())
+        self.assertTrue(key in UPSSchema._registry)
+        del snapshot
+        gc.collect()
+        self.assertFalse(key in UPSSchema._registry)
+
+
+class TestHistory(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        history = VarHistory(capacity=4)
+        for second in range(6):
+            self.assertTrue(history.append(100.0 + second, second))
+        self.assertFalse(history.append(50.0, 1))
+        self.assertEqual(len(history), 4)
+        self.assertEqual(history.latest(), (105.0, 5))
+        self.assertEqual(history.last(2, now=105.0),
+                         [(103.0, 3), (104.0, 4), (105.0, 5)])
+        self.assertEqual(history.last(1.5, now=104.0), [(103.0, 3),
+                                                        (104.0, 4)])
+        self.assertEqual(len(history.last(60, now=105.0)), 4)
+
+    def test_rollups(self):
+        history = VarHistory(capacity=2, levels=[(10, 6), (60, 10)])
+        for second in range(0, 120, 5):
+            history.append(float(second), second % 30)
+        rollup = history.rollup(20, now=119.0)
+        self.assertEqual((rollup.min, rollup.max, rollup.count),
+                         (10, 25, 4))
+        self.assertEqual(rollup.avg, 17.5)
+        rollup = history.rollup(120, now=119.0)
+        self.assertEqual((rollup.min, rollup.max, rollup.count),
+                         (0, 25, 24))
+        self.assertEqual(history.rollup(20, now=1000.0).count, 0)
+
+    def test_store(self):
+        history = HistoryStore(vars=["battery.charge", "ups.status",
+                                     "ups.load"])
+        history.add_vars("ups", {"battery.charge": "100",
+                                 "ups.status": "OL", "ups.load": "20",
+                                 "input.voltage": "230"}, 10.0)
+        history.add_changes([VarChange(12.0, "ups", "ups.load", "20", "30"),
+                             VarChange(12.0, "ups", "ups.load", "30", None)])
+        self.assertEqual(sorted(history.keys()), [("ups", "battery.charge"),
+                                                  ("ups", "ups.load")])
+        self.assertEqual(history.last("ups", "ups.load", 10, now=12.0),
+                         [(10.0, 20.0), (12.0, 30.0)])
+        self.assertEqual(history.rollup("ups", "ups.load", 60, 12.0).avg,
+                         25.0)
+        self.assertEqual(history.last("ups", "ups.status", 10), [])
+        self.assertEqual(history.rollup("other", "ups.load", 60).count, 0)
+
+
+class TestSampleLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def fill(self, log, seconds):
+        for second in seconds:
+            log.append_vars("ups", {"battery.charge": str(second),
+                                    "ups.status": "OL"}, float(second))
+            log.append("other", "ups.status", "OB", float(second))
+
+    def test_query(self):
+        with SampleLog(self.directory, segment_size=1024,
+                       index_every=128) as log:
+            self.fill(log, range(100))
+            self.assertTrue(len(log.segments) > 2)
+            samples = list(log.query(40, 42, "ups", ["battery.charge"]))
+            self.assertEqual(samples, [
+                Sample(40.0, "ups", "battery.charge", "40"),
+                Sample(41.0, "ups", "battery.charge", "41"),
+                Sample(42.0, "ups", "battery.charge", "42")])
+            self.assertEqual(len(list(log.query(90, 99))), 30)
+            self.assertEqual(len(list(log.query(0, 99, "other"))), 100)
+            self.assertEqual(list(log.query(0, 99, "nothing")), [])
+            self.assertEqual(list(log.query(200, 300)), [])
+            # Samples going back in time keep the order of the records.
+            log.append("ups", "ups.load", "10", 50.0)
+            self.assertEqual(list(log.query(99, 99, vars=["ups.load"])),
+                             [Sample(99.0, "ups", "ups.load", "10")])
+
+    def test_reopen(self):
+        with SampleLog(self.directory, segment_size=1024) as log:
+            self.fill(log, range(50))
+            last = log.segments[-1]
+        # A record cut short by a crash is dropped.
+        with open(last, "ab") as log_file:
+            log_file.write(b"\x00" * 7)
+        with SampleLog(self.directory, segment_size=1024) as log:
+            self.fill(log, range(50, 60))
+            self.assertEqual([sample.value for sample in log.query(
+                48, 51, "ups", ["battery.charge"])],
+                ["48", "49", "50", "51"])
+            self.assertEqual(len(list(log.query(0, 60))), 180)
+
+    def test_torn_keys(self):
+        with SampleLog(self.directory) as log:
+            log.append("ups", "a", "1", 1.0)
+        with open(os.path.join(self.directory, "keys"), "ab") as keys_file:
+            keys_file.write(b'["ups", "b')
+        for second in (2.0, 3.0):
+            with SampleLog(self.directory) as log:
+                log.append("ups", "c", "2", second)
+        with SampleLog(self.directory) as log:
+            self.assertEqual([(sample.var, sample.value)
+                              for sample in log.query(0, 10)],
+                             [("a", "1"), ("c", "2"), ("c", "2")])
+
+    def test_concurrent_writer(self):
+        with SampleLog(self.directory) as log:
+            stop = threading.Event()
+
+            def write():
+                second = 1
+                while not stop.is_set():
+                    self.fill(log, [second])
+                    second += 1
+            self.fill(log, [0])
+            writer = threading.Thread(target=write)
+            writer.start()
+            try:
+                for _ in range(3000):
+                    self.assertEqual(len(list(log.query(0, 0, "other"))),
+                                     1)
+            finally:
+                stop.set()
+                writer.join()
+
+    def test_retention(self):
+        with SampleLog(self.directory, segment_size=512,
+                       max_segments=3) as log:
+            self.fill(log, range(100))
+            self.assertEqual(len(log.segments), 3)
+            self.assertEqual(len(os.listdir(self.directory)), 7)
+            self.assertEqual(list(log.query(0, 40)), [])
+        with SampleLog(self.directory, segment_size=512,
+                       retention=30) as log:
+            self.fill(log, range(100, 200))
+            first = next(log.query(0, 200))
+            self.assertTrue(150 <= first.time <= 170, first)
+
+
+class TestFleetColumns(unittest.TestCase):
+
+    def setUp(self):
+        target = FleetTarget("127.0.0.1")
+        self.results = [
+            PollResult(target, {"b": {"ups.load": "30", "ups.status": "OL"},
+                                "a": {"ups.load": "10",
+                                      "battery.charge": "15",
+                                      "ups.status": "OB"}}, {}, None, 0),
+            PollResult(FleetTarget("10.0.0.1"), {}, {}, PyNUTError(), 0),
+            PollResult(FleetTarget("10.0.0.2"), {"c": {
+                "battery.charge": "unknown", "ups.load": "50"}}, {}, None, 0)]
+
+    def test_columns(self):
+        columns = FleetColumns.from_results(self.results)
+        self.assertEqual(columns.ups, [("127.0.0.1", 3493, "a"),
+                                       ("127.0.0.1", 3493, "b"),
+                                       ("10.0.0.2", 3493, "c")])
+        self.assertEqual(columns.names, ["battery.charge", "ups.load"])
+        self.assertEqual(list(columns["ups.load"]), [10.0, 30.0, 50.0])
+        self.assertEqual(list(columns.mask("battery.charge")),
+                         [1, 0, 0])
+        self.assertTrue(math.isnan(columns["battery.charge"][1]))
+        self.assertEqual(columns.text, {"ups.status": ["OB", "OL", None]})
+        self.assertEqual(columns.row(("10.0.0.2", 3493, "c")), 2)
+        self.assertFalse("ups.status" in columns)
+
+        columns = FleetColumns([("x", {"ups.load": 1})], vars=["ups.status"])
+        self.assertEqual((len(columns), columns.names, columns.text),
+                         (1, [], {}))
+
+    @unittest.skipIf(nut2.numpy is None, "numpy is not installed")
+    def test_numpy(self):
+        columns = FleetColumns.from_results(self.results)
+        load = columns["ups.load"]
+        self.assertEqual(load.mean(), 30.0)
+        self.assertEqual(list(columns["battery.charge"][
+            columns.mask("battery.charge")]), [15.0])
+
+
+class TestDeadline(unittest.TestCase):
+
+    def setUp(self):
+        self.delay = 0.03
+
+    def handler(self, line):
+        time.sleep(self.delay)
+        if line == b"LIST CMD ups\n":
+            return (b"BEGIN LIST CMD ups\n" +
+                    b"".join(b"CMD ups cmd%d\n" % i for i in range(5)) +
+                    b"END LIST CMD ups\n")
+        if line.startswith(b"GET CMDDESC"):
+            return b'CMDDESC ups %s "Description"\n' % line.split()[-1]
+        if line.startswith(b"MASTER"):
+            return b"OK MASTER-GRANTED\n"
+        if line.startswith(b"FSD"):
+            return b"OK FSD-SET\n"
+        return b"OK\n"
+
+    def client(self, login="user", **kwargs):
+        return PyNUTClient(login=login, transport=lambda host, port, timeout:
+                LoopbackTransport(self.handler), **kwargs)
+
+    def test_operation_within_deadline(self):
+        client = self.client(deadline=1)
+        self.assertEqual(len(client.list_commands("ups")), 5)
+        client.fsd("ups")
+
+    def test_operation_exceeds_deadline(self):
+        client = self.client(deadline=0.1)
+        try:
+            client.list_commands("ups")
+        except PyNUTTimeoutError as err:
+            self.assertEqual(err.operation, "list_commands")
+            self.assertEqual(err.completed, 1)
+            self.assertTrue(err.partial[0].startswith("CMD ups cmd0"))
+            self.assertTrue(err.elapsed >= 0.1)
+        else:
+            self.fail("PyNUTTimeoutError not raised")
+
+    def test_connect_exceeds_deadline(self):
+        self.delay = 0.06
+        self.assertRaises(PyNUTTimeoutError, self.client, password="pass",
+                deadline=0.1)
+
+    def test_deadline_block(self):
+        self.assertRaises(PyNUTTimeoutError, self._run_block, self.client())
+        # Each operation alone fits in the same budget.
+        client = self.client(login=None, deadline=0.05)
+        client.list_commands("ups", describe=False)
+        client.run_command("ups", "cmd0")
+
+    def _run_block(self, client):
+        with client.deadline(0.05):
+            client.list_commands("ups", describe=False)
+            client.run_command("ups", "cmd0")
+
+    def test_pipeline_deadline(self):
+        client = self.client(deadline=0.1)
+        pipe = client.pipeline()
+        for i in range(5):
+            pipe.run_command("ups", "cmd%d" % i)
+        self.assertRaises(PyNUTTimeoutError, pipe.execute)
+
+    def test_silent_server(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        client = PyNUTClient(port=listener.getsockname()[1], timeout=5,
+                deadline=0.1)
+        start = time.time()
+        self.assertRaises(PyNUTTimeoutError, client.list_vars, "ups")
+        self.assertTrue(time.time() - start < 1)
+        start = time.time()
+        try:
+            list(client.iter_vars("ups"))
+        except PyNUTTimeoutError as err:
+            self.assertEqual(err.operation, "iter_vars")
+        else:
+            self.fail("PyNUTTimeoutError not raised")
+        self.assertTrue(time.time() - start < 1)
+
+
+class SlowMockServer(MockServer):
+    """MockServer taking some time to answer each batch of requests."""
+
+    def write(self, text, timeout=None):
+        time.sleep(0.02)
+        MockServer.write(self, text)
+
+
+class TestSharedClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = SharedPyNUTClient(connect=False)
+        self.client._srv_handler = SlowMockServer(broken=False)
+        self.valid = "test"
+        self.invalid = "does_not_exist"
+
+    def run_threads(self, *calls):
+        barrier = threading.Barrier(len(calls))
+        results = [None] * len(calls)
+
+        def run(index, func, args):
+            barrier.wait()
+            try:
+                results[index] = func(*args)
+            except PyNUTError as err:
+                results[index] = err
+
+        threads = [threading.Thread(target=run, args=(i, call[0], call[1:]))
+                   for i, call in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_coalescing(self):
+        results = self.run_threads(*[(self.client.list_vars, self.valid)] * 20)
+        for result in results:
+            self.assertEqual(result, {'battery.charge': '100',
+                                      'battery.voltage': '14.44'})
+        self.assertTrue(self.client._srv_handler.writes < 20)
+        self.assertEqual(self.client.batches,
+                         self.client._srv_handler.writes)
+        self.assertEqual(self.client.coalesced + self.client.batches, 20)
+
+    def test_mixed_requests(self):
+        calls = [(self.client.get_var, self.valid, self.valid),
+                 (self.client.var_type, self.valid, self.valid),
+                 (self.client.list_vars, self.invalid),
+                 (self.client.list_commands, self.valid),
+                 (self.client.set_var, self.valid, self.valid, self.valid),
+                 (self.client.get_var, self.valid, self.invalid)] * 5
+        results = self.run_threads(*calls)
+        for i in range(0, len(calls), 6):
+            self.assertEqual(results[i], '100')
+            self.assertEqual(results[i + 1], 'RW STRING:3')
+            self.assertTrue(isinstance(results[i + 2], PyNUTError))
+            self.assertEqual(results[i + 3], {self.valid: 'Test UPS 1'})
+            self.assertEqual(results[i + 4], None)
+            self.assertTrue(isinstance(results[i + 5], PyNUTError))
+        self.assertTrue(self.client._srv_handler.writes < len(calls))
+
+    def test_streaming(self):
+        results = self.run_threads(
+            (lambda: list(self.client.iter_vars(self.valid)),),
+            (self.client.get_var, self.valid, self.valid))
+        self.assertEqual(len(results[0]), 2)
+        self.assertEqual(results[1], '100')
+
+    def test_broken_connection(self):
+        self.client._srv_handler = LoopbackTransport(lambda line: b"")
+        results = self.run_threads(*[(self.client.get_var, self.valid,
+                                      self.valid)] * 5)
+        for result in results:
+            self.assertTrue(isinstance(result, PyNUTError))
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.valid = "test"
+        self.connections = []
+        self.down = False
+        self.pool = ConnectionPool(transport=self.transport, backoff=0,
+                failure_threshold=2, reset_timeout=0.05)
+        self.addCleanup(self.pool.close)
+
+    def transport(self, host, port, timeout):
+        if self.down:
+            raise PyNUTConnectionError("Socket error.")
+        transport = LoopbackTransport(self.handler)
+        self.connections.append(transport)
+        return transport
+
+    def handler(self, line):
+        server = MockServer(broken=False)
+        server.write(line)
+        return server.replies
+
+    def kill(self, transport):
+        transport._handler = lambda line: b""
+
+    def test_reuse(self):
+        for _ in range(3):
+            with self.pool.connection("ups1", login=self.valid,
+                                      password=self.valid) as client:
+                self.assertEqual(client.get_var(self.valid, self.valid),
+                                 '100')
+        self.assertEqual(len(self.connections), 1)
+        with self.pool.connection("ups2") as client:
+            client.ver()
+        self.assertEqual(len(self.connections), 2)
+
+    def test_protocol_error_keeps_connection(self):
+        with self.pool.connection("ups1") as client:
+            self.assertRaises(PyNUTError, client.get_var, self.valid,
+                              "does_not_exist")
+        self.assertRaises(PyNUTError, self.pool.run,
+                          lambda c: c.list_vars("does_not_exist"), "ups1")
+        self.assertEqual(len(self.connections), 1)
+
+    def test_keepalive_replaces_dead_session(self):
+        self.pool.keepalive = 0
+        with self.pool.connection("ups1") as client:
+            client.ver()
+        self.kill(self.connections[0])
+        with self.pool.connection("ups1") as client:
+            client.ver()
+        self.assertEqual(len(self.connections), 2)
+
+        self.kill(self.connections[1])
+        self.pool.keepalive_idle()
+        self.assertEqual(self.pool._idle[("ups1", 3493, None)], [])
+
+    def test_keepalive_disabled(self):
+        self.pool.keepalive = None
+        self.pool.run(lambda c: c.ver(), "ups1")
+        self.pool.keepalive_idle()
+        self.pool.start_keepalive()
+        self.assertEqual(self.pool._keepalive_thread, None)
+        self.assertEqual(len(self.pool._idle[("ups1", 3493, None)]), 1)
+
+    def test_run_reconnects(self):
+        self.pool.keepalive = None
+        self.pool.run(lambda c: c.ver(), "ups1")
+        self.kill(self.connections[0])
+        self.assertEqual(self.pool.run(lambda c: c.num_logins(self.valid),
+                                       "ups1"), 1)
+        self.assertEqual(len(self.connections), 2)
+
+    def test_circuit_breaker(self):
+        self.down = True
+        for _ in range(2):
+            self.assertRaises(PyNUTConnectionError, self.pool.run,
+                              lambda c: c.ver(), "ups1")
+        self.assertRaises(PyNUTCircuitOpenError, self.pool.run,
+                          lambda c: c.ver(), "ups1")
+        # Other servers are not affected.
+        self.down = False
+        self.pool.run(lambda c: c.ver(), "ups2")
+        time.sleep(0.06)
+        self.pool.run(lambda c: c.ver(), "ups1")
+
+    def test_client_proxy(self):
+        client = self.pool.client("ups1", login=self.valid,
+                                  password=self.valid)
+        self.assertEqual(client.list_vars(self.valid),
+                         {'battery.charge': '100', 'battery.voltage': '14.44'})
+        self.kill(self.connections[0])
+        self.pool.keepalive = None
+        self.assertEqual(client.description(self.valid), "Test UPS 1")
+        self.assertRaises(AttributeError, getattr, client, "iter_vars")
+
+
+class TestPollScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.vars = {'ups.status': 'OL', 'input.voltage': '230.0',
+                     'device.serial': 'ABC123', 'ups.firmware': '1.0',
+                     'battery.charge': '100'}
+        self.requests = []
+        client = PyNUTClient(transport=lambda host, port, timeout:
+                LoopbackTransport(self.handler))
+        self.scheduler = PollScheduler(client, "ups", max_interval=16,
+                                       full_interval=None)
+
+    def handler(self, line):
+        self.requests.append(line)
+        words = line.split()
+        if words[:2] == [b"LIST", b"VAR"]:
+            return (b"BEGIN LIST VAR ups\n" + b"".join(
+                    b'VAR ups %s "%s"\n' % (var.encode(), value.encode())
+                    for var, value in self.vars.items()) +
+                    b"END LIST VAR ups\n")
+        if words[:2] == [b"GET", b"VAR"]:
+            var = words[3].decode()
+            if var not in self.vars:
+                return b"ERR VAR-NOT-SUPPORTED\n"
+            return b'VAR ups %s "%s"\n' % (words[3],
+                                            self.vars[var].encode())
+        return b"OK\n"
+
+    def run_ticks(self, ticks, start=0):
+        changes = []
+        for now in range(start, start + ticks):
+            if now % 2:
+                self.vars['input.voltage'] = '%d.0' % (220 + now % 7)
+            changes.extend(self.scheduler.poll(now=now))
+        return changes
+
+    def test_first_poll_lists(self):
+        changes = self.scheduler.poll(now=0)
+        self.assertEqual(len(changes), 5)
+        self.assertEqual(self.scheduler.values, self.vars)
+        self.assertEqual(self.scheduler.lists, 1)
+        self.assertEqual(self.scheduler.poll(now=0.5), [])
+
+    def test_learning(self):
+        self.run_ticks(60)
+        self.assertEqual(self.scheduler.interval('ups.status'), 1)
+        self.assertEqual(self.scheduler.interval('input.voltage'), 1)
+        self.assertEqual(self.scheduler.interval('device.serial'), 16)
+        # Static variables are now rarely read.
+        self.requests = []
+        lists = self.scheduler.lists
+        changes = self.run_ticks(32, start=60)
+        # Two or three ticks have everything due, and use LIST VAR.
+        self.assertTrue(self.scheduler.lists - lists <= 3)
+        self.assertFalse(any(b"device.serial" in line
+                             for line in self.requests))
+        self.assertTrue(len(self.requests) < 32 * 2 + 3)
+        self.assertTrue(all(change.var == 'input.voltage'
+                            for change in changes))
+
+    def test_list_threshold(self):
+        self.scheduler.poll(now=0)
+        self.scheduler.poll(now=1)
+        self.assertEqual(self.scheduler.lists, 2)
+        self.scheduler.list_threshold = 1
+        self.scheduler.poll(now=2)
+        self.assertEqual(self.scheduler.lists, 2)
+        self.assertEqual(self.scheduler.gets, 1)
+
+    def test_alert_tightens_intervals(self):
+        self.run_ticks(40)
+        self.vars['ups.status'] = 'OB LB'
+        self.run_ticks(2, start=40)
+        self.assertTrue(self.scheduler.alert)
+        self.assertEqual(self.scheduler.interval('device.serial'), 2)
+        self.requests = []
+        self.run_ticks(4, start=42)
+        self.assertTrue(any(b"device.serial" in line or b"LIST" in line
+                            for line in self.requests))
+
+    def test_removed_variable(self):
+        self.scheduler.poll(now=0)
+        del self.vars['battery.charge']
+        self.scheduler.list_threshold = 1
+        changes = self.scheduler.poll(now=1)
+        self.assertEqual([(c.var, c.new) for c in changes],
+                         [('battery.charge', None)])
+        self.assertFalse('battery.charge' in self.scheduler.values)
+
+
+class TestClientStats(unittest.TestCase):
+
+    def setUp(self):
+        self.valid = "test"
+        self.events = []
+        self.stats = ClientStats(observers=[self.events.append])
+        self.client = PyNUTClient(login=self.valid, password=self.valid,
+                stats=self.stats, transport=lambda host, port, timeout:
+                LoopbackTransport(self.handler))
+
+    def handler(self, line):
+        server = MockServer(broken=False)
+        server.write(line)
+        return server.replies
+
+    def test_counters(self):
+        self.client.get_var(self.valid, self.valid)
+        self.assertRaises(PyNUTError, self.client.get_var, self.valid,
+                          "does_not_exist")
+        self.client.list_vars(self.valid)
+        commands = self.stats.commands
+        self.assertEqual(sorted(commands), ["GET VAR", "LIST VAR",
+                                            "PASSWORD", "USERNAME"])
+        self.assertEqual(commands["GET VAR"].count, 2)
+        self.assertEqual(commands["GET VAR"].errors, 1)
+        self.assertEqual(commands["GET VAR"].bytes_sent,
+                         len(b"GET VAR test test\n") +
+                         len(b"GET VAR test does_not_exist\n"))
+        self.assertEqual(commands["LIST VAR"].bytes_received,
+                         len(self.handler(b"LIST VAR test\n")))
+        self.assertEqual(commands["LIST VAR"].wire.count, 1)
+        self.assertEqual(commands["LIST VAR"].parse.count, 1)
+
+    def test_observers(self):
+        pipe = self.client.pipeline()
+        pipe.get_var(self.valid, self.valid).run_command(self.valid,
+                                                         self.valid)
+        pipe.execute()
+        self.assertEqual([event.command for event in self.events],
+                         ["USERNAME", "PASSWORD", "GET VAR", "INSTCMD"])
+        event = self.events[2]
+        self.assertEqual(event.error, None)
+        self.assertTrue(event.wire_time >= 0 and event.parse_time >= 0)
+
+        self.stats.remove_observer(self.events.append)
+        self.assertEqual(list(self.client.iter_vars(self.valid))[0][0],
+                         'battery.charge')
+        self.assertEqual(len(self.events), 4)
+        self.assertEqual(self.stats.commands["LIST VAR"].count, 1)
+
+    def test_histogram(self):
+        histogram = LatencyHistogram(bounds=(0.001, 0.01, 0.1))
+        self.assertEqual(histogram.percentile(0.5), None)
+        for duration in (0.0005, 0.002, 0.003, 0.05, 2):
+            histogram.observe(duration)
+        self.assertEqual(list(histogram.counts), [1, 2, 1, 1])
+        self.assertEqual(histogram.percentile(0.5), 0.01)
+        self.assertEqual(histogram.percentile(1), float('inf'))
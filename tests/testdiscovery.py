@@ -0,0 +1,94 @@
+import os
+import shutil
+import tempfile
+import unittest
+from emulator import UPSEmulator
+
+from nut2 import PyNUTClient, DiscoveryCache, MetadataCache
+
+
+class TestDiscoveryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.upsd = UPSEmulator(ups_count=2, var_count=5,
+                                command_count=2).start()
+        self.addCleanup(self.upsd.stop)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, "discovery.json")
+
+        self.key = "%s:%s" % (self.upsd.host, self.upsd.port)
+
+    def discover(self, cache=None):
+        discovery = DiscoveryCache(self.path)
+        with PyNUTClient(port=self.upsd.port, cache=cache) as client:
+            inventory = discovery.discover(client)
+        discovery.save()
+        return discovery, inventory
+
+    def test_rediscover_changed(self):
+        discovery, inventory = self.discover()
+        self.assertEqual(discovery.rediscovered[self.key], ["ups0", "ups1"])
+        self.assertEqual(sorted(inventory), ["ups0", "ups1"])
+        self.assertEqual(inventory["ups1"]["types"]["var3"], "NUMBER")
+        self.assertEqual(inventory["ups1"]["commands"],
+                         {"cmd0": "Command", "cmd1": "Command"})
+
+        # Nothing changed: only LIST UPS and LIST VAR are sent.
+        requests = self.upsd.requests
+        discovery, reloaded = self.discover()
+        self.assertEqual(discovery.rediscovered[self.key], [])
+        self.assertEqual(reloaded, inventory)
+        self.assertEqual(self.upsd.requests - requests, 3)
+
+        discovery.servers[self.key]["ups1"]["vars"].remove("var4")
+        discovery.servers[self.key]["ups2"] = inventory["ups0"]
+        discovery.save()
+        discovery, reloaded = self.discover()
+        self.assertEqual(discovery.rediscovered[self.key], ["ups1"])
+        self.assertEqual(reloaded, inventory)
+
+    def test_several_servers(self):
+        with UPSEmulator(ups_count=1, var_count=2) as other:
+            discovery = DiscoveryCache()
+            for upsd in (self.upsd, other):
+                with PyNUTClient(port=upsd.port) as client:
+                    discovery.discover(client)
+        self.assertEqual(discovery.rediscovered, {
+            self.key: ["ups0", "ups1"],
+            "%s:%s" % (other.host, other.port): ["ups0"]})
+        self.assertEqual(len(discovery.servers), 2)
+        self.assertRaises(ValueError, discovery.save)
+
+    def test_unreadable_ups_kept(self):
+        _, inventory = self.discover()
+        self.upsd._replies[b"LIST VAR ups1"] = b"ERR DATA-STALE\n"
+        discovery, reloaded = self.discover()
+        self.assertEqual(discovery.rediscovered[self.key], [])
+        self.assertEqual(reloaded, inventory)
+
+    def test_prime_metadata_cache(self):
+        self.discover()
+        cache = MetadataCache()
+        self.discover(cache)
+        requests = self.upsd.requests
+        with PyNUTClient(port=self.upsd.port, cache=cache) as client:
+            self.assertEqual(client.var_type("ups0", "var1"), "NUMBER")
+            self.assertEqual(client.command_description("ups1", "cmd1"),
+                             "Command")
+        self.assertEqual(self.upsd.requests, requests)
+
+    def test_other_version_ignored(self):
+        with open(self.path, "w") as cache_file:
+            cache_file.write('{"version": 0, "servers": {"x": {}}}')
+        self.assertEqual(DiscoveryCache(self.path).servers, {})
+
+    def test_corrupt_file_rebuilt(self):
+        self.discover()
+        with open(self.path, "r+") as cache_file:
+            cache_file.truncate(20)
+        discovery, inventory = self.discover()
+        self.assertEqual(sorted(inventory), ["ups0", "ups1"])
+        self.assertEqual(discovery.rediscovered[self.key], ["ups0", "ups1"])
+        self.assertEqual(DiscoveryCache(self.path).servers,
+                         discovery.servers)
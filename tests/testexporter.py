@@ -0,0 +1,102 @@
+import gzip
+import time
+import unittest
+import urllib.request
+from emulator import UPSEmulator
+from servers import start_garbled_server
+
+from nut2 import PyNUTError, MetricsExporter, FleetTarget, PollResult
+
+
+class TestMetricsExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.upsd = UPSEmulator(ups_count=2, var_count=3).start()
+        self.addCleanup(self.upsd.stop)
+        self.exporter = MetricsExporter([(self.upsd.host, self.upsd.port)],
+                                        port=0, interval=60, timeout=2)
+        self.addCleanup(self.exporter.shutdown)
+
+    def scrape(self, **headers):
+        host, port = self.exporter.address
+        request = urllib.request.Request("http://%s:%d/metrics" % (
+            host, port), headers=headers)
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.headers, response.read()
+
+    def test_scrape(self):
+        self.exporter.start()
+        deadline = time.monotonic() + 5
+        while not self.exporter.polls and time.monotonic() < deadline:
+            time.sleep(0.01)
+        headers, body = self.scrape()
+        self.assertTrue(headers["Content-Type"].startswith("text/plain"))
+        lines = body.decode().splitlines()
+        server = 'server="%s:%d"' % (self.upsd.host, self.upsd.port)
+        self.assertIn('nut_up{%s} 1' % server, lines)
+        self.assertIn('nut_var2{%s,ups="ups1"} 2.0' % server, lines)
+        self.assertEqual(lines.count("# TYPE nut_var1 gauge"), 1)
+
+        requests = self.upsd.requests
+        headers, compressed = self.scrape(**{
+            "Accept-Encoding": "gzip",
+            "Accept": "application/openmetrics-text; version=1.0.0"})
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(compressed), body + b"# EOF\n")
+        # Scrapes are served without polling the server.
+        self.assertEqual(self.upsd.requests, requests)
+
+    def test_failing_server(self):
+        garbled = ("127.0.0.1", start_garbled_server(self))
+        exporter = MetricsExporter(
+            [garbled, (self.upsd.host, self.upsd.port)], port=0, timeout=2)
+        self.addCleanup(exporter.shutdown)
+        for _ in range(2):
+            exporter.poll()
+            body = exporter.exposition().decode()
+            self.assertIn('nut_up{server="127.0.0.1:%d"} 0\n' % garbled[1],
+                          body)
+            self.assertIn('nut_var0{server="%s:%d",ups="ups0"} 0.0\n' % (
+                self.upsd.host, self.upsd.port), body)
+        self.assertEqual(exporter.polls, 2)
+
+    def test_incremental_update(self):
+        target = FleetTarget("nas", 3493)
+
+        def result(status, charge):
+            return PollResult(target, {"ups": {
+                "ups.status": status, "battery.charge": charge,
+                "ups.model": "Model"}}, {}, None, 0.1)
+
+        self.exporter.update([result("OL CHRG", "90")])
+        body = self.exporter.exposition()
+        self.assertIn(b'nut_ups_status{server="nas:3493",ups="ups",'
+                      b'flag="CHRG"} 1\n', body)
+        self.assertIn(b'flag="OB"} 0\n', body)
+        self.assertNotIn(b"ups_model", body)
+        block = self.exporter._blocks["nut_battery_charge"]
+
+        self.exporter.update([result("OB DISCHRG", "90")])
+        self.assertIs(self.exporter._blocks["nut_battery_charge"], block)
+        body = self.exporter.exposition()
+        self.assertIn(b'flag="OB"} 1\n', body)
+        self.assertIs(self.exporter.exposition(), body)
+
+        self.exporter.update([PollResult(target, None, {}, PyNUTError(), 1)])
+        self.assertEqual(self.exporter.exposition(),
+                         b"# HELP nut_up Whether the NUT server could be "
+                         b"polled.\n# TYPE nut_up gauge\n"
+                         b'nut_up{server="nas:3493"} 0\n')
+
+    def test_special_values(self):
+        target = FleetTarget("nas", 3493)
+        self.exporter.update([PollResult(target, {"ups": {
+            "input.frequency": "nan", "ups.load": "inf",
+            "ups.temperature": "-inf"}}, {}, None, 0.1)])
+        body = self.exporter.exposition()
+        self.assertIn(b'nut_input_frequency{server="nas:3493",ups="ups"} '
+                      b'NaN\n', body)
+        self.assertIn(b'nut_ups_load{server="nas:3493",ups="ups"} +Inf\n',
+                      body)
+        self.assertIn(b'nut_ups_temperature{server="nas:3493",ups="ups"} '
+                      b'-Inf\n', body)
@@ -0,0 +1,87 @@
+import threading
+import unittest
+from emulator import UPSEmulator
+
+from nut2 import PyNUTClient, PyNUTError, NUTProxy
+
+
+class TestProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.upstreams = [UPSEmulator(ups_count=2, var_count=5,
+                                      users={"admin": "secret"}).start()
+                          for _ in range(2)]
+        for upsd in self.upstreams:
+            self.addCleanup(upsd.stop)
+        self.proxy = NUTProxy([(upsd.host, upsd.port, None, None, prefix)
+                               for upsd, prefix in zip(self.upstreams,
+                                                       ("a-", "b-"))],
+                              port=0, ttl=60, timeout=2).start()
+        self.addCleanup(self.proxy.shutdown)
+
+    def client(self, **kwargs):
+        host, port = self.proxy.address
+        return PyNUTClient(host, port, **kwargs)
+
+    def test_namespace(self):
+        with self.client() as client:
+            self.assertEqual(sorted(client.list_ups()),
+                             ["a-ups0", "a-ups1", "b-ups0", "b-ups1"])
+            self.assertEqual(client.description("b-ups1"),
+                             "Emulated UPS ups1")
+            self.assertRaises(PyNUTError, client.list_vars, "c-ups0")
+            self.assertRaises(PyNUTError, client.list_vars, "ups0")
+
+    def test_cached_reads(self):
+        with self.client() as client:
+            ups_vars = client.list_vars("a-ups1")
+            self.assertEqual(len(ups_vars), 5)
+            requests = self.upstreams[0].requests
+            for var, value in ups_vars.items():
+                self.assertEqual(client.get_var("a-ups1", var), value)
+            self.assertEqual(client.list_vars("a-ups1"), ups_vars)
+            self.assertEqual(self.upstreams[0].requests, requests)
+            self.assertRaises(PyNUTError, client.get_var, "a-ups1", "nope")
+
+            self.assertEqual(client.var_type("b-ups0", "var1"), "NUMBER")
+            self.assertEqual(client.list_commands("b-ups0")["cmd2"],
+                             "Command")
+            self.assertEqual(client.num_logins("b-ups0"), 1)
+        self.assertTrue(self.proxy.hits > self.proxy.misses)
+
+    def test_writes_use_client_credentials(self):
+        with self.client() as client:
+            self.assertRaises(PyNUTError, client.run_command, "a-ups0",
+                              "cmd0")
+            self.assertRaises(PyNUTError, client.set_var, "a-ups0", "var0",
+                              "1")
+        with self.client(login="admin", password="secret") as client:
+            client.list_vars("b-ups0")
+            requests = self.upstreams[1].requests
+            client.run_command("b-ups0", "cmd0")
+            client.set_var("b-ups0", "var0", 'a "quoted" value')
+            client.fsd("b-ups0")
+            # The cached variables were dropped.
+            client.list_vars("b-ups0")
+            self.assertTrue(self.upstreams[1].requests > requests + 4)
+        with self.client(login="admin", password="wrong") as client:
+            self.assertRaises(PyNUTError, client.fsd, "b-ups0")
+
+    def test_single_flight(self):
+        with self.client() as client:
+            client.list_ups()
+        upsd = self.upstreams[0]
+        upsd.latency = 0.2
+        requests = upsd.requests
+        results = []
+
+        def read():
+            with self.client() as client:
+                results.append(client.list_vars("a-ups0"))
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertEqual(upsd.requests - requests, 1)
@@ -0,0 +1,303 @@
+import functools
+import os
+import shutil
+import socket
+import ssl
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from emulator import UPSEmulator
+from servers import (mock_handler, CERTFILE, serve_tls, serve,
+                     start_garbled_server)
+
+import nut2
+
+from nut2 import (PyNUTClient, PyNUTError, PyNUTTimeoutError, TCPTransport,
+                  UnixTransport, LoopbackTransport, ShardedPoller)
+
+
+class TestTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.valid = "test"
+
+    def start_server(self, listener, chunk_size=None):
+        thread = threading.Thread(target=serve, args=(listener, chunk_size))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(listener.close)
+        self.addCleanup(thread.join, 5)
+
+    def test_tcp(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.start_server(listener, chunk_size=3)
+        with PyNUTClient(port=listener.getsockname()[1], login=self.valid,
+                         password=self.valid) as client:
+            self.assertEqual(client.list_vars(self.valid),
+                             {'battery.charge': '100',
+                              'battery.voltage': '14.44'})
+            self.assertEqual(client.get_var(self.valid, self.valid), '100')
+            self.assertTrue(isinstance(client._srv_handler, TCPTransport))
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "no Unix sockets")
+    def test_unix(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "upsd.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        self.start_server(listener)
+        with PyNUTClient(host=path, transport=UnixTransport) as client:
+            self.assertEqual(client.list_commands(self.valid),
+                             {self.valid: "Test UPS 1"})
+
+    def test_connection_refused(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        self.assertRaises(PyNUTError, PyNUTClient, port=port)
+
+    def test_connection_closed(self):
+        transport = LoopbackTransport(lambda line: b"")
+        transport.write(b"VER\n")
+        self.assertRaises(PyNUTError, transport.read_until, b"\n")
+
+    def test_timeout(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        transport = TCPTransport("127.0.0.1", listener.getsockname()[1])
+        self.addCleanup(transport.close)
+        self.assertRaises(PyNUTError, transport.read_until, b"\n", 0.05)
+
+    def test_loopback(self):
+        client = PyNUTClient(
+            transport=lambda host, port, timeout: LoopbackTransport(mock_handler))
+        self.assertEqual(client.num_logins(self.valid), 1)
+        self.assertEqual(client.list_ups()[self.valid], "Test UPS 1")
+
+    def test_read_until_buffering(self):
+        replies = [b"A" * 20000 + b"\nB\n", b"C\r", b"\nD\n"]
+        transport = LoopbackTransport(lambda line: replies.pop(0))
+        transport.write(b"1\n")
+        self.assertEqual(transport.read_until(b"\n"), b"A" * 20000 + b"\n")
+        transport.write(b"2\n3\n")
+        self.assertEqual(transport.read_until(b"\n"), b"B\n")
+        self.assertEqual(transport.read_until(b"\r\n"), b"C\r\n")
+        self.assertEqual(transport.read_until(b"D\n"), b"D\n")
+
+
+class TestEmulator(unittest.TestCase):
+
+    def setUp(self):
+        self.upsd = UPSEmulator(ups_count=2, var_count=30, command_count=3,
+                                value_size=12).start()
+        self.addCleanup(self.upsd.stop)
+
+    def test_requests(self):
+        with PyNUTClient(port=self.upsd.port, login="user",
+                         password="pass") as client:
+            self.assertEqual(sorted(client.list_ups()), ["ups0", "ups1"])
+            ups_vars = client.list_vars("ups1")
+            self.assertEqual(len(ups_vars), 30)
+            self.assertEqual(ups_vars["var7"], "000000000007")
+            self.assertEqual(client.list_commands("ups0"),
+                             {"cmd0": "Command", "cmd1": "Command",
+                              "cmd2": "Command"})
+            self.assertRaises(PyNUTError, client.get_var, "ups2", "var0")
+            self.assertEqual(client.list_clients("ups1"),
+                             {"ups1": ["127.0.0.1"]})
+            self.assertEqual(list(client.iter_clients()),
+                             [("ups0", "127.0.0.1"), ("ups1", "127.0.0.1")])
+            pipe = client.pipeline()
+            for i in range(30):
+                pipe.get_var("ups0", "var%d" % i)
+            self.assertEqual(pipe.execute(), list(ups_vars.values()))
+
+
+@unittest.skipIf(nut2.shared_memory is None, "requires Python 3.8")
+class TestShardedPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [UPSEmulator(ups_count=2, var_count=10).start()
+                        for _ in range(3)]
+        for server in self.servers:
+            self.addCleanup(server.stop)
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        self.closed_port = listener.getsockname()[1]
+        listener.close()
+
+    def test_sweep(self):
+        targets = [(server.host, server.port) for server in self.servers]
+        targets.append(("127.0.0.1", self.closed_port))
+        with ShardedPoller(targets, processes=2, timeout=2) as poller:
+            self.assertEqual(poller.processes, 2)
+            for _ in range(2):
+                results = poller.sweep()
+                self.assertEqual([result.target for result in results],
+                                 poller.targets)
+                for result in results[:3]:
+                    self.assertEqual(result.error, None)
+                    self.assertEqual(sorted(result.ups_vars),
+                                     ["ups0", "ups1"])
+                    self.assertEqual(result.ups_vars["ups1"]["var3"],
+                                     "00000003")
+                self.assertTrue(isinstance(results[3].error, PyNUTError))
+            self.assertEqual(poller.read(0), results[0])
+
+    def test_large_servers(self):
+        with UPSEmulator(ups_count=4, var_count=120, value_size=12) as upsd:
+            with ShardedPoller([(upsd.host, upsd.port)],
+                               timeout=2) as poller:
+                result = poller.sweep()[0]
+        self.assertEqual(result.error, None)
+        self.assertEqual(sum(map(len, result.ups_vars.values())), 480)
+
+    def test_garbled_reply(self):
+        targets = [(self.servers[0].host, self.servers[0].port),
+                   ("127.0.0.1", start_garbled_server(self))]
+        with ShardedPoller(targets, processes=2, timeout=2) as poller:
+            results = poller.sweep()
+        self.assertEqual(results[0].error, None)
+        self.assertTrue(isinstance(results[1].error, PyNUTError))
+        self.assertIn("UnicodeDecodeError", str(results[1].error))
+
+    def test_dead_worker(self):
+        slow = UPSEmulator(latency=1).start()
+        self.addCleanup(slow.stop)
+        targets = [(self.servers[0].host, self.servers[0].port),
+                   (slow.host, slow.port),
+                   (self.servers[1].host, self.servers[1].port)]
+        with ShardedPoller(targets, processes=2, timeout=5) as poller:
+            poller.start()
+            killer = threading.Timer(0.3, poller._workers[1][0].terminate)
+            killer.start()
+            results = poller.sweep()
+            killer.join()
+            self.assertEqual([result.error is None for result in results],
+                             [True, False, True])
+            # The worker is started again by the next sweep.
+            slow.latency = 0
+            self.assertTrue(all(result.error is None
+                                for result in poller.sweep()))
+
+    def test_slot_too_small(self):
+        server = self.servers[0]
+        with ShardedPoller([(server.host, server.port)], slot_size=64,
+                           timeout=2) as poller:
+            self.assertTrue(isinstance(poller.sweep()[0].error, PyNUTError))
+
+    def test_no_shared_memory(self):
+        with patch("nut2.shared_memory", None):
+            self.assertRaises(PyNUTError, ShardedPoller, [("127.0.0.1",)])
+
+    def test_torn_slot(self):
+        buf = bytearray(256)
+        nut2._write_slot(buf, 0, 256, 1.0, 0.5, nut2._SLOT_VARS, b"+ups\0")
+        # A writer killed between the two sequence stores.
+        nut2._SLOT_SEQ.pack_into(buf, 0, 3)
+        kind = nut2._read_slot(buf, 0, timeout=0.01)[2]
+        self.assertEqual(kind, nut2._SLOT_ERROR)
+        nut2._write_slot(buf, 0, 256, 2.0, 0.5, nut2._SLOT_VARS, b"+ups\0")
+        self.assertEqual(nut2._read_slot(buf, 0),
+                         (2.0, 0.5, nut2._SLOT_VARS, b"+ups\0"))
+
+class TestTLS(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.addCleanup(self.listener.close)
+        self.port = self.listener.getsockname()[1]
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(CERTFILE)
+        self.thread = threading.Thread(target=serve_tls, args=(
+            self.listener, server_context, 3))
+        self.thread.daemon = True
+        self.thread.start()
+        self.context = ssl.create_default_context(cafile=CERTFILE)
+
+    def client(self):
+        return PyNUTClient("127.0.0.1", self.port, login="test",
+                           password="test", ssl_context=self.context)
+
+    def test_session_resumption(self):
+        with self.client() as client:
+            self.assertFalse(client.tls_session_reused)
+            self.assertTrue(client._srv_handler.tls_session is not None)
+            self.assertEqual(client.get_var("test", "test"), "100")
+        for _ in range(2):
+            with self.client() as client:
+                self.assertTrue(client.tls_session_reused)
+                self.assertEqual(len(client.list_vars("test")), 2)
+        self.thread.join(5)
+
+    def test_untrusted_certificate(self):
+        self.context = ssl.create_default_context()
+        self.assertRaises(PyNUTError, self.client)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "no Unix sockets")
+    def test_unix_socket(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "upsd.sock")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(CERTFILE)
+        thread = threading.Thread(target=serve_tls, args=(
+            listener, server_context, 2))
+        thread.daemon = True
+        thread.start()
+        self.assertRaises(PyNUTError, PyNUTClient, path,
+                          transport=UnixTransport, ssl_context=self.context)
+        transport = functools.partial(UnixTransport,
+                                      server_hostname="localhost")
+        with PyNUTClient(path, transport=transport,
+                         ssl_context=self.context) as client:
+            self.assertEqual(client.get_var("test", "test"), "100")
+
+    def test_handshake_deadline(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        self.addCleanup(listener.close)
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+
+        def accept_starttls():
+            conn, _ = listener.accept()
+            with conn:
+                conn.recv(64)
+                conn.sendall(b"OK STARTTLS\n")
+                # Never answer the handshake.
+                stop.wait(5)
+        thread = threading.Thread(target=accept_starttls)
+        thread.daemon = True
+        thread.start()
+        start = time.time()
+        try:
+            PyNUTClient("127.0.0.1", listener.getsockname()[1], timeout=5,
+                        deadline=0.2, ssl_context=self.context)
+        except PyNUTTimeoutError as err:
+            self.assertEqual(err.operation, "connect")
+        else:
+            self.fail("PyNUTTimeoutError not raised")
+        self.assertTrue(time.time() - start < 1)
+
+    def test_plaintext(self):
+        with PyNUTClient("127.0.0.1", self.port) as client:
+            self.assertEqual(client.tls_session_reused, None)
+            self.assertEqual(client.ver(), 'Network UPS Tools upsd 2.7.1 '
+                             '- http://www.networkupstools.org/\n')